@@ -19,6 +19,7 @@ setup(
                  },
     install_requires=['numpy>=1.10',
                       'pandas>=0.24',
+                      'scipy',
                       'matplotlib>=3.0',
                       'biopython>=1.5',
                       'pyvcf>=0.6',
@@ -30,7 +31,10 @@ setup(
     entry_points = {
         'console_scripts': [
             'snipgenie-gui=snipgenie.gui:main',
-            'snipgenie=snipgenie.app:main']
+            'snipgenie=snipgenie.app:main',
+            'snipgenie-type=snipgenie.snp_typing:main',
+            'snipgenie-db=snipgenie.database:main',
+            'snipgenie-cluster=snipgenie.clustering:main']
             },
     classifiers = ['Operating System :: OS Independent',
             'Programming Language :: Python :: 2.7',
@@ -43,42 +43,131 @@ def build_bwa_index(fastafile, path=None):
     print (cmd)
     return
 
+def sort_options(out, ref=None):
+    """Get samtools sort output options, a .cram extension on the output
+    file gives reference compressed cram"""
+
+    if os.path.splitext(out)[1] == '.cram':
+        return '-O cram --reference {r}'.format(r=ref)
+    return ''
+
+def unmapped_filter(out, unmapped):
+    """
+    Get samtools view option that writes reads removed by the view filter
+    (the unmapped reads) to a temporary bam in the unmapped folder.
+    Returns:
+        options string and temporary file name
+    """
+
+    if unmapped == None:
+        return '', None
+    name = os.path.basename(out)
+    tmp = os.path.join(unmapped, name+'.unmapped')
+    return '-U {u}'.format(u=tmp), tmp
+
+def write_unmapped(tmp, paired=True):
+    """
+    Write unmapped reads captured during alignment to compressed fastq
+    files and remove the temporary bam. Unpaired mates are discarded.
+    """
+
+    if tmp == None or not os.path.exists(tmp):
+        return
+    samtoolscmd = tools.get_cmd('samtools')
+    name = os.path.splitext(tmp[:-len('.unmapped')])[0]
+    cmd = '{s} fastq -n {o} {u}'.format(s=samtoolscmd,o=unmapped_fastq_options(name, paired),u=tmp)
+    print (cmd)
+    subprocess.check_output(cmd, shell=True)
+    os.remove(tmp)
+    return
+
+def unmapped_fastq_options(name, paired=True):
+    """samtools fastq output options, unpaired mates are discarded"""
+
+    if paired == True:
+        return '-1 {n}_R1.fastq.gz -2 {n}_R2.fastq.gz -0 {d} -s {d}'.format(n=name,d=os.devnull)
+    return '-0 {n}.fastq.gz -s {d}'.format(n=name,d=os.devnull)
+
+def extract_unmapped(out, unmapped, paired=True, ref=None):
+    """
+    Write the unmapped reads of a sorted bam or cram file to compressed
+    fastq files in the unmapped folder. This is a separate pass so the
+    unmapped reads are also kept in the alignment.
+    """
+
+    if unmapped == None or not os.path.exists(out):
+        return
+    samtoolscmd = tools.get_cmd('samtools')
+    name = os.path.join(unmapped, os.path.splitext(os.path.basename(out))[0])
+    #mates are grouped again before writing pairs
+    cmd = '{s} view -u -f 4 {r} {b} | {s} collate -O -u - {n}.collate | {s} fastq -n {o} -'\
+            .format(s=samtoolscmd,r=tools.reference_option(ref),b=out,n=name,
+                    o=unmapped_fastq_options(name, paired))
+    print (cmd)
+    subprocess.check_output(cmd, shell=True)
+    return
+
+def stream_trimmed_reads(cmd, file1, file2, quality=20, threads=4):
+    """
+    Run an aligner command that reads interleaved fastq from stdin, feeding
+    it reads trimmed on the fly so that no trimmed files are written.
+    Returns:
+        dict of trimming stats
+    """
+
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    stats = None
+    try:
+        stats = tools.trim_reads_interleaved(file1, file2, p.stdin, quality,
+                                             threads=max(1,int(threads)//2))
+        p.stdin.close()
+    except BrokenPipeError:
+        #the aligner exited early, its return code is checked below
+        pass
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return stats
+
 def bwa_align(file1, file2, idx, out, threads=4, overwrite=False,
-              options='', filter=None, unmapped=None):
+              options='', filter=None, unmapped=None, trim_quality=None):
     """Align reads to a reference with bwa.
     Args:
         file1, file2: fastq files
         idx: bwa index name
-        out: output bam file name
+        out: output bam or cram file name
         options: extra command line options e.g. -k INT for seed length
-        unmapped: path to file for unmapped reads if required
+        unmapped: folder for unmapped reads if required, these are kept in
+        the bam and also saved as fastq.gz
+        trim_quality: if set, reads are trimmed at this quality with the built
+        in method and streamed to bwa
+    Returns:
+        trimming stats if trim_quality is set
     """
 
     bwacmd = tools.get_cmd('bwa')
     samtoolscmd = tools.get_cmd('samtools')
     if file2 == None:
         file2=''
-    cmd = '{b} mem -M -t {t} {p} {i} "{f1}" "{f2}" | {s} view -bt - | {s} sort -o {o}'.format(
-                b=bwacmd,i=idx,s=samtoolscmd,
-                f1=file1,f2=file2,o=out,t=threads,p=options)
+    so = sort_options(out, idx)
+    if trim_quality != None:
+        #interleaved reads from stdin
+        pe = '-p' if file2 != '' else ''
+        cmd = '{b} mem -M {pe} -t {t} {p} {i} - | {s} view -bt - | {s} sort {so} -o {o}'.format(
+                    b=bwacmd,i=idx,s=samtoolscmd,pe=pe,o=out,t=threads,p=options,so=so)
+    else:
+        cmd = '{b} mem -M -t {t} {p} {i} "{f1}" "{f2}" | {s} view -bt - | {s} sort {so} -o {o}'.format(
+                    b=bwacmd,i=idx,s=samtoolscmd,
+                    f1=file1,f2=file2,o=out,t=threads,p=options,so=so)
+    stats = None
     if not os.path.exists(out) or overwrite == True:
         print (cmd)
-        tmp = subprocess.check_output(cmd, shell=True)
-
-        #write out unmapped reads
-        if unmapped != None:
-            f1 = os.path.join(unmapped,os.path.basename(file1))
-            f2 = os.path.join(unmapped,os.path.basename(file2))
-            #cmd = '{s} view -b -f 4 {o} > {u}'.format(s=samtoolscmd,o=out,u=unmapped)
-            #cmd = '{s} view -b -f 4 {o} | {s} fastq -1 {f1} -2 {f2} \
-            #         -0 /dev/null -s /dev/null -n'.format(s=samtoolscmd,o=out,u=unmapped,f1=f1,f2=f2)
-
-            uf =  os.path.join(unmapped,os.path.basename(out))+'.fasta'
-            cmd = '{s} view -b -f 4 {o} | {s} fasta -0 /dev/null {o} > {f}'.format(
-                    s=samtoolscmd,o=out,u=unmapped,f=uf)
-            #print (cmd)
+        if trim_quality != None:
+            stats = stream_trimmed_reads(cmd, file1, file2 or None, trim_quality, threads)
+        else:
             tmp = subprocess.check_output(cmd, shell=True)
-    return
+        #write out unmapped reads
+        extract_unmapped(out, unmapped, paired=file2!='', ref=idx)
+    return stats
 
 def build_bowtie_index(fastafile, path=None):
     """Build a bowtie index
@@ -104,8 +193,15 @@ def build_bowtie_index(fastafile, path=None):
     return name
 
 def bowtie_align(file1, file2, idx, out, remaining=None, threads=2,
-                overwrite=False, verbose=True, options='-v 1 --best'):
-    """Map reads using bowtie"""
+                overwrite=False, verbose=True, options='-v 1 --best',
+                unmapped=None, trim_quality=None, ref=None):
+    """Map reads using bowtie.
+    Args:
+        unmapped: folder for unmapped reads if required
+        ref: reference fasta, required for cram output
+        trim_quality: if set, reads are trimmed at this quality with the built
+        in method and streamed to bowtie
+    """
 
     bowtiecmd = tools.get_cmd('bowtie')
     samtoolscmd = tools.get_cmd('samtools')
@@ -114,22 +210,41 @@ def bowtie_align(file1, file2, idx, out, remaining=None, threads=2,
         print ('aligners.BOWTIE_INDEXES variable not set')
         return
     os.environ["BOWTIE_INDEXES"] = BOWTIE_INDEXES
-    if file2 != None:
+    if trim_quality != None:
+        filestr = '--interleaved -' if file2 != None else '-'
+    elif file2 != None:
         filestr = '-1 {f1} -2 {f2}'.format(f1=file1,f2=file2)
     else:
         filestr = file1
-    cmd = '{c} -q -p {t} -S {p} {r} {f} | {s} view -F 0x04 -bt - | {s} sort -o {o}'\
-            .format(c=bowtiecmd,t=threads,f=filestr,p=options,r=idx,o=out,s=samtoolscmd)
+    uf, utmp = unmapped_filter(out, unmapped)
+    cmd = '{c} -q -p {t} -S {p} {r} {f} | {s} view -F 0x04 {u} -bt - | {s} sort {so} -o {o}'\
+            .format(c=bowtiecmd,t=threads,f=filestr,p=options,r=idx,o=out,s=samtoolscmd,u=uf,
+                    so=sort_options(out, ref))
 
+    stats = None
+    if os.path.exists(out) and overwrite == False:
+        if trim_quality != None:
+            return stats
+        return remaining
     if verbose == True:
         print (cmd)
     try:
-        result = subprocess.check_output(cmd, shell=True, executable='/bin/bash',
-                                         stderr= subprocess.STDOUT)
-        if verbose == True:
-            print (result.decode())
+        if trim_quality != None:
+            stats = stream_trimmed_reads(cmd, file1, file2, trim_quality, threads)
+        else:
+            result = subprocess.check_output(cmd, shell=True, executable='/bin/bash',
+                                             stderr= subprocess.STDOUT)
+            if verbose == True:
+                print (result.decode())
     except subprocess.CalledProcessError as e:
         print (str(e.output))
+        #don't leave a partial alignment to be indexed or cached
+        if os.path.exists(out):
+            os.remove(out)
+        raise
+    write_unmapped(utmp, paired=file2!=None)
+    if trim_quality != None:
+        return stats
     return remaining
 
 def build_subread_index(fastafile):
@@ -151,18 +266,26 @@ def build_subread_index(fastafile):
     return
 
 def subread_align(file1, file2, idx, out, threads=2,
-                overwrite=False, verbose=True):
+                overwrite=False, verbose=True, unmapped=None, ref=None):
+    """Align reads with subread.
+    Args:
+        unmapped: folder for unmapped reads if required
+        ref: reference fasta, required for cram output
+    """
 
     os.environ["SUBREAD_INDEXES"] = SUBREAD_INDEXES
     idx = os.path.join(SUBREAD_INDEXES, idx)
     samtoolscmd = tools.get_cmd('samtools')
     subreadcmd = tools.get_cmd('subread-align')
     params = '-t 1 --SAMoutput -m 3 -M 2'
-    cmd = '{sc} {p} -T {t} -i {i} -r "{f1}" -R "{f2}" | {s} view -F 0x04 -bt - | {s} sort -o {o}'.format(
-            sc=subreadcmd,p=params,t=threads,i=idx,f1=file1,f2=file2,s=samtoolscmd,o=out)
+    uf, utmp = unmapped_filter(out, unmapped)
+    cmd = '{sc} {p} -T {t} -i {i} -r "{f1}" -R "{f2}" | {s} view -F 0x04 {u} -bt - | {s} sort {so} -o {o}'.format(
+            sc=subreadcmd,p=params,t=threads,i=idx,f1=file1,f2=file2,s=samtoolscmd,o=out,u=uf,
+            so=sort_options(out, ref))
     if not os.path.exists(out) or overwrite == True:
         print (cmd)
         result = subprocess.check_output(cmd, shell=True, stderr= subprocess.STDOUT)
+        write_unmapped(utmp, paired=file2!=None)
     return
 
 def minimap2_align(file, ref, out, threads=4, overwrite=False):
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+"""
+    Genome annotation loading and consequence calling of variants.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,pickle
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+from Bio.Seq import Seq
+from . import tools
+
+#consequence fields in the order of bcftools csq output
+csq_cols = ['snp_type','gene','locus_tag','feature_type','strand','aa','nuc']
+store_path = os.path.join(tools.config_path, 'annotation_cache')
+#annotations loaded in this process, keyed by file path, size and mod time
+_loaded = {}
+
+class Annotation(object):
+    """
+    Feature table of a genbank file with an interval index for overlap
+    queries. Nucleotide sequences are only extracted when asked for.
+    Use load_genbank to get one from the cache.
+    Args:
+        features: dataframe of features
+        sequences: dict of record id to sequence string
+    """
+    def __init__(self, features, sequences):
+        self.features = features
+        self.sequences = sequences
+        self.intervals = pd.IntervalIndex.from_arrays(features.start, features.end,
+                                                      closed='left')
+        return
+
+    def __repr__(self):
+        return 'Annotation %s features in %s records' %(len(self.features), len(self.sequences))
+
+    def overlaps(self, start, end, chrom=None, feat_type=None):
+        """
+        Features overlapping a region.
+        Args:
+            start, end: 0-based half open region
+            chrom: record id, all records if None
+            feat_type: only this feature type, e.g. CDS
+        """
+
+        df = self.features
+        m = self.intervals.overlaps(pd.Interval(start, end, closed='left'))
+        if chrom != None:
+            m &= (df.id == chrom).values
+        if feat_type != None:
+            m &= (df.feat_type == feat_type).values
+        return df[m]
+
+    def sequence(self, feature, protein=False):
+        """
+        Nucleotide sequence of a feature on its own strand.
+        Args:
+            feature: row of the features table or its index label
+            protein: return the translation instead
+        """
+
+        if not isinstance(feature, pd.Series):
+            feature = self.features.loc[feature]
+        seq = self.sequences[feature['id']][int(feature['start']):int(feature['end'])]
+        if feature['strand'] == -1:
+            seq = str(Seq(seq).reverse_complement())
+        if protein == True:
+            return str(Seq(seq).translate(table=11))
+        return seq
+
+    def to_dataframe(self, nucl_seq=False):
+        """Features table, optionally with the sequence of each feature"""
+
+        df = self.features.copy()
+        if nucl_seq == True:
+            df['sequence'] = [self.sequence(r) for i,r in df.iterrows()]
+        return df
+
+def parse_genbank(gb_file):
+    """Parse a genbank file into an Annotation, no caching"""
+
+    cols = ['id','start','end','strand','feat_type']
+    rows = []
+    sequences = {}
+    for rec in SeqIO.parse(gb_file, 'genbank'):
+        sequences[rec.id] = str(rec.seq)
+        for f in rec.features:
+            d = {k: v[0] if type(v) is list else v for k,v in f.qualifiers.items()}
+            d['id'] = rec.id
+            d['start'] = int(f.location.start)
+            d['end'] = int(f.location.end)
+            d['strand'] = f.location.strand if f.location.strand != None else 0
+            d['feat_type'] = f.type
+            rows.append(d)
+    df = pd.DataFrame(rows)
+    if len(df) == 0:
+        df = pd.DataFrame(columns=cols)
+    #features table columns first then qualifiers in order found
+    df = df[cols+[c for c in df.columns if c not in cols]]
+    df['start'] = df.start.astype(np.int64)
+    df['end'] = df.end.astype(np.int64)
+    df['strand'] = df.strand.astype(np.int8)
+    for c in ['id','feat_type']:
+        df[c] = df[c].astype('category')
+    if 'translation' in df.columns:
+        df['length'] = df.translation.str.len()
+    return Annotation(df, sequences)
+
+def load_genbank(gb_file, path=None):
+    """
+    Load the annotation of a genbank file, parsing it only once. The parsed
+    table is cached in memory and saved to a store keyed by the file checksum
+    so later sessions don't parse it again.
+    Args:
+        gb_file: genbank file
+        path: folder for the store, default is in the config folder
+    Returns:
+        an Annotation object
+    """
+
+    from . import cache
+    st = os.stat(gb_file)
+    key = (os.path.abspath(gb_file), st.st_size, st.st_mtime)
+    if key in _loaded:
+        return _loaded[key]
+    if path == None:
+        path = store_path
+    md5 = cache.md5sum(gb_file)
+    filename = os.path.join(path, md5+'.pickle')
+    A = None
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as f:
+                A = Annotation(*pickle.load(f))
+        except Exception as e:
+            print ('could not read cached annotation %s' %filename)
+    if A == None:
+        A = parse_genbank(gb_file)
+        os.makedirs(path, exist_ok=True)
+        tmp = filename+'.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((A.features, A.sequences), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    _loaded[key] = A
+    return A
+
+def base_codes(seq):
+    """Encode a sequence as A=0, C=1, G=2, T=3 and 4 for anything else"""
+
+    lookup = np.full(256, 4, dtype=np.uint8)
+    for i,b in enumerate('ACGT'):
+        lookup[ord(b)] = i
+        lookup[ord(b.lower())] = i
+    return lookup[np.frombuffer(str(seq).encode(), dtype=np.uint8)]
+
+def codon_table(table_id=11):
+    """
+    Translation table as an array of 65 amino acids indexed by codon code
+    16*b1+4*b2+b3, index 64 is used for codons with ambiguous bases.
+    Returns:
+        amino acid array and boolean array of start codons
+    """
+
+    from Bio.Data import CodonTable
+    t = CodonTable.unambiguous_dna_by_id[int(table_id)]
+    aa = np.full(65, 'X', dtype='<U1')
+    start = np.zeros(65, dtype=bool)
+    for i in range(64):
+        c = 'ACGT'[i//16]+'ACGT'[i//4%4]+'ACGT'[i%4]
+        if c in t.stop_codons:
+            aa[i] = '*'
+        else:
+            aa[i] = t.forward_table[c]
+        start[i] = c in t.start_codons
+    return aa, start
+
+class CodonIndex(object):
+    """
+    Lookup from every genome position to the coding sequences, codon numbers
+    and codon positions containing it, built once from a genbank file. Genes
+    are indexed by their spliced location so joins and the minus strand are
+    handled. Positions in overlapping genes have one entry per gene.
+    Args:
+        gb_file: genbank file with the genome sequence and CDS features
+    Usage:
+        C = CodonIndex('Mbovis_AF212297.gb')
+        C.annotate(['LT708304.1'], [3100000], ['C'], ['T'])
+    """
+    def __init__(self, gb_file):
+        self.gb_file = gb_file
+        self.chroms = {}
+        tags = []
+        genes = []
+        strands = []
+        tables = []
+        tpos = []
+        cds_offset = []
+        cds_len = []
+        n = 0
+        for rec in SeqIO.parse(gb_file, 'genbank'):
+            first = len(cds_offset)
+            for feat in rec.features:
+                if feat.type != 'CDS':
+                    continue
+                q = feat.qualifiers
+                if 'pseudo' in q:
+                    continue
+                tag = q.get('locus_tag', q.get('gene', ['cds%s' %len(tags)]))[0]
+                strand = feat.location.strand
+                #genome coordinates in transcript order
+                parts = []
+                for p in feat.location.parts:
+                    s, e = int(p.start), int(p.end)
+                    if strand == -1:
+                        parts.append(np.arange(e-1, s-1, -1, dtype=np.int32))
+                    else:
+                        parts.append(np.arange(s, e, dtype=np.int32))
+                x = np.concatenate(parts)
+                #codon_start is 1-based
+                shift = int(q.get('codon_start', ['1'])[0])-1
+                x = x[shift:]
+                tags.append(tag)
+                genes.append(q.get('gene', [tag])[0])
+                strands.append(-1 if strand == -1 else 1)
+                tables.append(int(q.get('transl_table', ['11'])[0]))
+                tpos.append(x)
+                cds_offset.append(n)
+                cds_len.append(len(x))
+                n += len(x)
+            last = len(cds_offset)
+            self.chroms[rec.id] = {'seq': base_codes(rec.seq), 'first': first, 'last': last,
+                                   'name': rec.name}
+        self.locus_tag = np.array(tags, dtype=object)
+        self.gene = np.array(genes, dtype=object)
+        self.strand = np.array(strands, dtype=np.int8)
+        self.cds_offset = np.array(cds_offset, dtype=np.int64)
+        self.cds_len = np.array(cds_len, dtype=np.int64)
+        self.tpos = np.concatenate(tpos) if len(tpos) > 0 else np.zeros(0, dtype=np.int32)
+        #translation tables used, as rows of a lookup array
+        ids = sorted(set(tables)) or [11]
+        t = [codon_table(i) for i in ids]
+        self.aa_table = np.array([i[0] for i in t])
+        self.start_table = np.array([i[1] for i in t])
+        self.table = np.array([ids.index(i) for i in tables], dtype=np.int8)
+        #each genome position points to a slice of (cds, transcript position) entries
+        cds = np.repeat(np.arange(len(cds_len)), cds_len)
+        tidx = np.arange(n) - np.repeat(self.cds_offset, cds_len)
+        for chrom, c in self.chroms.items():
+            m = (cds >= c['first']) & (cds < c['last'])
+            order = np.argsort(self.tpos[m], kind='stable')
+            gpos = self.tpos[m][order]
+            c['cds'] = cds[m][order].astype(np.int32)
+            c['tidx'] = tidx[m][order].astype(np.int32)
+            c['offsets'] = np.searchsorted(gpos, np.arange(len(c['seq'])+1)).astype(np.int64)
+        return
+
+    def __repr__(self):
+        return 'CodonIndex %s sequences, %s coding sequences' %(len(self.chroms), len(self.cds_len))
+
+    def _chrom(self, chrom):
+        if chrom in self.chroms:
+            return self.chroms[chrom]
+        for c in self.chroms.values():
+            if c['name'] == chrom:
+                return c
+        if len(self.chroms) == 1:
+            #assume a single sequence is the same as the reference
+            return list(self.chroms.values())[0]
+        return
+
+    def lookup(self, chrom, pos):
+        """
+        Coding sequences containing each position.
+        Args:
+            chrom: sequence name
+            pos: array of 1-based positions
+        Returns:
+            arrays of the index into pos, cds number and 0-based position in
+            the cds, with one entry per overlapping cds
+        """
+
+        c = self._chrom(chrom)
+        pos = np.asarray(pos, dtype=np.int64)
+        empty = np.zeros(0, dtype=np.int64)
+        if c == None or len(pos) == 0:
+            return empty, empty, empty
+        p = np.clip(pos-1, 0, len(c['seq'])-1)
+        inside = (pos >= 1) & (pos <= len(c['seq']))
+        lo = c['offsets'][p]
+        n = np.where(inside, c['offsets'][p+1]-lo, 0)
+        site = np.repeat(np.arange(len(pos)), n)
+        e = np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+        return site, c['cds'][e].astype(np.int64), c['tidx'][e].astype(np.int64)
+
+    def _codons(self, c, cds, codon):
+        """Codon base codes on the coding strand, shape (n, 3)"""
+
+        t = self.cds_offset[cds][:,None] + codon[:,None]*3 + np.arange(3)
+        #incomplete codons at the end of a gene
+        ok = codon*3+2 < self.cds_len[cds]
+        t = np.where(ok[:,None], t, 0)
+        b = c['seq'][self.tpos[t]] if len(t) > 0 else np.zeros((0,3), dtype=np.uint8)
+        b = np.where(ok[:,None], b, 4)
+        minus = self.strand[cds] == -1
+        b = np.where(minus[:,None] & (b < 4), 3-b, b)
+        return b.astype(np.int64)
+
+    def _translate(self, b, table):
+        code = b[:,0]*16+b[:,1]*4+b[:,2]
+        code = np.where((b > 3).any(1), 64, code)
+        return self.aa_table[table, code], self.start_table[table, code]
+
+    def annotate(self, chrom, pos, ref, alt):
+        """
+        Consequences of variants in a single vectorised pass. SNPs are given
+        bcftools csq style types (synonymous, missense, stop_gained, stop_lost,
+        stop_retained, start_lost) and indels are typed as frameshift or
+        inframe. Each variant is annotated on its own so adjacent changes in
+        the same codon are not combined.
+        Args:
+            chrom: sequence name or array of names for each variant
+            pos: 1-based positions
+            ref, alt: reference and alternate alleles
+        Returns:
+            dataframe with a row for each variant and overlapping gene, the site
+            column is the index of the variant in the inputs
+        """
+
+        pos = np.asarray(pos, dtype=np.int64)
+        ref = np.asarray(ref, dtype=object)
+        alt = np.asarray(alt, dtype=object)
+        if np.ndim(chrom) == 0:
+            chrom = np.full(len(pos), chrom, dtype=object)
+        chrom = np.asarray(chrom, dtype=object)
+        res = []
+        for name in pd.unique(chrom):
+            idx = np.where(chrom == name)[0]
+            site, cds, t = self.lookup(name, pos[idx])
+            if len(site) == 0:
+                continue
+            res.append(self._annotate(self._chrom(name), idx[site], cds, t,
+                                      pos, ref, alt, name))
+        if len(res) == 0:
+            return pd.DataFrame(columns=['site','chrom','start']+csq_cols)
+        df = pd.concat(res).sort_values(['site','locus_tag'], kind='stable')
+        return df.reset_index(drop=True)
+
+    def _annotate(self, c, site, cds, t, pos, ref, alt, chrom):
+        r = pd.Series(ref[site], dtype=object)
+        a = pd.Series(alt[site], dtype=object)
+        rlen = r.str.len().values
+        alen = a.str.len().values
+        codon = t//3
+        table = self.table[cds]
+        minus = self.strand[cds] == -1
+        refb = self._codons(c, cds, codon)
+        ref_aa, ref_start = self._translate(refb, table)
+        #substitute the alt base on the coding strand
+        altb = refb.copy()
+        snp = (rlen == 1) & (alen == 1)
+        code = base_codes(''.join(np.where(snp, a.values, 'N')))
+        code = np.where(minus & (code < 4), 3-code, code)
+        altb[np.arange(len(t)), t%3] = code
+        alt_aa, alt_start = self._translate(altb, table)
+
+        snp_type = np.full(len(t), 'missense', dtype=object)
+        snp_type[ref_aa == alt_aa] = 'synonymous'
+        snp_type[(ref_aa == alt_aa) & (ref_aa == '*')] = 'stop_retained'
+        snp_type[(alt_aa == '*') & (ref_aa != '*')] = 'stop_gained'
+        snp_type[(ref_aa == '*') & (alt_aa != '*')] = 'stop_lost'
+        snp_type[(codon == 0) & ref_start & ~alt_start] = 'start_lost'
+        diff = alen-rlen
+        snp_type[~snp & (diff%3 != 0)] = 'frameshift'
+        snp_type[~snp & (diff%3 == 0) & (diff > 0)] = 'inframe_insertion'
+        snp_type[~snp & (diff%3 == 0) & (diff < 0)] = 'inframe_deletion'
+        snp_type[~snp & (diff == 0)] = 'missense'
+
+        num = pd.Series(codon+1).astype(str)
+        aa = num + ref_aa
+        change = snp & (ref_aa != alt_aa)
+        aa[change] = aa[change] + '>' + num[change] + alt_aa[change]
+        nuc = pd.Series(pos[site]).astype(str) + r + '>' + a
+        return pd.DataFrame({'site': site, 'chrom': chrom, 'start': pos[site],
+                             'snp_type': snp_type, 'gene': self.gene[cds],
+                             'locus_tag': self.locus_tag[cds],
+                             'feature_type': 'protein_coding',
+                             'strand': np.where(minus, '-', '+'),
+                             'aa': aa.values, 'nuc': nuc.values})
+
+def csq_from_vcf(vcf_file, index, csqout=None):
+    """
+    Consequence calls for each sample in a multi sample vcf, the in process
+    equivalent of bcftools csq. Distinct alleles are annotated once and the
+    results are joined to the samples carrying them.
+    Args:
+        vcf_file: vcf with samples
+        index: a CodonIndex or genbank file
+        csqout: optionally write a table in the bcftools csq -Ot format
+    Returns:
+        dataframe in the format returned by app.read_csq_file
+    """
+
+    if not isinstance(index, CodonIndex):
+        index = CodonIndex(index)
+    cols = ['1','sample','2','chrom','start']
+    v = tools.read_vcf_arrays(vcf_file, fields=['GT'])
+    ns = len(v['samples'])
+    nsites = len(v['POS'])
+    empty = pd.DataFrame(columns=cols+csq_cols)
+    if nsites == 0 or ns == 0:
+        return empty
+    gtb = tools.get_genotype_bases(v['REF'], v['ALT'], v['GT'])
+    site, j = np.where((gtb != None) & (gtb != v['REF'][:,None]))
+    if len(site) == 0:
+        return empty
+    allele = gtb[site, j]
+    #annotate each distinct site and allele once
+    key = pd.Series(site).astype(str) + ':' + pd.Series(allele, dtype=object)
+    codes, uniq = pd.factorize(key)
+    first = np.zeros(len(uniq), dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    s = site[first]
+    a = index.annotate(v['CHROM'][s], v['POS'][s], v['REF'][s], allele[first])
+    #join back to samples
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(uniq))
+    starts = np.cumsum(counts)-counts
+    n = counts[a.site.values]
+    rows = np.repeat(a.index.values, n)
+    k = np.repeat(starts[a.site.values], n) + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+    samples = np.array(v['samples'], dtype=object)[j[order[k]]]
+    df = a.loc[rows, ['chrom','start']+csq_cols].reset_index(drop=True)
+    df.insert(0, 'sample', samples)
+    df.insert(0, '1', 'CSQ')
+    df.insert(2, '2', 1)
+    df = df.sort_values(['start','sample'], kind='stable').reset_index(drop=True)
+    if csqout != None:
+        x = df[cols].copy()
+        csq = df[csq_cols[0]].astype(str)
+        for c in csq_cols[1:]:
+            csq = csq + '|' + df[c].astype(str)
+        x['csq'] = csq
+        x.to_csv(csqout, sep='\t', header=False, index=False)
+    for c in ['1','sample','chrom','snp_type','gene','locus_tag','strand','feature_type']:
+        df[c] = df[c].astype('category')
+    return df
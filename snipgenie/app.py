@@ -32,7 +32,7 @@ from Bio.Seq import Seq
 from Bio import SeqIO, AlignIO
 from Bio.SeqFeature import SeqFeature, FeatureLocation
 #from Bio.Alphabet import generic_dna
-from . import tools, aligners, trees
+from . import tools, aligners, trees, results
 import multiprocessing as mp
 
 tempdir = tempfile.gettempdir()
@@ -71,12 +71,13 @@ if not os.path.exists(config_path):
         os.makedirs(config_path)
 
 defaults = {'threads':None, 'labelsep':'_','trim':False, 'unmapped':False,
-            'quality':25,
+            'quality':25, 'keep_trimmed':False, 'depth':None, 'cram':False,
+            'cache':None, 'cache_size':None, 'text_outputs':True, 'csq_method':'native',
             'aligner': 'bwa', 'species': None,
             'filters': default_filter, 'custom_filters': False, 'mask': None,
             'reference': None, 'gb_file': None, 'overwrite':False,
-            'omit_samples': [],
-            'buildtree':False, 'bootstraps':100}
+            'omit_samples': [], 'include': None, 'db': None,
+            'buildtree':False, 'treemethod':'raxml', 'bootstraps':100}
 
 def check_platform():
     """See if we are running in Windows"""
@@ -173,7 +174,10 @@ def check_samples_unique(samples):
         return False
 
 def results_summary(df):
-    return df.groupby('sample').first()[['name','bam_file','read_length']].reset_index()
+
+    cols = ['name','bam_file','read_length','perc_mapped','mean_depth','breadth_1x']
+    cols = [c for c in cols if c in df.columns]
+    return df.groupby('sample').first()[cols].reset_index()
 
 def write_samples(df, path):
     """Write out sample names using dataframe from get_samples"""
@@ -185,22 +189,29 @@ def write_samples(df, path):
 def check_samples_aligned(samples, outdir):
     """Check how many samples already aligned"""
 
-    found = glob.glob(os.path.join(outdir,'*.bam'))
+    found = glob.glob(os.path.join(outdir,'*.bam')) + glob.glob(os.path.join(outdir,'*.cram'))
     x = samples.groupby('sample')
     print ('%s/%s samples already aligned' %(len(found),len(x)))
     return
 
 def align_reads(samples, idx, outdir='mapped', callback=None, aligner='bwa',
-                unmapped=None, **kwargs):
+                unmapped=None, trim=False, quality=25, cram=False, cache=None, **kwargs):
     """
     Align multiple files. Requires a dataframe with a 'sample' column to indicate
-    paired files grouping. If a trimmed column is present these files will align_reads
-    instead of the raw ones.
+    paired files grouping. If a downsampled or trimmed column is present these
+    files will be aligned instead of the raw ones.
     Args:
         samples: dataframe with sample names
         idx: bwa index name
         outdir: output folder
         unmapped_dir: folder for unmapped files if required
+        trim: quality trim reads before aligning without keeping trimmed files.
+        For bwa and bowtie the trimmed reads are streamed to the aligner
+        quality: right trim quality
+        cram: write reference compressed cram files instead of bam, existing
+        bam files are converted
+        cache: an AlignmentCache, alignments of the same reads are linked from
+        the cache instead of being re-run. Not used when unmapped reads are saved
     """
 
     if not os.path.exists(outdir):
@@ -210,11 +221,16 @@ def align_reads(samples, idx, outdir='mapped', callback=None, aligner='bwa',
 
     new = []
     samtoolscmd = tools.get_cmd('samtools')
+    ref = idx
+    ref_length = tools.get_fasta_length(ref)
+    saved = 0
     for name,df in samples.groupby('sample'):
         #print (name)
         if callback != None:
             callback('aligning %s' %name)
-        if 'trimmed' in df.columns:
+        if 'downsampled' in df.columns:
+            files = list(df.downsampled)
+        elif 'trimmed' in df.columns:
             files = list(df.trimmed)
             if callback != None:
                 callback('using trimmed')
@@ -224,36 +240,107 @@ def align_reads(samples, idx, outdir='mapped', callback=None, aligner='bwa',
             #unpaired reads
             files.append(None)
         out = os.path.join(outdir,name+'.bam')
+        if cram == True:
+            bam = out
+            out = os.path.join(outdir,name+'.cram')
+            if os.path.exists(bam) and not os.path.exists(out):
+                saved += bam_to_cram(bam, out, ref, threads=kwargs['threads'])
+        key = None
+        #the unmapped reads are not cached so these samples are always aligned
+        if cache != None and unmapped == None:
+            key = cache.key(files, ref, aligner, trim=trim, quality=quality, cram=cram,
+                            options=kwargs.get('options'))
+            if kwargs['overwrite'] == True:
+                #don't write through links into the cache
+                for f in [out, out+'.bai', out+'.crai']:
+                    if os.path.lexists(f):
+                        os.remove(f)
+            elif not os.path.exists(out) and cache.get(key, out) == True:
+                key = None
         #if unmapped != None:
         #    un = os.path.join(unmapped,name+'.bam')
         #else:
         #    un = None
+        stats = None
+        trim_quality = None
+        tmpdir = None
+        if trim == True and (not os.path.exists(out) or kwargs['overwrite'] == True):
+            if aligner in ['bwa','bowtie']:
+                trim_quality = quality
+            else:
+                #aligner can't read from stdin so trim to temp files
+                tmpdir = tempfile.mkdtemp(dir=outdir)
+                stats = {'reads':0, 'bases':0, 'trimmed_bases':0}
+                for i in range(len(files)):
+                    if files[i] == None:
+                        continue
+                    tf = os.path.join(tmpdir, os.path.basename(files[i]))
+                    s = tools.trim_reads_default(files[i], tf, quality, threads=kwargs['threads'])
+                    stats['reads'] += s['reads']
+                    stats['bases'] += s['bases']
+                    stats['trimmed_bases'] += s['trimmed_bases']
+                    files[i] = tf
         if aligner == 'bwa':
-            aligners.bwa_align(files[0],files[1], idx=idx, out=out, unmapped=unmapped, **kwargs)
+            stats = aligners.bwa_align(files[0],files[1], idx=idx, out=out, unmapped=unmapped,
+                                       trim_quality=trim_quality, **kwargs)
         elif aligner == 'bowtie':
             idx = os.path.splitext(os.path.basename(idx))[0]
-            aligners.bowtie_align(files[0],files[1], idx=idx, out=out, **kwargs)
+            s = aligners.bowtie_align(files[0],files[1], idx=idx, out=out, unmapped=unmapped,
+                                      trim_quality=trim_quality, ref=ref, **kwargs)
+            if trim_quality != None:
+                stats = s
         elif aligner == 'subread':
             idx = os.path.splitext(os.path.basename(idx))[0]
-            aligners.subread_align(files[0],files[1], idx=idx, out=out, **kwargs)
-        bamidx = out+'.bai'
+            aligners.subread_align(files[0],files[1], idx=idx, out=out, unmapped=unmapped,
+                                   ref=ref, **kwargs)
+        if tmpdir != None:
+            shutil.rmtree(tmpdir)
+        if stats != None and stats['bases'] > 0:
+            samples.loc[df.index,'trimmed_perc'] = round(stats['trimmed_bases']/stats['bases']*100,2)
+        if cram == True:
+            bamidx = out+'.crai'
+        else:
+            bamidx = out+'.bai'
         if not os.path.exists(bamidx) or kwargs['overwrite']==True:
             cmd = '{s} index {o}'.format(o=out,s=samtoolscmd)
             subprocess.check_output(cmd,shell=True)
             print (cmd)
+        if key != None:
+            cache.put(key, out)
         index = df.index
         samples.loc[index,'bam_file'] = os.path.abspath(out)
-        #find mean depth
-        #depth = tools.get_bam_depth(out)
-        #samples.loc[index,'depth'] = depth
-        #get mapping info and add to samples samples table
-        #stat = tools.samtools_flagstats(out)
-        #perc = stat['mapped']/stat['total']*100
-        #samples.loc[index,'perc_mapped'] = perc
+        #get mapping info and depth in one pass and add to samples table
+        #bowtie and subread bams have no unmapped reads so the total read
+        #count is taken from trimming if it was done
+        total = None
+        if stats != None and 'reads' in stats:
+            total = stats['reads']
+        mstats = tools.samtools_stats(out, ref_length, threads=kwargs['threads'], ref=ref,
+                                      total=total, filtered=aligner in ['bowtie','subread'])
+        for k in mstats:
+            samples.loc[index,k] = mstats[k]
         if callback != None:
             callback(out)
+    if saved > 0:
+        print ('converted bam files to cram, saved %s MB' %round(saved/1e6,1))
     return samples
 
+def bam_to_cram(bam_file, out, ref, threads=4):
+    """Convert a bam file to reference compressed cram and remove the bam.
+    Returns:
+        bytes saved
+    """
+
+    samtoolscmd = tools.get_cmd('samtools')
+    cmd = '{s} view -@ {t} -C -T {r} -o {o} {b}'.format(s=samtoolscmd,t=threads,r=ref,o=out,b=bam_file)
+    print (cmd)
+    subprocess.check_output(cmd, shell=True)
+    saved = os.path.getsize(bam_file) - os.path.getsize(out)
+    for f in [bam_file, bam_file+'.bai', bam_file+'.stats']:
+        if os.path.exists(f):
+            os.remove(f)
+    return saved
+
 def mpileup_region(region,out,bam_files,callback=None):
     """Run bcftools for single region."""
 
@@ -355,9 +442,16 @@ def mpileup_gnuparallel(bam_files, ref, outpath, threads=4, callback=None, tempd
 
 def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
                     callback=None, overwrite=False, filters=None, gff_file=None,
-                    mask=None, tempdir='/tmp',
-                    custom_filters=False, **kwargs):
-    """Call variants with bcftools"""
+                    gb_file=None, csq_method='native', mask=None, tempdir='/tmp',
+                    custom_filters=False, text_outputs=True, **kwargs):
+    """Call variants with bcftools.
+    Args:
+        gff_file: gff annotation for bcftools csq
+        gb_file: genbank annotation, used for consequence calling with the
+        native method or converted to gff for bcftools
+        csq_method: 'native' to annotate in process from a genbank file or
+        'bcftools' to use bcftools csq
+    """
 
     st = time.time()
     if filters == None:
@@ -375,12 +469,13 @@ def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
         else:
             rawbcf = mpileup_gnuparallel(bam_files, ref, outpath, threads=threads,
                                         tempdir=tempdir, callback=callback)
+        index_vcf(rawbcf)
     else:
         print ('%s already exists' %rawbcf)
     #find snps only
     print ('calling variants..')
-    vcfout = os.path.join(outpath,'calls.vcf')
-    cmd = '{bc} call --ploidy 1 -m -v -o {o} {raw}'.format(bc=bcftoolscmd,o=vcfout,raw=rawbcf)
+    vcfout = os.path.join(outpath,'calls.vcf.gz')
+    cmd = '{bc} call --ploidy 1 -m -v -O z -o {o} {raw}'.format(bc=bcftoolscmd,o=vcfout,raw=rawbcf)
     if callback != None:
         callback(cmd)
     print (cmd)
@@ -391,12 +486,14 @@ def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
         sample_file = os.path.join(outpath,'samples.txt')
         print (sample_file)
         relabel_vcfheader(vcfout, sample_file)
+    index_vcf(vcfout)
 
     #filters
     filtered = os.path.join(outpath,'filtered.vcf.gz')
     cmd = '{bc} filter -i "{f}" -o {o} -O z {i}'.format(bc=bcftoolscmd,i=vcfout,o=filtered,f=filters)
     print (cmd)
     tmp = subprocess.check_output(cmd,shell=True)
+    index_vcf(filtered)
     if callback != None:
         callback(cmd)
 
@@ -406,6 +503,7 @@ def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
     cmd = '{bc} view -v snps -o {o} -O z {i}'.format(bc=bcftoolscmd,o=snpsout,i=filtered)
     print (cmd)
     subprocess.check_output(cmd,shell=True)
+    index_vcf(snpsout)
 
     #also get indels only to separate file
     indelsout = os.path.join(outpath,'indels.vcf.gz')
@@ -413,6 +511,7 @@ def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
     cmd = '{bc} view -v indels -o {o} -O z {i}'.format(bc=bcftoolscmd,o=indelsout,i=filtered)
     print (cmd)
     subprocess.check_output(cmd,shell=True)
+    index_vcf(indelsout)
 
     #apply mask if required
     if mask != None:
@@ -423,29 +522,80 @@ def variant_calling(bam_files, ref, outpath, relabel=True, threads=4,
         site_proximity_filter(snpsout, outdir=outpath)
 
     #consequence calling
-    if gff_file != None:
+    jobs = [(snpsout, 'csq.tsv', 'csq.matrix'), (indelsout, 'csq_indels.tsv', 'csq_indels.matrix')]
+    if gb_file != None and gff_file == None and csq_method != 'native':
+        gff_file = os.path.join(outpath, os.path.basename(gb_file)+'.gff')
+        tools.gff_bcftools_format(gb_file, gff_file)
+    if csq_method == 'native' and gb_file != None:
+        print ('consequence calling..')
+        from . import annotation
+        index = annotation.CodonIndex(gb_file)
+        for v,c,o in jobs:
+            csqdf = annotation.csq_from_vcf(v, index, os.path.join(outpath, c))
+            m = get_aa_snp_matrix(csqdf)
+            results.save_table(m, os.path.join(outpath,o), text=text_outputs)
+    #snps and indels are run at the same time with bcftools
+    elif gff_file != None:
         print ('consequence calling..')
-        csqout = os.path.join(outpath, 'csq.tsv')
-        m = csq_call(ref, gff_file, snpsout, csqout)
-        m.to_csv(os.path.join(outpath,'csq.matrix'))
-        #indels as well
-        csqout = os.path.join(outpath, 'csq_indels.tsv')
-        m = csq_call(ref, gff_file, indelsout, csqout)
-        m.to_csv(os.path.join(outpath,'csq_indels.matrix'))
+        from concurrent.futures import ThreadPoolExecutor
+        shards = max(1, threads//2)
+        with ThreadPoolExecutor(2) as ex:
+            futures = [ex.submit(csq_call, ref, gff_file, v, os.path.join(outpath, c), shards)
+                       for v,c,o in jobs]
+            for (v,c,o),f in zip(jobs, futures):
+                results.save_table(f.result(), os.path.join(outpath,o), text=text_outputs)
 
     print ('took %s seconds' %str(round(time.time()-st,0)))
     return snpsout
 
-def csq_call(ref, gff_file, vcf_file, csqout):
-    """Consequence calling"""
+def index_vcf(vcf_file):
+    """Index a bgzipped vcf or bcf file, overwrites any existing index"""
 
     bcftoolscmd = tools.get_cmd('bcftools')
-    cmd = '{bc} csq -f {r} -g {g} {f} -Ot -o {o}'.format(bc=bcftoolscmd,r=ref,g=gff_file,
-                f=vcf_file,o=csqout)
+    cmd = '{bc} index -f {v}'.format(bc=bcftoolscmd,v=vcf_file)
     print (cmd)
-    #if callback != None:
-    #    callback(cmd)
-    tmp = subprocess.check_output(cmd,shell=True)
+    subprocess.check_output(cmd,shell=True)
+    return
+
+def csq_call(ref, gff_file, vcf_file, csqout, threads=1):
+    """Consequence calling.
+    Args:
+        threads: if more than one the genome is split into this many regions
+        which are run in parallel, needs an indexed vcf
+    """
+
+    bcftoolscmd = tools.get_cmd('bcftools')
+    if threads > 1 and os.path.exists(vcf_file+'.csi'):
+        from concurrent.futures import ThreadPoolExecutor
+        chr = tools.get_chrom(ref)
+        length = tools.get_fasta_length(ref)
+        x = np.linspace(1,length+1,threads+1,dtype=int)
+        cmds = []
+        outfiles = []
+        for i in range(threads):
+            out = csqout+'.%s' %i
+            cmds.append('{bc} csq -r "{c}":{s}-{e} -f {r} -g {g} {f} -Ot -o {o}'.format(
+                        bc=bcftoolscmd,c=chr,s=x[i],e=x[i+1]-1,r=ref,g=gff_file,f=vcf_file,o=out))
+            outfiles.append(out)
+        print (cmds[0])
+        with ThreadPoolExecutor(threads) as ex:
+            list(ex.map(lambda c: subprocess.check_output(c,shell=True), cmds))
+        #join shards, records overlapping two regions are output twice
+        seen = set()
+        with open(csqout,'w') as out:
+            for f in outfiles:
+                for line in open(f):
+                    if line.startswith('#'):
+                        continue
+                    if line not in seen:
+                        seen.add(line)
+                        out.write(line)
+                os.remove(f)
+    else:
+        cmd = '{bc} csq -f {r} -g {g} {f} -Ot -o {o}'.format(bc=bcftoolscmd,r=ref,g=gff_file,
+                    f=vcf_file,o=csqout)
+        print (cmd)
+        tmp = subprocess.check_output(cmd,shell=True)
     csqdf = read_csq_file(csqout)
     #get presence/absence matrix of csq mutations
     m = get_aa_snp_matrix(csqdf)
@@ -455,7 +605,7 @@ def relabel_vcfheader(vcf_file, sample_file):
     """Re-label samples in vcf header"""
 
     bcftoolscmd = tools.get_cmd('bcftools')
-    rlout = os.path.join(tempdir,'calls.vcf')
+    rlout = os.path.join(tempdir,os.path.basename(vcf_file))
     cmd = '{bc} reheader --samples {s} -o {o} {v}'.format(bc=bcftoolscmd,o=rlout,
                                                 v=vcf_file,s=sample_file)
     print(cmd)
@@ -503,6 +653,7 @@ def mask_filter(vcf_file, mask_file):
     bcftoolscmd = tools.get_cmd('bcftools')
     cmd = 'bcftools view {o} -O z -o {gz}'.format(o=out,gz=vcf_file)
     tmp = subprocess.check_output(cmd,shell=True)
+    index_vcf(vcf_file)
     return
 
 def site_proximity_filter(vcf_file, dist=10, outdir=None):
@@ -534,13 +685,14 @@ def site_proximity_filter(vcf_file, dist=10, outdir=None):
     bcftoolscmd = tools.get_cmd('bcftools')
     cmd = 'bcftools view {o} -O z -o {gz}'.format(o=out,gz=vcf_file)
     tmp = subprocess.check_output(cmd,shell=True)
+    index_vcf(vcf_file)
     return
 
 def trim_files(df, outpath, overwrite=False, threads=4, quality=30):
     """Batch trim fastq files"""
 
     method = 'cutadapt'
-    if platform.system() == 'Windows':
+    if platform.system() == 'Windows' or shutil.which('cutadapt') == None:
         method = 'default'
     if not os.path.exists(outpath):
         os.makedirs(outpath, exist_ok=True)
@@ -552,23 +704,99 @@ def trim_files(df, outpath, overwrite=False, threads=4, quality=30):
         df.loc[i,'trimmed'] = outfile
     return df
 
-def read_csq_file(filename):
-    """Read csq tsv outpt file into dataframe"""
+def downsample_files(df, outpath, ref, depth=60, overwrite=False, threads=4):
+    """
+    Batch downsample fastq files to a target depth before alignment. Adds
+    the est_depth, sample_fraction and downsampled file columns to the
+    samples table. Samples already below the target depth are not copied.
+    Each sample is sampled with a seed made from its name so the same reads
+    are kept when it is run again.
+    """
+
+    import json, hashlib
+    if not os.path.exists(outpath):
+        os.makedirs(outpath, exist_ok=True)
+    length = tools.get_fasta_length(ref)
+    for name,g in df.groupby('sample'):
+        if 'trimmed' in g.columns:
+            files = list(g.trimmed)
+        else:
+            files = list(g.filename)
+        #outputs are always gzipped
+        outfiles = [os.path.join(outpath, os.path.basename(f)) for f in files]
+        outfiles = [f if f.endswith('.gz') else f+'.gz' for f in outfiles]
+        statsfile = os.path.join(outpath, name+'.json')
+        s = None
+        if os.path.exists(statsfile) and overwrite == False:
+            s = json.load(open(statsfile))
+            #the reads must be sampled again if the files were removed
+            if s['fraction'] < 1 and not all(os.path.exists(f) for f in outfiles):
+                s = None
+        if s == None:
+            #fixed seed per sample so reruns keep the same reads
+            seed = int(hashlib.md5(str(name).encode()).hexdigest()[:8], 16)
+            if len(files) == 1:
+                s = tools.downsample_reads(files[0], None, outfiles[0], None, length, depth,
+                                           seed=seed, threads=threads)
+            else:
+                s = tools.downsample_reads(files[0], files[1], outfiles[0], outfiles[1], length,
+                                           depth, seed=seed, threads=threads)
+            s['seed'] = seed
+            json.dump(s, open(statsfile,'w'))
+            print ('%s: estimated depth %s, kept %s of reads' %(name,s['depth'],s['fraction']))
+        if s['fraction'] == 1:
+            outfiles = files
+        df.loc[g.index,'est_depth'] = s['depth']
+        df.loc[g.index,'sample_fraction'] = s['fraction']
+        for i,f in zip(g.index, outfiles):
+            df.loc[i,'downsampled'] = f
+    return df
+
+def split_csq(values):
+    """
+    Split bcftools csq consequence strings (as in -Ot output or the BCSQ
+    tag) into columns using the C parser. Fields are in the bcftools order
+    consequence|gene|transcript|biotype|strand|amino_acid_change|dna_change.
+    """
+
+    from io import StringIO
+    import csv
+    cols = ['snp_type','gene','locus_tag','feature_type','strand','aa','nuc']
+    values = pd.Series(values, dtype=object).fillna('')
+    x = pd.read_csv(StringIO('\n'.join(values)+'\n'), sep='|', names=cols, usecols=range(7),
+                    header=None, dtype=str, quoting=csv.QUOTE_NONE, skip_blank_lines=False,
+                    keep_default_na=False, na_values=[''])
+    return x
 
-    cols = ['1','sample','2','chrom','start','snp_type','gene','locus_tag','strand','feature_type','aa','nuc',]
-    csqdf = pd.read_csv(filename,sep='[|\t]',comment='#',names=cols, engine='python')
-    csqdf['aa'] = csqdf.aa.fillna(csqdf.snp_type)
-    csqdf['nuc'] = csqdf.nuc.fillna(csqdf.snp_type)
+def read_csq_file(filename, chunksize=500000):
+    """Read csq tsv output file into dataframe, read in chunks"""
+
+    cols = ['1','sample','2','chrom','start']
+    chunks = []
+    reader = pd.read_csv(filename, sep='\t', comment='#', header=None, names=cols+['csq'],
+                         dtype={'sample':str,'chrom':str,'start':np.int64},
+                         chunksize=chunksize)
+    for df in reader:
+        x = split_csq(df.csq.values)
+        x.index = df.index
+        df = pd.concat([df[cols], x], axis=1)
+        df['aa'] = df.aa.fillna(df.snp_type)
+        df['nuc'] = df.nuc.fillna(df.snp_type)
+        chunks.append(df)
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=cols+['snp_type','gene','locus_tag','feature_type',
+                                          'strand','aa','nuc'])
+    csqdf = pd.concat(chunks)
+    for c in ['1','sample','chrom','snp_type','gene','locus_tag','strand','feature_type']:
+        csqdf[c] = csqdf[c].astype('category')
     return csqdf
 
 def get_aa_snp_matrix(df):
-    """Get presence/absence matrix from csq calls table"""
+    """Get presence/absence matrix from csq calls table.
+    Returns: a tools.SparseMatrix, use to_dense() for a dataframe"""
 
     df = df.drop_duplicates(['gene','aa','sample'])
-    x = df.set_index(['start','gene','aa','snp_type','sample'])['nuc'].unstack('sample')
-    x[x.notna()] = 1
-    x = x.fillna(0)
-    return x
+    return tools.SparseMatrix.from_pairs(df[['start','gene','aa','snp_type']], df['sample'])
 
 def run_bamfiles(bam_files, ref, gff_file=None, outdir='.', threads=4, **kwargs):
     """
@@ -588,10 +816,10 @@ def run_bamfiles(bam_files, ref, gff_file=None, outdir='.', threads=4, **kwargs)
     snprecs, smat = tools.fasta_alignment_from_vcf(vcf_file)
     outfasta = os.path.join(outdir, 'core.fa')
     SeqIO.write(snprecs, outfasta, 'fasta')
-    smat.to_csv(os.path.join(outdir,'core.txt'), sep=' ')
+    results.save_table(smat, os.path.join(outdir,'core.txt'), sep=' ')
     aln = AlignIO.read(outfasta, 'fasta')
     snp_dist = tools.snp_dist_matrix(aln)
-    snp_dist.to_csv(os.path.join(outdir,'snpdist.csv'), sep=',')
+    results.save_table(snp_dist, os.path.join(outdir,'snpdist.csv'), matrix=True)
     treefile = trees.run_RAXML(outfasta, outpath=outdir)
     ls = len(smat)
     trees.convert_branch_lengths(treefile,os.path.join(outdir,'tree.newick'), ls)
@@ -649,6 +877,12 @@ class WorkFlow(object):
         print ()
         return
 
+    def get_params(self):
+        """Workflow options that can be saved"""
+
+        return {i: self.__dict__[i] for i in list(defaults)+['input','outdir']
+                if i in self.__dict__}
+
     def setup(self):
         """Setup main parameters"""
 
@@ -675,6 +909,10 @@ class WorkFlow(object):
         else:
             self.threads = int(self.threads)
         df = get_samples(self.filenames, sep=self.labelsep)
+        if self.include != None:
+            #only samples in a list, e.g. selected.txt from triage
+            names = [l.strip() for l in open(self.include) if l.strip() != '']
+            df = df[df['sample'].isin(names)]
         if len(df) == 0:
             print ('no samples provided. files should be fastq.gz type')
             return False
@@ -697,7 +935,7 @@ class WorkFlow(object):
             aligners.build_bowtie_index(self.reference)
         elif self.aligner == 'subread':
             aligners.build_subread_index(self.reference)
-        if self.gb_file != None:
+        if self.gb_file != None and self.csq_method == 'bcftools':
             #convert annotation to gff for consequence calling
             self.gff_file = os.path.join(self.outdir, os.path.basename(self.gb_file)+'.gff')
             tools.gff_bcftools_format(self.gb_file, self.gff_file)
@@ -722,13 +960,26 @@ class WorkFlow(object):
             print ('no samples found')
             return
 
-        if self.trim == True:
+        #trimmed files are only written out if they are to be kept,
+        #otherwise reads are trimmed during alignment with the built in
+        #trimmer rather than cutadapt, which uses a different algorithm
+        stream_trim = False
+        if self.trim == True and self.keep_trimmed == True:
             print ('trimming fastq files')
             print ('--------------------')
             trimmed_path = os.path.join(self.outdir, 'trimmed')
             samples = trim_files(samples, trimmed_path, self.overwrite,
                                   quality=self.quality, threads=self.threads)
             print ()
+        elif self.trim == True:
+            stream_trim = True
+        if self.depth != None:
+            print ('downsampling reads to %sx' %self.depth)
+            print ('-----------------------------')
+            ds_path = os.path.join(self.outdir, 'downsampled')
+            samples = downsample_files(samples, ds_path, self.reference, float(self.depth),
+                                        self.overwrite, threads=self.threads)
+            print ()
         print ('aligning files')
         print ('--------------')
         print ('Using reference genome: %s' %self.reference)
@@ -738,8 +989,17 @@ class WorkFlow(object):
         else:
             unmapped = None
         check_samples_aligned(samples, path)
+        if self.cache != None:
+            from . import cache
+            size = self.cache_size
+            if size != None:
+                size = float(size)*1e9
+            aln_cache = cache.AlignmentCache(self.cache, max_size=size)
+        else:
+            aln_cache = None
         samples = align_reads(samples, idx=self.reference, outdir=path,
-                        aligner=self.aligner, unmapped=unmapped,
+                        aligner=self.aligner, unmapped=unmapped, cache=aln_cache,
+                        trim=stream_trim, quality=self.quality, cram=self.cram,
                         threads=self.threads, overwrite=self.overwrite)
         print ()
         print ('calling variants')
@@ -748,11 +1008,14 @@ class WorkFlow(object):
         self.vcf_file = variant_calling(bam_files, self.reference, self.outdir,
                                         threads=self.threads,
                                         gff_file=self.gff_file,
+                                        gb_file=self.gb_file,
+                                        csq_method=self.csq_method,
                                         filters=self.filters,
                                         mask=self.mask,
                                         custom_filters=self.custom_filters,
                                         overwrite=self.overwrite,
-                                        tempdir=self.tempdir)
+                                        tempdir=self.tempdir,
+                                        text_outputs=self.text_outputs)
         print (self.vcf_file)
         print ()
         print ('making SNP matrix')
@@ -760,23 +1023,32 @@ class WorkFlow(object):
         snprecs, smat = tools.fasta_alignment_from_vcf(self.vcf_file, omit=self.omit_samples)
         outfasta = os.path.join(self.outdir, 'core.fa')
         SeqIO.write(snprecs, outfasta, 'fasta')
-        #write out sites matrix as txt file
-        smat.to_csv(os.path.join(self.outdir,'core.txt'), sep=' ')
+        #write out sites matrix, text files are optional
+        text = self.text_outputs
+        results.save_table(smat, os.path.join(self.outdir,'core.txt'), text=text, sep=' ')
         print ()
         #write out pairwise snp distances
         aln = AlignIO.read(outfasta, 'fasta')
         snp_dist = tools.snp_dist_matrix(aln)
-        snp_dist.to_csv(os.path.join(self.outdir,'snpdist.csv'), sep=',')
+        results.save_table(snp_dist, os.path.join(self.outdir,'snpdist.csv'), text=text,
+                           matrix=True)
 
         #save summary tables
-        samples.to_csv(os.path.join(self.outdir,'samples.csv'),index=False)
+        results.save_table(samples, os.path.join(self.outdir,'samples.csv'), text=text,
+                           index=False)
         summ = results_summary(samples)
-        summ.to_csv(os.path.join(self.outdir,'summary.csv'),index=False)
+        results.save_table(summ, os.path.join(self.outdir,'summary.csv'), text=text,
+                           index=False)
         self.summary = summ
         print ('Done. Sample summary:')
         print ('---------------------')
         print (summ)
         print ()
+        if self.db != None:
+            from . import database
+            D = database.Database(self.db)
+            D.ingest_results(self.outdir, params=self.get_params())
+            D.close()
 
         if self.buildtree == True:
             print ('building tree')
@@ -784,12 +1056,17 @@ class WorkFlow(object):
             if len(bam_files) <= 2:
                 print ('Cannot build tree, too few samples.')
                 return
-            treefile = trees.run_RAXML(outfasta, threads=self.threads,
-                        bootstraps=self.bootstraps, outpath=self.outdir)
-            if treefile == None:
-                return
-            ls = len(smat)
-            trees.convert_branch_lengths(treefile,os.path.join(self.outdir,'tree.newick'), ls)
+            if self.treemethod in ['nj','bionj'] and int(self.bootstraps) == 0:
+                trees.nj_tree(snp_dist, os.path.join(self.outdir,'tree.newick'),
+                              method=self.treemethod)
+            else:
+                #replicates are run in parallel, one process each
+                try:
+                    trees.bootstrap_tree(outfasta, self.outdir, self.treemethod,
+                                         int(self.bootstraps), threads=self.threads)
+                except subprocess.CalledProcessError as e:
+                    print ('Error building tree. Is RAxML installed?')
+                    return
         print ()
 
         #check unmapped reads
@@ -836,11 +1113,47 @@ def main():
     parser.add_argument("-w", "--overwrite", dest="overwrite", action="store_true", default=False,
                         help="overwrite intermediate files")
     parser.add_argument("-T", "--trim", dest="trim", action="store_true", default=False,
-                        help="whether to trim fastq files" )
+                        help="whether to trim fastq files, reads are cut after the last base at or above "
+                        "the quality by the built in trimmer as they are aligned, with -k cutadapt is used if installed" )
+    parser.add_argument("-k", "--keep_trimmed", dest="keep_trimmed", action="store_true", default=False,
+                        help="write trimmed fastq files to the output folder, otherwise "
+                        "reads are trimmed during alignment" )
     parser.add_argument("-U", "--unmapped", dest="unmapped", action="store_true", default=False,
                         help="whether to save unmapped reads" )
     parser.add_argument("-Q", "--quality", dest="quality", default=25,
                         help="right trim quality, default 25")
+    parser.add_argument("-D", "--depth", dest="depth", default=None,
+                        help="downsample reads to this estimated depth before alignment")
+    parser.add_argument("-C", "--cram", dest="cram", action="store_true", default=False,
+                        help="store alignments as reference compressed cram files" )
+    parser.add_argument("--cache", dest="cache", default=None,
+                        help="folder for a cache of alignments shared between projects")
+    parser.add_argument("--cache_size", dest="cache_size", default=None,
+                        help="maximum size of the alignment cache in GB")
+    parser.add_argument("--no_text", dest="text_outputs", action="store_false", default=True,
+                        help="don't write text copies of the result tables, binary files only")
+    parser.add_argument("--csq", dest="csq_method", default='native',
+                        help="consequence calling method, native or bcftools")
+    parser.add_argument("--include", dest="include", default=None,
+                        help="file with a list of samples to include, others are ignored", metavar="FILE")
+    parser.add_argument("--triage", dest="triage", action="store_true", default=False,
+                        help="find approximate snp distances and nearest known isolates "
+                        "from the reads without alignment, written to outdir/triage")
+    parser.add_argument("--known", dest="known", default=None,
+                        help="folder of split k-mer profiles of known isolates for triage, "
+                        "e.g. the triage/profiles folder of a previous run")
+    parser.add_argument("--triage_threshold", dest="triage_threshold", default=None,
+                        help="samples within this distance of a known isolate are selected")
+    parser.add_argument("--bam", action='append', dest="bam", default=[],
+                        help="type an aligned bam file at the clade snp sites only, without "
+                        "joint variant calling, can be repeated", metavar="FILE")
+    parser.add_argument("--panel_sites", dest="panel_sites", default=None,
+                        help="snp matrix (core.txt) whose sites are added to the --bam panel", metavar="FILE")
+    parser.add_argument("--nearest", dest="nearest", default=None,
+                        help="nearest isolate index used to find the closest isolates to --bam samples",
+                        metavar="FILE")
+    parser.add_argument("--db", dest="db", default=None,
+                        help="add the results to an isolate database, created if needed", metavar="FILE")
     parser.add_argument("-f", "--filters", dest="filters", default=default_filter,
                         help="variant calling post-filters" )
     parser.add_argument("-m", "--mask", dest="mask", default=None,
@@ -850,7 +1163,11 @@ def main():
     parser.add_argument("-a", "--aligner", dest="aligner", default='bwa',
                         help="aligner to use")
     parser.add_argument("-b", "--buildtree", dest="buildtree", action="store_true", default=False,
-                        help="whether to build a phylogenetic tree, requires RaXML" )
+                        help="whether to build a phylogenetic tree, requires RaXML unless --treemethod is nj or bionj" )
+    parser.add_argument("--treemethod", dest="treemethod", default='raxml',
+                        choices=['raxml','nj','bionj'],
+                        help="tree building method, nj and bionj are built from the snp distances. "
+                        "Bootstrap replicates are run in parallel, one raxmlHPC process each for raxml" )
     parser.add_argument("-N", "--bootstraps", dest="bootstraps", default=100,
                         help="number of bootstraps to build tree")
     parser.add_argument("-o", "--outdir", dest="outdir",
@@ -881,11 +1198,36 @@ def main():
         qcfile = 'qc_report.pdf'
         filenames = get_files_from_paths(args['input'])
         tools.pdf_qc_reports(filenames, qcfile)
+    elif len(args['bam']) > 0:
+        from . import panel
+        ref = args['reference']
+        if args['species'] != None:
+            ref = preset_genomes[args['species']]['sequence']
+        elif ref == None:
+            ref = mbovis_genome
+        outdir = args['outdir']
+        if outdir == None:
+            outdir = 'panel'
+        threads = args['threads']
+        if threads == None:
+            threads = 1
+        panel.run_panel(args['bam'], ref, outdir, core=args['panel_sites'],
+                        index=args['nearest'], threads=int(threads))
     elif args['outdir'] == None:
         print ('No input or output folders provided. These are required.')
         print ('Example:')
         print ('snipgenie -r <reference> -i <input folder with fastq.gz files> -o <output folder>')
         print ('Use -h for more help on options.')
+    elif args['triage'] == True:
+        from . import triage
+        filenames = get_files_from_paths(args['input'])
+        df = get_samples(filenames, sep=args['labelsep'])
+        threads = args['threads']
+        if threads == None:
+            threads = os.cpu_count()
+        triage.run_triage(df, os.path.join(args['outdir'], 'triage'), known=args['known'],
+                          threshold=args['triage_threshold'], threads=int(threads),
+                          overwrite=args['overwrite'])
     else:
         W = WorkFlow(**args)
         st = W.setup()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+    Shared content addressed store of aligned reads.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,shutil,time
+import json, hashlib
+
+home = os.path.expanduser("~")
+config_path = os.path.join(home,'.config','snipgenie')
+default_path = os.path.join(config_path, 'cache')
+index_ext = ['.bai','.crai']
+
+def link_file(src, dest, symlink=True):
+    """Hard link a file, falling back to a symlink across file systems
+    and a copy where neither is possible"""
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    if symlink == True:
+        try:
+            os.symlink(os.path.abspath(src), dest)
+            return
+        except OSError:
+            pass
+    shutil.copy(src, dest)
+    return
+
+def md5sum(filename, blocksize=2**22):
+    """md5 checksum of a file"""
+
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class AlignmentCache(object):
+    """
+    Store of aligned reads shared between projects. Entries are keyed by the
+    checksums of the input fastq files and reference together with the
+    aligner and any settings that change the alignment. Files are linked in
+    and out of the store so a hit costs no copying. The store is kept under
+    max_size bytes by removing the least recently used entries.
+    Args:
+        path: folder for the store
+        max_size: maximum size in bytes, unlimited if None
+        verify: check the checksum of cached files before use, otherwise only
+        the file size is checked
+    """
+    def __init__(self, path=None, max_size=None, verify=False):
+        if path == None:
+            path = default_path
+        self.path = path
+        self.max_size = max_size
+        self.verify = verify
+        self.objects = os.path.join(path, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.checksums_file = os.path.join(path, 'checksums.json')
+        if os.path.exists(self.checksums_file):
+            self.checksums = json.load(open(self.checksums_file))
+        else:
+            self.checksums = {}
+        return
+
+    def checksum(self, filename):
+        """Checksum of an input file, memoised by path, size and mod time
+        so large fastq files are only read once"""
+
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        c = self.checksums.get(filename)
+        if c != None and c[0] == st.st_size and c[1] == st.st_mtime:
+            return c[2]
+        md5 = md5sum(filename)
+        self.checksums[filename] = [st.st_size, st.st_mtime, md5]
+        tmp = self.checksums_file+'.tmp'
+        json.dump(self.checksums, open(tmp,'w'))
+        os.replace(tmp, self.checksums_file)
+        return md5
+
+    def key(self, files, ref, aligner, **options):
+        """
+        Get the store key for an alignment.
+        Args:
+            files: input fastq files
+            ref: reference fasta
+            aligner: aligner name
+            options: any other settings that change the output, e.g. trimming
+        """
+
+        d = {'files': [self.checksum(f) for f in files if f != None],
+             'ref': self.checksum(ref),
+             'aligner': aligner,
+             'options': options}
+        s = json.dumps(d, sort_keys=True, default=str)
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def _remove(self, key):
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+        return
+
+    def get(self, key, out):
+        """
+        Link a cached alignment and its index to out if present.
+        Returns:
+            True if found
+        """
+
+        entry = self._entry(key)
+        metafile = os.path.join(entry, 'meta.json')
+        if not os.path.exists(metafile):
+            return False
+        meta = json.load(open(metafile))
+        src = os.path.join(entry, meta['name'])
+        if not os.path.exists(src) or os.path.getsize(src) != meta['size'] or \
+            (self.verify == True and md5sum(src) != meta['md5']):
+            print ('cached alignment %s is corrupt, removing' %key)
+            self._remove(key)
+            return False
+        link_file(src, out)
+        for ext in index_ext:
+            if os.path.exists(src+ext):
+                link_file(src+ext, out+ext)
+        #record use for eviction
+        os.utime(metafile)
+        print ('using cached alignment for %s' %os.path.basename(out))
+        return True
+
+    def put(self, key, bam_file):
+        """Add an alignment and its index to the store"""
+
+        entry = self._entry(key)
+        metafile = os.path.join(entry, 'meta.json')
+        if os.path.exists(metafile):
+            os.utime(metafile)
+            return
+        tmp = entry+'.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        name = 'aln'+os.path.splitext(bam_file)[1]
+        #never symlink into the store as the project files may be removed
+        link_file(bam_file, os.path.join(tmp, name), symlink=False)
+        for ext in index_ext:
+            if os.path.exists(bam_file+ext):
+                link_file(bam_file+ext, os.path.join(tmp, name+ext), symlink=False)
+        meta = {'name': name, 'size': os.path.getsize(bam_file),
+                'md5': md5sum(bam_file), 'source': os.path.abspath(bam_file),
+                'created': time.time()}
+        json.dump(meta, open(os.path.join(tmp, 'meta.json'),'w'))
+        self._remove(key)
+        os.replace(tmp, entry)
+        self.evict()
+        return
+
+    def entries(self):
+        """Get list of (last used, size, key) for all entries"""
+
+        res = []
+        for d in os.listdir(self.objects):
+            for key in os.listdir(os.path.join(self.objects, d)):
+                if key.endswith('.tmp'):
+                    continue
+                entry = os.path.join(self.objects, d, key)
+                metafile = os.path.join(entry, 'meta.json')
+                if not os.path.exists(metafile):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+                            if f != 'meta.json')
+                res.append((os.path.getmtime(metafile), size, key))
+        return res
+
+    def size(self):
+        """Total size of the store in bytes"""
+
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the store is under max_size"""
+
+        if self.max_size == None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for used, size, key in entries:
+            if total <= self.max_size:
+                break
+            print ('removing cached alignment %s' %key)
+            self._remove(key)
+            total -= size
+        return
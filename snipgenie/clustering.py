@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+    Hierarchical snp threshold clustering of isolates.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,time
+import numpy as np
+import pandas as pd
+from . import nearest
+
+default_thresholds = [0,5,12,25,50]
+
+def unpack_bits(bits):
+    """Packed profile bitsets as a float32 matrix of 0/1 for matrix products"""
+
+    b = np.ascontiguousarray(bits.astype('<u8')).view(np.uint8)
+    return np.unpackbits(b, axis=1, bitorder='little').astype(np.float32)
+
+def pair_distances(a, b):
+    """Snp distances between two sets of unpacked profiles, the size of the
+    symmetric difference of their alleles"""
+
+    return a.sum(1)[:,None] + b.sum(1)[None,:] - 2 * (a @ b.T)
+
+def find_roots(parent, x):
+    """Root of each node in a union-find parent array, compressing paths"""
+
+    root = parent[x]
+    while True:
+        r = parent[root]
+        if (r == root).all():
+            break
+        root = r
+    parent[x] = root
+    return root
+
+def union(parent, u, v):
+    """Join the sets of each pair of nodes u and v. The smallest node of
+    each set is kept as its root so older clusters keep their ids."""
+
+    while len(u) > 0:
+        ru = find_roots(parent, u)
+        rv = find_roots(parent, v)
+        keep = ru != rv
+        ru, rv = ru[keep], rv[keep]
+        if len(ru) == 0:
+            break
+        lo = np.minimum(ru, rv)
+        hi = np.maximum(ru, rv)
+        #several pairs can hook the same root, the smallest target wins and
+        #the rest are joined in the next pass
+        np.minimum.at(parent, hi, lo)
+        u, v = lo, hi
+    return
+
+class SNPClusters(object):
+    """
+    Single linkage clustering of isolates at several snp thresholds, giving
+    each isolate a snp address of its cluster numbers from the largest
+    threshold down, e.g. 3.7.7.12.40 for 50.25.12.5.0 snps. New isolates
+    are added incrementally, only their distances to the stored isolates
+    are computed. Clusters joined by a new isolate take the oldest of their
+    numbers and the change is recorded in merges, so addresses are stable
+    otherwise. Distances are those of nearest.NearestIndex.
+    Usage:
+        C = SNPClusters.from_matrix(nucmat)
+        C.add(newmat)
+        C.table()
+        C.save('clusters.npz')
+    """
+    def __init__(self, thresholds=default_thresholds, block=2000):
+        self.thresholds = sorted(thresholds)
+        self.block = block
+        self.index = nearest.NearestIndex()
+        #cluster number of each isolate at each threshold
+        self.labels = np.zeros((0, len(self.thresholds)), dtype=np.int64)
+        self.next_id = np.ones(len(self.thresholds), dtype=np.int64)
+        self.merges = pd.DataFrame(columns=['threshold','old','new','update'])
+        self.updates = 0
+        return
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return 'SNPClusters %s isolates, thresholds %s' %(len(self), self.thresholds)
+
+    @classmethod
+    def from_matrix(cls, nucmat, thresholds=default_thresholds):
+        """Cluster the isolates in a snp matrix, see NearestIndex.from_matrix"""
+
+        C = cls(thresholds)
+        C.add(nucmat)
+        return C
+
+    def _edges(self, start):
+        """Yield blocks of distances of the isolates from start onwards to all
+        earlier isolates and each other"""
+
+        bits = self.index.bits
+        n = len(bits)
+        for i in range(start, n, self.block):
+            a = unpack_bits(bits[i:i+self.block])
+            for j in range(0, min(i+self.block, n), self.block):
+                b = unpack_bits(bits[j:j+self.block])
+                d = pair_distances(a, b)
+                ii, jj = np.nonzero(d <= self.thresholds[-1])
+                ii = ii + i
+                jj = jj + j
+                keep = jj < ii
+                yield ii[keep], jj[keep], d[ii[keep]-i, jj[keep]-j]
+
+    def add(self, nucmat):
+        """
+        Add isolates and update the clusters. Isolates already stored are
+        skipped.
+        Args:
+            nucmat: snp matrix in either orientation with the reference
+            alleles as a ref row or column, see NearestIndex.add
+        Returns:
+            table of the new isolates, see table
+        """
+
+        from . import snp_typing
+        names, positions, codes, ref = snp_typing.allele_matrix(nucmat)
+        if ref is None:
+            raise ValueError('snp matrix has no ref alleles')
+        names = [str(n) for n in names]
+        exists = np.isin(names, self.index.names)
+        if exists.all():
+            return self.table().iloc[0:0]
+        if exists.any():
+            print ('%s isolates already clustered' %exists.sum())
+            X = snp_typing.sample_matrix(nucmat)
+            nucmat = X[~exists]
+            if ref is not None:
+                nucmat.loc['ref'] = ref.values
+        start = len(self)
+        self.index.add(nucmat)
+        n = len(self)
+        m = n - start
+        self.updates += 1
+        nlevels = len(self.thresholds)
+        K = self.next_id.copy()
+        #nodes are existing cluster numbers then the new isolates
+        parents = [np.arange(K[l]+m) for l in range(nlevels)]
+
+        def node(idx, l):
+            res = K[l] + idx - start
+            old = idx < start
+            res[old] = self.labels[idx[old], l]
+            return res
+
+        for ii, jj, d in self._edges(start):
+            for l,t in enumerate(self.thresholds):
+                e = d <= t
+                union(parents[l], node(ii[e], l), node(jj[e], l))
+        new = np.zeros((m, nlevels), dtype=np.int64)
+        merges = []
+        for l,t in enumerate(self.thresholds):
+            p = parents[l]
+            roots = find_roots(p, np.arange(len(p)))
+            #clusters of only new isolates get new numbers
+            r = roots[K[l]:]
+            fresh = np.unique(r[r >= K[l]])
+            ids = roots.copy()
+            ids[fresh] = self.next_id[l] + np.arange(len(fresh))
+            self.next_id[l] += len(fresh)
+            new[:,l] = ids[r]
+            if start > 0:
+                old = self.labels[:start, l]
+                changed = np.unique(old[ids[old] != old])
+                for c in changed:
+                    merges.append((t, c, ids[c], self.updates))
+                self.labels[:start, l] = ids[old]
+        self.labels = np.concatenate([self.labels, new])
+        if len(merges) > 0:
+            x = pd.DataFrame(merges, columns=['threshold','old','new','update'])
+            self.merges = pd.concat([self.merges, x], ignore_index=True) if len(self.merges) > 0 else x
+        return self.table().iloc[start:]
+
+    def table(self):
+        """Cluster numbers and snp address of every isolate"""
+
+        cols = ['t%s' %t for t in self.thresholds]
+        df = pd.DataFrame(self.labels, index=self.index.names, columns=cols)
+        df = df[cols[::-1]]
+        address = df[cols[-1]].astype(str)
+        for c in cols[-2::-1]:
+            address = address + '.' + df[c].astype(str)
+        df['address'] = address
+        df.index.name = 'sample'
+        return df
+
+    def clusters(self, threshold, min_size=2):
+        """Members of each cluster at a threshold with at least min_size isolates"""
+
+        x = self.table()['t%s' %threshold]
+        counts = x.value_counts()
+        x = x[x.isin(counts[counts >= min_size].index)]
+        return x.groupby(x).apply(lambda g: list(g.index))
+
+    def save(self, filename):
+        """Save the clusters and the profiles as a compressed npz file"""
+
+        m = self.merges
+        np.savez_compressed(filename, labels=self.labels, next_id=self.next_id,
+                            thresholds=np.array(self.thresholds), updates=np.array(self.updates),
+                            merges=m[['threshold','old','new','update']].values.astype(np.int64),
+                            **self.index.to_arrays())
+        return
+
+    @classmethod
+    def load(cls, filename):
+        """Load clusters saved with save"""
+
+        with np.load(filename, allow_pickle=False) as f:
+            C = cls([int(t) for t in f['thresholds']])
+            C.index = nearest.NearestIndex.from_arrays(f)
+            C.labels = f['labels']
+            C.next_id = f['next_id']
+            C.updates = int(f['updates'])
+            C.merges = pd.DataFrame(f['merges'].reshape(-1,4), columns=['threshold','old','new','update'])
+        return C
+
+def main():
+    "Run the application"
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='snipgenie snp address clustering tool.')
+    parser.add_argument("-i", "--input", action='append', dest="input", default=[],
+                        help="snp matrix (core.txt) or multi sample vcf, can be repeated", metavar="FILE")
+    parser.add_argument("-s", "--state", dest="state", default='clusters.npz',
+                        help="saved clusters, updated with the new isolates if it exists", metavar="FILE")
+    parser.add_argument("-t", "--thresholds", dest="thresholds", default='0,5,12,25,50',
+                        help="comma separated snp thresholds")
+    parser.add_argument("-o", "--outfile", dest="outfile", default='snp_addresses.csv',
+                        help="output csv file", metavar="FILE")
+    args = vars(parser.parse_args())
+    from . import snp_typing
+    st = time.time()
+    if os.path.exists(args['state']):
+        C = SNPClusters.load(args['state'])
+        print ('loaded %s' %C)
+    else:
+        C = SNPClusters([int(i) for i in args['thresholds'].split(',')])
+    n = C.updates
+    for f in args['input']:
+        X = snp_typing.read_snp_matrix(f)
+        new = C.add(X)
+        print ('added %s isolates from %s' %(len(new), f))
+    m = C.merges
+    m = m[m['update'] > n]
+    if len(m) > 0:
+        print ('merged clusters:')
+        print (m.to_string(index=False))
+    C.save(args['state'])
+    C.table().to_csv(args['outfile'])
+    print ('clustered %s isolates in %s seconds' %(len(C), round(time.time()-st,1)))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""
+    Isolate database of snp profiles, typing results and metadata.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,time,json
+import sqlite3
+import numpy as np
+import pandas as pd
+from . import results, profiles
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT,
+    reference TEXT,
+    version TEXT,
+    created REAL,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS site_sets (
+    id INTEGER PRIMARY KEY,
+    positions BLOB NOT NULL,
+    ref TEXT NOT NULL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS isolates (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    species TEXT,
+    run_id INTEGER REFERENCES runs(id),
+    added REAL
+);
+CREATE INDEX IF NOT EXISTS isolates_run ON isolates(run_id);
+CREATE TABLE IF NOT EXISTS metadata (
+    isolate_id INTEGER NOT NULL REFERENCES isolates(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (isolate_id, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metadata_key ON metadata(key, value);
+CREATE TABLE IF NOT EXISTS profiles (
+    isolate_id INTEGER PRIMARY KEY REFERENCES isolates(id) ON DELETE CASCADE,
+    site_set INTEGER NOT NULL REFERENCES site_sets(id),
+    run_id INTEGER REFERENCES runs(id),
+    profile BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS profiles_site_set ON profiles(site_set);
+CREATE TABLE IF NOT EXISTS typing (
+    isolate_id INTEGER NOT NULL REFERENCES isolates(id) ON DELETE CASCADE,
+    method TEXT NOT NULL,
+    clade TEXT,
+    matches INTEGER,
+    mismatches INTEGER,
+    nearest TEXT,
+    distance INTEGER,
+    run_id INTEGER REFERENCES runs(id),
+    PRIMARY KEY (isolate_id, method)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS typing_clade ON typing(method, clade);
+CREATE VIEW IF NOT EXISTS isolate_summary AS
+    SELECT i.id, i.name, i.species, t.clade, t.nearest, t.distance, i.run_id
+    FROM isolates i LEFT JOIN typing t ON t.isolate_id = i.id AND t.method = 'snp_typing';
+"""
+
+#sample table columns that are file names rather than metadata
+file_columns = ['sample','filename','name','bam_file','pair','filename1','filename2']
+
+class Database(object):
+    """
+    SQLite store of isolates with their snp profiles, typing results,
+    metadata and the runs they came from. The database is opened in WAL
+    mode so the viewer can read while results are added.
+    Args:
+        filename: database file, created if needed
+    Usage:
+        D = Database('isolates.sqlite')
+        D.ingest_results('results')
+        D.isolates(clade='5')
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.con = sqlite3.connect(filename)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('PRAGMA foreign_keys=ON')
+        self.con.executescript(schema)
+        return
+
+    def close(self):
+        self.con.close()
+        return
+
+    def query(self, sql, params=()):
+        """Run a parameterised query and return a dataframe"""
+
+        return pd.read_sql_query(sql, self.con, params=params)
+
+    def add_run(self, path=None, reference=None, params=None):
+        """Record a run and return its id"""
+
+        from . import __version__
+        cur = self.con.execute('INSERT INTO runs (path, reference, version, created, params) '
+                               'VALUES (?,?,?,?,?)',
+                               (path, reference, __version__, time.time(),
+                                json.dumps(params, default=str)))
+        return cur.lastrowid
+
+    def add_site_set(self, positions, ref):
+        """Store a set of sites with their reference alleles, returns its id"""
+
+        positions = np.asarray(positions, dtype=np.int64)
+        order = np.argsort(positions)
+        sid = profiles.site_set_id(positions)
+        #ids are stored as signed 64 bit integers
+        sid = int(np.uint64(sid).astype(np.int64))
+        ref = ''.join(pd.Series(ref).astype(str).str[0].values[order])
+        self.con.execute('INSERT OR IGNORE INTO site_sets (id, positions, ref, size) VALUES (?,?,?,?)',
+                         (sid, positions[order].astype('<i8').tobytes(), ref, len(positions)))
+        return sid
+
+    def get_site_set(self, sid):
+        """Positions and reference alleles of a site set"""
+
+        r = self.con.execute('SELECT positions, ref FROM site_sets WHERE id=?', (sid,)).fetchone()
+        if r == None:
+            raise KeyError('site set %s not found' %sid)
+        return pd.Series(list(r[1]), index=np.frombuffer(r[0], dtype='<i8'))
+
+    def add_isolates(self, names, run_id=None, species=None):
+        """Add or update isolates, returns a series of ids by name. The run and
+        species are kept if not given."""
+
+        now = time.time()
+        self.con.executemany('INSERT INTO isolates (name, species, run_id, added) VALUES (?,?,?,?) '
+                             'ON CONFLICT(name) DO UPDATE SET run_id=coalesce(excluded.run_id, run_id), '
+                             'species=coalesce(excluded.species, species)',
+                             [(str(n), species, run_id, now) for n in names])
+        return self.isolate_ids(names)
+
+    def isolate_ids(self, names):
+        """Ids of named isolates"""
+
+        names = [str(n) for n in names]
+        ids = {}
+        #query in batches to stay under the sqlite variable limit
+        for i in range(0, len(names), 900):
+            b = names[i:i+900]
+            sql = 'SELECT name, id FROM isolates WHERE name IN (%s)' %','.join('?'*len(b))
+            ids.update(self.con.execute(sql, b).fetchall())
+        return pd.Series(ids, dtype=object).reindex(names)
+
+    def add_profiles(self, nucmat, run_id=None):
+        """
+        Store snp profiles from a snp matrix with a ref column such as core.txt.
+        Only alleles different to the reference are kept.
+        """
+
+        df = nucmat
+        if 'pos' in df.columns:
+            df = df.set_index('pos')
+        positions = df.index.values.astype(np.int64)
+        sid = self.add_site_set(positions, df['ref'].values)
+        blobs = profiles.encode_profiles(df, sites=positions)
+        ids = self.add_isolates(blobs.index, run_id)
+        self.con.executemany('INSERT OR REPLACE INTO profiles (isolate_id, site_set, run_id, profile) '
+                             'VALUES (?,?,?,?)',
+                             [(int(ids[str(n)]), sid, run_id, b) for n,b in blobs.items()])
+        return
+
+    def add_typing(self, df, method='snp_typing', run_id=None):
+        """Store typing results indexed by sample as made by snp_typing.type_samples"""
+
+        df = df.copy()
+        for c in ['clade','matches','mismatches','nearest','distance']:
+            if c not in df.columns:
+                df[c] = None
+        ids = self.add_isolates(df.index, run_id)
+
+        def value(x):
+            if pd.isnull(x):
+                return None
+            if isinstance(x, (float,np.floating)) and float(x).is_integer():
+                return str(int(x))
+            return str(x)
+
+        def number(x):
+            return None if pd.isnull(x) else int(x)
+
+        rows = [(int(ids[str(n)]), method, value(r.clade), number(r.matches), number(r.mismatches),
+                 value(r.nearest), number(r.distance), run_id) for n,r in df.iterrows()]
+        self.con.executemany('INSERT OR REPLACE INTO typing (isolate_id, method, clade, matches, '
+                             'mismatches, nearest, distance, run_id) VALUES (?,?,?,?,?,?,?,?)', rows)
+        return
+
+    def add_metadata(self, df, name_col=None):
+        """
+        Store metadata columns as key value pairs. Isolates are added if
+        not already present.
+        Args:
+            df: dataframe indexed by isolate name or with a name column
+            name_col: column with isolate names
+        """
+
+        if name_col != None:
+            df = df.set_index(name_col)
+        ids = self.add_isolates(df.index)
+        x = df.copy()
+        x.index = ids.values
+        x = x.stack().reset_index()
+        x.columns = ['isolate_id','key','value']
+        x['value'] = x.value.astype(str)
+        self.con.executemany('INSERT OR REPLACE INTO metadata (isolate_id, key, value) VALUES (?,?,?)',
+                             list(zip(x.isolate_id.astype(int).tolist(), x.key.astype(str).tolist(),
+                                      x.value.tolist())))
+        return
+
+    def ingest_results(self, path, params=None, typing=False, metadata=None):
+        """
+        Load the outputs of a workflow into the database in one transaction.
+        Reads samples.csv, core.txt and snp_types.csv if present.
+        Args:
+            path: results folder
+            params: workflow options to record with the run
+            typing: run snp typing if there is no snp_types.csv
+            metadata: optional table of isolate metadata with a sample column
+        Returns:
+            the run id
+        """
+
+        st = time.time()
+        corefile = os.path.join(path, 'core.txt')
+        with self.con:
+            reference = None
+            if params != None:
+                reference = params.get('reference')
+            manifest = results.read_manifest(path)
+            run_id = self.add_run(os.path.abspath(path), reference,
+                                  {'params': params, 'manifest': manifest})
+            samplefile = os.path.join(path, 'samples.csv')
+            if os.path.exists(samplefile) or os.path.exists(results.binary_name(samplefile)):
+                samples = results.load_table(samplefile)
+                samples = samples.groupby('sample').first()
+                cols = [c for c in samples.columns if c not in file_columns]
+                self.add_isolates(samples.index, run_id)
+                self.add_metadata(samples[cols])
+            core = None
+            if os.path.exists(corefile) or os.path.exists(results.binary_name(corefile)):
+                core = results.load_table(corefile)
+                self.add_profiles(core, run_id)
+            typefile = os.path.join(path, 'snp_types.csv')
+            if os.path.exists(typefile):
+                self.add_typing(pd.read_csv(typefile, index_col=0), run_id=run_id)
+            elif typing == True and core is not None:
+                from . import snp_typing
+                self.add_typing(snp_typing.type_samples(core), run_id=run_id)
+            if metadata is not None:
+                self.add_metadata(metadata, 'sample')
+        print ('added results from %s in %s seconds' %(path, round(time.time()-st,1)))
+        return run_id
+
+    def isolates(self, clade=None, run_id=None, limit=None):
+        """Isolate names with typing results, optionally for one clade or run"""
+
+        sql = 'SELECT name, species, clade, nearest, distance, run_id FROM isolate_summary'
+        where = []
+        params = []
+        if clade != None:
+            where.append('clade = ?')
+            params.append(str(clade))
+        if run_id != None:
+            where.append('run_id = ?')
+            params.append(run_id)
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if limit != None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        return self.query(sql, params)
+
+    def metadata(self, keys, names=None):
+        """Metadata values as a table of isolates by keys"""
+
+        sql = 'SELECT i.name, m.key, m.value FROM metadata m JOIN isolates i ON i.id = m.isolate_id '\
+              'WHERE m.key IN (%s)' %','.join('?'*len(keys))
+        params = list(keys)
+        if names != None:
+            sql += ' AND i.name IN (%s)' %','.join('?'*len(names))
+            params += [str(n) for n in names]
+        x = self.query(sql, params)
+        return x.pivot(index='name', columns='key', values='value').reindex(columns=keys)
+
+    def get_profiles(self, names=None):
+        """
+        Stored profiles as a snp matrix of samples by positions, positions
+        not stored in a profile have the reference allele.
+        """
+
+        sql = 'SELECT i.name, p.site_set, p.profile FROM profiles p JOIN isolates i ON i.id = p.isolate_id'
+        params = []
+        if names != None:
+            sql += ' WHERE i.name IN (%s)' %','.join('?'*len(names))
+            params = [str(n) for n in names]
+        rows = self.con.execute(sql, params).fetchall()
+        res = []
+        for sid in dict.fromkeys(r[1] for r in rows):
+            ref = self.get_site_set(sid)
+            b = pd.Series([r[2] for r in rows if r[1] == sid], index=[r[0] for r in rows if r[1] == sid])
+            X = profiles.decode_profiles(b, ref.index.values).reindex(columns=ref.index)
+            X = X.fillna(pd.Series(ref.values, index=ref.index))
+            res.append(X)
+        if len(res) == 0:
+            return pd.DataFrame()
+        return pd.concat(res)
+
+    def map_table(self, keys=['LAT','LONG','SB']):
+        """Isolates with typing results and location metadata for the map view"""
+
+        x = self.isolates().set_index('name')
+        m = self.metadata(keys)
+        x = x.join(m, how='inner')
+        return x.reset_index()
+
+def main():
+    "Run the application"
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='snipgenie isolate database tool.')
+    parser.add_argument("-d", "--db", dest="db", default='isolates.sqlite',
+                        help="database file", metavar="FILE")
+    parser.add_argument("-i", "--input", action='append', dest="input", default=[],
+                        help="results folder to add, can be repeated", metavar="FILE")
+    parser.add_argument("-m", "--metadata", dest="metadata", default=None,
+                        help="csv file of isolate metadata with a sample column", metavar="FILE")
+    parser.add_argument("-t", "--type", dest="typing", action="store_true", default=False,
+                        help="run snp typing for results without snp_types.csv")
+    args = vars(parser.parse_args())
+    D = Database(args['db'])
+    for path in args['input']:
+        D.ingest_results(path, typing=args['typing'])
+    if args['metadata'] != None:
+        with D.con:
+            D.add_metadata(pd.read_csv(args['metadata']), 'sample')
+    n = D.con.execute('SELECT count(*) FROM isolates').fetchone()[0]
+    print ('%s isolates in %s' %(n, args['db']))
+    D.close()
+    return
+
+if __name__ == '__main__':
+    main()
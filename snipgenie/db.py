@@ -99,7 +99,7 @@ class FoliumWidget(QWidget):
 
         import folium
         m = self.map
-        for i,r in df.iterrows():
+        for i,r in df.dropna(subset=['LAT','LONG']).iterrows():
             popup = self.get_popup(r)
             cm = folium.CircleMarker(location = [r.LONG, r.LAT],
                                    radius = 5,
@@ -124,7 +124,7 @@ class FoliumWidget(QWidget):
         html = '<h4>%s</h4> <p>seq type: %s</p>'\
                 '<p>SB: %s </p> <p>closest: %s</p>'\
                 '<p>species: %s </p>'\
-                   %(r['name'],r['clade'],r['SB'],r['nearest'],r.species)
+                   %(r['name'],r.get('clade'),r.get('SB'),r.get('nearest'),r.get('species'))
         return html
 
     def base_map(self):
@@ -151,7 +151,7 @@ class FoliumWidget(QWidget):
 
 class DBViewer(QMainWindow):
     """Sample app for BTBgenie database/mapping interaction"""
-    def __init__(self):
+    def __init__(self, filename=None):
 
         QMainWindow.__init__(self)
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
@@ -163,6 +163,9 @@ class DBViewer(QMainWindow):
         self.setCentralWidget(self.main)
         self.add_widgets()
         self.create_menu(self)
+        self.db = None
+        if filename != None:
+            self.load_db(filename)
         self.show_map()
         return
 
@@ -215,21 +218,34 @@ class DBViewer(QMainWindow):
         self.setStatusBar(self.statusBar)
         return
 
-    def load_db(self):
+    def load_db(self, filename=None):
         """connect"""
 
+        from . import database
+        if filename == None:
+            filename, _ = QFileDialog.getOpenFileName(self, 'Open Database', '.',
+                                            'sqlite (*.sqlite *.db);;All files (*.*)')
+            if not filename:
+                return
+        self.db = database.Database(filename)
         con = QSqlDatabase.addDatabase("QSQLITE")
-        con.setDatabaseName("mbovis_ireland.sqlite")
-        print (con.databaseName())
-        print (con.connectionName())
+        con.setDatabaseName(filename)
+        con.open()
+        self.statusBar.showMessage(filename)
         self.load_table()
+        if hasattr(self, 'mapviewer'):
+            self.mapviewer.base_map()
+            self.mapviewer.show_dataframe(self.db.map_table())
         return
 
-    def load_table(self):
+    def load_table(self, clade=None):
+        """Show isolates, optionally for one clade using the clade index"""
 
         self.model = QSqlTableModel(self)
-        self.model.setTable("isolates")
+        self.model.setTable("isolate_summary")
         self.model.setEditStrategy(QSqlTableModel.OnFieldChange)
+        if clade != None:
+            self.model.setFilter("clade = '%s'" %str(clade).replace("'","''"))
         self.model.select()
         self.dbview.setModel(self.model)
         self.dbview.resizeColumnsToContents()
@@ -258,8 +274,9 @@ class DBViewer(QMainWindow):
 
         if not hasattr(self, 'mapviewer'):
             self.mapviewer = FoliumWidget()
-            self.df = pd.read_csv('notebooks/wicklow_test.csv')
-            self.mapviewer.show_dataframe(self.df)
+            if self.db != None:
+                self.df = self.db.map_table()
+                self.mapviewer.show_dataframe(self.df)
         if not 'map' in self.get_tabs():
             idx = self.right_tabs.addTab(self.mapviewer, 'map')
             self.right_tabs.setCurrentIndex(idx)
@@ -300,7 +317,10 @@ def main():
 
     QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
-    aw = DBViewer()
+    filename = None
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    aw = DBViewer(filename)
     aw.show()
     app.exec_()
 
@@ -29,7 +29,7 @@ import pandas as pd
 import numpy as np
 import pylab as plt
 from Bio import SeqIO
-from . import tools, aligners, app, widgets, tables, plotting, trees
+from . import tools, aligners, app, widgets, tables, plotting, trees, results, annotation
 
 home = os.path.expanduser("~")
 module_path = os.path.dirname(os.path.abspath(__file__)) #path to module
@@ -499,7 +499,7 @@ class App(QMainWindow):
     def import_results_folder(self, path):
         """Import previously made results"""
 
-        df = read.csv(os.path.join(path, 'samples.csv'))
+        df = results.load_table(os.path.join(path, 'samples.csv'))
         return
 
     def check_missing_files(self):
@@ -603,8 +603,8 @@ class App(QMainWindow):
         if filename == None:
             filename = self.add_file("Genbank Files(*.gb *.gbk *.gbff)")
         self.ref_gb = filename
-        #put annotation in a dataframe
-        self.annot = tools.genbank_to_dataframe(self.ref_gb)
+        #put annotation in a dataframe, parsed once and cached
+        self.annot = annotation.load_genbank(self.ref_gb).features
         self.update_ref_genome()
         return
 
@@ -675,14 +675,14 @@ class App(QMainWindow):
             self.outputdir = selected_directory
         #check if folder already got some results
         results_file = os.path.join(self.outputdir, 'samples.csv')
-        if os.path.exists(results_file):
+        if os.path.exists(results_file) or os.path.exists(results.binary_name(results_file)):
             msg = "This folder appears to have results already. Try to import them?"
             reply = QMessageBox.question(self, 'Confirm', msg,
                                         QMessageBox.Cancel | QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
             if reply == QMessageBox.Cancel:
                 return
             elif reply == QMessageBox.Yes:
-                self.fastq_table.model.df = pd.read_csv(results_file)
+                self.fastq_table.model.df = results.load_table(results_file)
                 self.fastq_table.refresh()
                 self.results['vcf_file'] = os.path.join(self.outputdir, 'filtered.vcf.gz')
         self.outdirLabel.setText(self.outputdir)
@@ -755,11 +755,11 @@ class App(QMainWindow):
         if not os.path.exists(path):
             os.makedirs(path)
         samples = app.align_reads(df, idx=ref, outdir=path, overwrite=overwrite, threads=kwds['threads'],
-                        aligner=kwds['aligner'],
+                        aligner=kwds['aligner'], cram=kwds['cram'],
                         callback=progress_callback.emit)
-        samples.to_csv(os.path.join(self.outputdir,'samples.csv'),index=False)
+        results.save_table(samples, os.path.join(self.outputdir,'samples.csv'), index=False)
         summ = app.results_summary(samples)
-        summ.to_csv(os.path.join(self.outputdir,'summary.csv'),index=False)
+        results.save_table(summ, os.path.join(self.outputdir,'summary.csv'), index=False)
         #rewrite samples in case check_missing
         app.write_samples(samples, self.outputdir)
         return
@@ -776,18 +776,23 @@ class App(QMainWindow):
         overwrite = kwds['overwrite']
         threads = int(kwds['threads'])
         filters = kwds['filters']
+        csq_method = kwds['csq_method']
         df = self.fastq_table.model.df
         path = self.outputdir
 
-        gff_file = os.path.join(path, self.ref_gb+'.gff')
-        tools.gff_bcftools_format(self.ref_gb, gff_file)
+        if csq_method == 'bcftools' and self.ref_gb != None:
+            gff_file = os.path.join(path, os.path.basename(self.ref_gb)+'.gff')
+            tools.gff_bcftools_format(self.ref_gb, gff_file)
+        else:
+            gff_file = None
         #use trimmed files if present in table
         bam_files = list(df.bam_file.unique())
 
         self.results['vcf_file'] = app.variant_calling(bam_files, self.ref_genome, path,
                                     threads=threads, relabel=True,
                                     overwrite=overwrite, filters=filters,
-                                    gff_file=gff_file,
+                                    gff_file=gff_file, gb_file=self.ref_gb,
+                                    csq_method=csq_method,
                                     callback=progress_callback.emit)
         self.results['nuc_matrix'] = os.path.join(self.outputdir, 'core.txt')
         self.results['csq_matrix'] = os.path.join(self.outputdir, 'csq.matrix')
@@ -797,16 +802,16 @@ class App(QMainWindow):
         """Show the stored results from variant calling as tables"""
 
         vcf_file = self.results['vcf_file']
-        vdf = tools.vcf_to_dataframe(vcf_file)
+        vdf = tools.vcf_to_dataframe(vcf_file, parquet=True)
         table = tables.DefaultTable(self.tabs, app=self, dataframe=vdf)
         i = self.tabs.addTab(table, 'variants')
         if 'nuc_matrix' in self.results:
-            nucmat = pd.read_csv(self.results['nuc_matrix'],sep=' ')
+            nucmat = results.load_table(self.results['nuc_matrix']).reset_index()
             table = tables.DefaultTable(self.tabs, app=self, dataframe=nucmat)
             i = self.tabs.addTab(table, 'snp_matrix')
             self.tabs.setCurrentIndex(i)
         if 'csq_matrix' in self.results:
-            csqmat = pd.read_csv(self.results['csq_matrix'])
+            csqmat = results.load_table(self.results['csq_matrix']).reset_index()
             table = tables.DefaultTable(self.tabs, app=self, dataframe=csqmat)
             i = self.tabs.addTab(table, 'csq_matrix')
             self.tabs.setCurrentIndex(i)
@@ -816,9 +821,9 @@ class App(QMainWindow):
         """Show SNP distance matrix"""
 
         filename = self.results['snp_dist']
-        if not os.path.exists(filename):
+        if not os.path.exists(filename) and not os.path.exists(results.binary_name(filename, True)):
             return
-        mat = pd.read_csv(filename)
+        mat = results.load_table(filename).reset_index()
         table = tables.DefaultTable(self.tabs, app=self, dataframe=mat)
         i = self.tabs.addTab(table, 'snp_dist')
         return
@@ -840,7 +845,7 @@ class App(QMainWindow):
         from Bio import AlignIO
         aln = AlignIO.read(outfasta, 'fasta')
         snp_dist = tools.snp_dist_matrix(aln)
-        snp_dist.to_csv(self.results['snp_dist'], sep=',')
+        results.save_table(snp_dist, self.results['snp_dist'], matrix=True)
         return
 
     def snp_align_completed(self):
@@ -857,8 +862,14 @@ class App(QMainWindow):
             outfile = os.path.join(self.outputdir,'RAxML_bipartitions.variants')
             treefile = trees.run_RAXML(corefasta, bootstraps=bootstraps, outpath=self.outputdir)
         elif method == 'fasttree':
-            outfile = os.path.join(self.outputdir,'fasttree.newick')
-            treefile = trees.run_fasttree(corefasta, bootstraps=bootstraps, outpath=self.outputdir)
+            #replicates are run in parallel and resumed if interrupted
+            self.opts.applyOptions()
+            threads = int(self.opts.kwds['threads'])
+            outfile = trees.bootstrap_tree(corefasta, self.outputdir, 'fasttree',
+                                           bootstraps, threads=threads)
+        elif method == 'nj':
+            outfile = os.path.join(self.outputdir,'tree.newick')
+            trees.nj_tree(self.results['snp_dist'], outfile)
 
         self.show_tree()
         self.treefile = outfile
@@ -947,7 +958,7 @@ class App(QMainWindow):
         """Show annotation in table"""
 
         gb_file = self.ref_gb
-        df = tools.genbank_to_dataframe(gb_file)
+        df = annotation.load_genbank(gb_file).to_dataframe()
         t = tables.DataFrameTable(self.tabs, dataframe=df)
         i = self.tabs.addTab(t, 'ref_annotation')
         self.tabs.setCurrentIndex(i)
@@ -986,22 +997,30 @@ class App(QMainWindow):
             df.loc[i,'reads'] = tools.get_fastq_length(r.filename)
         return
 
+    def get_mapping_stats(self, bam_file):
+        """samtools stats of a bam or cram file using the project reference.
+        Bowtie and subread bams have no unmapped reads so no percentage mapped
+        is given for them."""
+
+        self.opts.applyOptions()
+        kwds = self.opts.kwds
+        return tools.samtools_stats(bam_file, ref=self.ref_genome,
+                                    filtered=kwds['aligner'] in ['bowtie','subread'])
+
     def add_mapping_stats(self, progress_callback):
-        """get mapping stats for all files and add to table"""
+        """get mapping stats for all files and add to table, these are
+        normally already present from alignment"""
 
         df = self.fastq_table.model.df
         rows = self.fastq_table.getSelectedRows()
         data = df.iloc[rows]
-
-        def get_stats(x):
-            d = tools.samtools_flagstat(x)
-            s = pd.Series(d)
-            return s
-
         for i,r in data.iterrows():
-            s = get_stats(r.bam_file)
-            df.loc[i,'mapped'] = s['mapped']
-            df.loc[i,'total'] = s['total']
+            if 'mean_depth' in df.columns and not pd.isnull(r.mean_depth):
+                continue
+            #uses saved samtools stats output if present
+            d = self.get_mapping_stats(r.bam_file)
+            for k in d:
+                df.loc[i,k] = d[k]
         #self.fastq_table.setDataFrame(df)
         return
 
@@ -1011,7 +1030,7 @@ class App(QMainWindow):
         df = self.fastq_table.model.df
         row = self.fastq_table.getSelectedRows()[0]
         data = df.iloc[row]
-        d = tools.samtools_flagstat(data.bam_file)
+        d = self.get_mapping_stats(data.bam_file)
         df = pd.DataFrame(d.items())
         self.info.append(data.bam_file)
         self.info.append(df.to_string())
@@ -1057,7 +1076,7 @@ class App(QMainWindow):
 
     def plot_snp_matrix(self):
 
-        mat = pd.read_csv(self.results['snp_dist'],index_col=0)
+        mat = results.load_table(self.results['snp_dist'])
         bv = widgets.BrowserViewer()
         import toyplot
         min=mat.min().min()
@@ -1093,19 +1112,22 @@ class App(QMainWindow):
         samples = list(data['sample'].unique())
         print (samples)
         vcffile = self.results['vcf_file']
-        vdf = tools.vcf_to_dataframe(vcffile)
-        def het(x):
-            if sum(x.AD) == 0:
-                return
-            return min(x.AD)/sum(x.AD)
+        v = tools.read_vcf_arrays(vcffile, fields=['AD'], samples=samples)
+        #minor allele fraction at each site, padded alleles are -1
+        ad = v['AD']
+        total = np.where(ad>=0, ad, 0).sum(2)
+        minor = np.where(ad>=0, ad, np.iinfo(ad.dtype).max).min(2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hets = np.where(total>0, minor/total, np.nan)
         l=int(np.sqrt(len(samples)))
         fig,ax=plt.subplots(l,l+1,figsize=(10,6))
         axs=ax.flat
         i=0
         sites = []
         for s in samples:
-            x = vdf[vdf['sample']==s]
-            x['het'] = x.apply(het,1)
+            if s not in v['samples']:
+                continue
+            x = pd.DataFrame({'start':v['POS']-1, 'het':hets[:,v['samples'].index(s)]})
             x.plot('start','het',kind='scatter',alpha=0.6,ax=axs[i])
             axs[i].set_title(s)
             i+=1
@@ -1125,13 +1147,13 @@ class App(QMainWindow):
         from . import snp_typing
         df = self.fastq_table.model.df
         #use ALL snp sites including uninformative
-        nucmat = pd.read_csv(self.results['nuc_matrix'],sep=' ',index_col=0)
+        nucmat = results.load_table(self.results['nuc_matrix'])
         #print (nucmat)
         rows = self.fastq_table.getSelectedRows()
         data = df.iloc[rows]
-        snptable = snp_typing.clade_snps
         res = snp_typing.type_samples(nucmat)
-
+        res.to_csv(os.path.join(self.outputdir, 'snp_types.csv'))
+        print (res)
         return
 
     def spoligotyping(self, progress_callback):
@@ -1357,8 +1379,8 @@ class AppOptions(widgets.BaseOptions):
         cpus = [str(i) for i in range(1,os.cpu_count()+1)]
         self.groups = {'general':['threads','labelsep','overwrite'],
                         'trimming':['quality'],
-                        'aligners':['aligner'],
-                        'variant calling':['filters'],
+                        'aligners':['aligner','cram'],
+                        'variant calling':['filters','csq_method'],
                         'blast':['db','identity','coverage']
                        }
         self.opts = {'threads':{'type':'combobox','default':4,'items':cpus},
@@ -1368,9 +1390,12 @@ class AppOptions(widgets.BaseOptions):
 
                     'aligner':{'type':'combobox','default':'bwa',
                     'items':aligners,'label':'aligner'},
+                    'cram':{'type':'checkbox','default':False,'label':'store as cram'},
                     'db':{'type':'combobox','default':'card',
                     'items':[],'label':'database'},
                     'filters':{'type':'entry','default':app.default_filter},
+                    'csq_method':{'type':'combobox','default':'native',
+                    'items':['native','bcftools'],'label':'consequence calling'},
                     'identity':{'type':'entry','default':90},
                     'coverage':{'type':'entry','default':50},
                     'quality':{'type':'spinbox','default':30}
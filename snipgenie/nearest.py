@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""
+    Nearest isolate search over stored SNP profiles.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,time
+import numpy as np
+import pandas as pd
+
+bases = ['A','C','G','T']
+_bytecounts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(x):
+    """Number of set bits in each row of a 2d array of uint64 words"""
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).sum(-1, dtype=np.int64)
+    b = np.ascontiguousarray(x).view(np.uint8)
+    return _bytecounts[b].sum(-1, dtype=np.int64)
+
+def profile_series(snps):
+    """A sample profile as a series of alleles indexed by position. Accepts
+    a series, a dict, a string from snp_typing.encode_snps or bytes from
+    profiles.encode_profiles"""
+
+    if isinstance(snps, bytes):
+        from . import profiles
+        snps = profiles.decode_profile(snps)
+    elif isinstance(snps, str):
+        from . import snp_typing
+        snps = snp_typing.decode_snps(snps)
+    snps = pd.Series(snps).dropna()
+    snps.index = snps.index.astype(np.int64)
+    return snps.astype(str)
+
+class NearestIndex(object):
+    """
+    Search index of isolate snp profiles. Each profile is stored as a packed
+    bitset of the non reference alleles it carries, so the distance between
+    two isolates is the popcount of their xor. This is the snp distance
+    with missing calls treated as reference and sites where both isolates
+    carry different non reference alleles counted twice. Distances to a few
+    pivot isolates are stored so most profiles can be skipped using the
+    triangle inequality.
+    Usage:
+        N = NearestIndex.from_matrix(nucmat)
+        N.knn(snps, k=5)
+        N.within(snps, 10)
+        N.save('isolates.idx.npz')
+    """
+    def __init__(self, npivots=16):
+        self.npivots = npivots
+        self.names = []
+        #site table of position and allele for each bit
+        self.sites = pd.DataFrame({'pos': np.zeros(0, dtype=np.int64), 'allele': []})
+        self.site_index = {}
+        self.ref = {}
+        self.bits = np.zeros((0,0), dtype=np.uint64)
+        self.pivots = np.zeros((0,0), dtype=np.uint64)
+        self.pivot_dist = np.zeros((0,0), dtype=np.int64)
+        return
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'NearestIndex %s isolates, %s alleles, %s pivots' %(len(self),
+                len(self.sites), len(self.pivots))
+
+    @classmethod
+    def from_matrix(cls, nucmat, npivots=16):
+        """
+        Build an index from a snp matrix.
+        Args:
+            nucmat: positions by samples with a ref column, as in core.txt,
+            or samples by positions with a ref row
+        """
+
+        N = cls(npivots)
+        N.add(nucmat)
+        return N
+
+    def _words(self, nbits):
+        return max(1, (nbits+63)//64)
+
+    def _pack(self, rows, cols, n):
+        """Bitsets from row and bit indexes"""
+
+        w = self._words(len(self.sites))
+        bits = np.zeros((n, w), dtype=np.uint64)
+        if len(rows) > 0:
+            cols = np.asarray(cols, dtype=np.int64)
+            np.bitwise_or.at(bits, (rows, cols//64), np.uint64(1) << (cols%64).astype(np.uint64))
+        return bits
+
+    def _site_bits(self, pos, codes, add=False):
+        """Bit index of each position and allele code, -1 if not in the index"""
+
+        keys = pos.astype(np.int64)*4 + codes
+        ukeys, inv = np.unique(keys, return_inverse=True)
+        upos = (ukeys//4).tolist()
+        ualleles = [bases[c] for c in (ukeys%4)]
+        if add == True:
+            new = [k for k in zip(upos, ualleles) if k not in self.site_index]
+            if len(new) > 0:
+                n = len(self.sites)
+                for i,k in enumerate(new):
+                    self.site_index[k] = n+i
+                x = pd.DataFrame(new, columns=['pos','allele'])
+                self.sites = pd.concat([self.sites, x], ignore_index=True)
+        ubits = np.array([self.site_index.get(k, -1) for k in zip(upos, ualleles)], dtype=np.int64)
+        return ubits[inv.ravel()]
+
+    def _ref_codes(self, positions):
+        from . import snp_typing
+        return snp_typing.encode_alleles([self.ref.get(p) for p in positions])
+
+    def add(self, nucmat):
+        """
+        Add profiles to the index.
+        Args:
+            nucmat: snp matrix in either orientation, see from_matrix. The
+            reference allele at new positions is taken from the ref column,
+            which is needed if there are positions not in the index
+        """
+
+        from . import snp_typing
+        names, positions, codes, ref = snp_typing.allele_matrix(nucmat)
+        new = [i for i,p in enumerate(positions) if p not in self.ref]
+        if len(new) > 0:
+            if ref is None:
+                raise ValueError('%s positions not in the index and no ref alleles given' %len(new))
+            r = snp_typing.encode_alleles(np.asarray(ref)[new])
+            for i,c in zip(new, r):
+                self.ref[int(positions[i])] = bases[c] if c < 4 else 'N'
+        alts = (codes != self._ref_codes(positions)) & (codes < 4)
+        rows, cols = np.nonzero(alts)
+        b = self._site_bits(positions[cols], codes[rows, cols], add=True)
+        new = self._pack(rows, b, len(names))
+        #widen the stored bitsets if there are new alleles
+        w = new.shape[1]
+        old = np.zeros((len(self.bits), w), dtype=np.uint64)
+        old[:, :self.bits.shape[1]] = self.bits
+        self.bits = np.concatenate([old, new])
+        p = np.zeros((len(self.pivots), w), dtype=np.uint64)
+        p[:, :self.pivots.shape[1]] = self.pivots
+        self.pivots = p
+        self.names.extend([str(n) for n in names])
+        self.choose_pivots()
+        return
+
+    def distances(self, bits):
+        """Distances from one bitset to every stored profile"""
+
+        return popcount(self.bits ^ bits)
+
+    def choose_pivots(self):
+        """Pick pivots spread across the data by farthest first traversal and
+        store the distance of every profile to each pivot"""
+
+        n = len(self.bits)
+        if n == 0:
+            return
+        if len(self.pivots) >= min(self.npivots, n) and len(self.pivot_dist) < n:
+            #existing pivots, just add distances for new profiles
+            new = self.bits[len(self.pivot_dist):]
+            d = np.stack([popcount(new ^ p) for p in self.pivots], axis=1)
+            self.pivot_dist = np.concatenate([self.pivot_dist, d])
+            return
+        idx = [0]
+        d = [self.distances(self.bits[0])]
+        mind = d[0].copy()
+        while len(idx) < min(self.npivots, n):
+            i = int(np.argmax(mind))
+            if mind[i] == 0:
+                break
+            idx.append(i)
+            d.append(self.distances(self.bits[i]))
+            mind = np.minimum(mind, d[-1])
+        self.pivots = self.bits[idx].copy()
+        self.pivot_dist = np.stack(d, axis=1)
+        return
+
+    def encode(self, snps):
+        """
+        Bitset of a query profile.
+        Returns:
+            bitset and the number of alleles not in the index, which add
+            to the distance to every stored profile
+        """
+
+        from . import snp_typing
+        s = profile_series(snps)
+        codes = snp_typing.encode_alleles(s.values)
+        alts = (codes != self._ref_codes(s.index)) & (codes < 4)
+        b = self._site_bits(s.index.values[alts], codes[alts])
+        bits = self._pack(np.zeros((b>=0).sum(), dtype=np.int64), b[b>=0], 1)[0]
+        return bits, int((b<0).sum())
+
+    def _lower_bounds(self, bits, novel):
+        dq = popcount(self.pivots ^ bits) + novel
+        return np.abs(self.pivot_dist - dq).max(1)
+
+    def within(self, snps, d):
+        """
+        Stored isolates within d snps of a profile.
+        Returns:
+            dataframe of names and distances sorted by distance
+        """
+
+        bits, novel = self.encode(snps)
+        cand = np.flatnonzero(self._lower_bounds(bits, novel) <= d)
+        dist = popcount(self.bits[cand] ^ bits) + novel
+        keep = dist <= d
+        return self._result(cand[keep], dist[keep])
+
+    def knn(self, snps, k=5, block=256):
+        """
+        The k nearest stored isolates to a profile. Candidates are checked in
+        order of their lower bound and the search stops once the bound is
+        more than the current kth distance.
+        Returns:
+            dataframe of names and distances sorted by distance
+        """
+
+        bits, novel = self.encode(snps)
+        k = min(k, len(self))
+        lb = self._lower_bounds(bits, novel)
+        order = np.argsort(lb, kind='stable')
+        best_i = np.zeros(0, dtype=np.int64)
+        best_d = np.zeros(0, dtype=np.int64)
+        for s in range(0, len(order), block):
+            c = order[s:s+block]
+            if len(best_d) >= k and lb[c[0]] > best_d[k-1]:
+                break
+            d = popcount(self.bits[c] ^ bits) + novel
+            best_i = np.concatenate([best_i, c])
+            best_d = np.concatenate([best_d, d])
+            o = np.argsort(best_d, kind='stable')[:k]
+            best_i, best_d = best_i[o], best_d[o]
+        return self._result(best_i, best_d)
+
+    def _result(self, idx, dist):
+        o = np.argsort(dist, kind='stable')
+        return pd.DataFrame({'name': np.array(self.names, dtype=object)[idx[o]],
+                             'distance': dist[o]})
+
+    def to_arrays(self):
+        """The index as a dict of arrays"""
+
+        ref = pd.Series(self.ref)
+        return {'bits': self.bits, 'pivots': self.pivots, 'pivot_dist': self.pivot_dist,
+                'names': np.array(self.names, dtype=str),
+                'site_pos': self.sites.pos.values.astype(np.int64),
+                'site_allele': np.array(self.sites.allele, dtype=str),
+                'ref_pos': ref.index.values.astype(np.int64),
+                'ref_allele': np.array(ref.values, dtype=str),
+                'npivots': np.array(self.npivots)}
+
+    @classmethod
+    def from_arrays(cls, f):
+        """Make an index from the arrays of to_arrays or an npz file"""
+
+        N = cls(int(f['npivots']))
+        N.bits = f['bits']
+        N.pivots = f['pivots']
+        N.pivot_dist = f['pivot_dist']
+        N.names = list(f['names'])
+        N.sites = pd.DataFrame({'pos': f['site_pos'], 'allele': f['site_allele'].astype(object)})
+        N.ref = dict(zip(f['ref_pos'].tolist(), f['ref_allele'].tolist()))
+        N.site_index = {(int(p),a): i for i,(p,a) in enumerate(zip(N.sites.pos, N.sites.allele))}
+        return N
+
+    def save(self, filename):
+        """Save the index as a compressed npz file"""
+
+        np.savez_compressed(filename, **self.to_arrays())
+        return
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save"""
+
+        with np.load(filename, allow_pickle=False) as f:
+            return cls.from_arrays(f)
+
+def nearest_isolates(nucmat, index, k=1):
+    """
+    Find the nearest stored isolates for every sample in a snp matrix. A
+    sample stored in the index under the same name is not reported.
+    Args:
+        nucmat: snp matrix, see NearestIndex.from_matrix
+        index: NearestIndex or saved index file
+        k: number of neighbours
+    Returns:
+        dataframe indexed by sample with nearest and distance columns
+    """
+
+    from . import snp_typing
+    if not isinstance(index, NearestIndex):
+        index = NearestIndex.load(index)
+    X = snp_typing.sample_matrix(nucmat)
+    res = []
+    for name,row in X.iterrows():
+        r = index.knn(row, k=k+1)
+        r = r[r.name != str(name)][:k]
+        res.append(pd.DataFrame({'sample': name, 'nearest': r.name, 'distance': r.distance}))
+    res = pd.concat(res).set_index('sample')
+    return res
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+    Genotyping of single isolates at a panel of known sites.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,time,subprocess
+import numpy as np
+import pandas as pd
+from . import tools
+
+def make_panel(chrom, snptable=None, core=None, outfile=None):
+    """
+    Make a panel of sites to genotype from the clade snps table and the
+    sites of a snp matrix.
+    Args:
+        chrom: reference sequence name used in the alignments
+        snptable: clade snps table, default is the M.bovis table
+        core: snp matrix such as core.txt or its file name, optional
+        outfile: write the panel as a tab separated regions file for bcftools
+    Returns:
+        dataframe of chrom and pos
+    """
+
+    from . import snp_typing
+    if snptable is None:
+        snptable = snp_typing.clade_snps
+    pos = [snptable.pos.dropna().astype(np.int64).values]
+    if core is not None:
+        if isinstance(core, str):
+            core = snp_typing.read_snp_matrix(core)
+        names, positions, codes, ref = snp_typing.allele_matrix(core)
+        pos.append(positions)
+    pos = np.unique(np.concatenate(pos))
+    panel = pd.DataFrame({'chrom': chrom, 'pos': pos})
+    if outfile != None:
+        panel.to_csv(outfile, sep='\t', index=False, header=False)
+    return panel
+
+def genotype_bam(bam_file, ref, panel_file, outfile, min_depth=4, threads=1):
+    """
+    Call alleles of one bam or cram file at the panel sites only. The bam
+    index is used so only reads at the panel sites are read.
+    Args:
+        bam_file: indexed bam or cram file
+        ref: reference fasta
+        panel_file: regions file from make_panel
+        outfile: bgzipped vcf of calls at all panel sites
+        min_depth: sites with lower depth are treated as missing
+    Returns:
+        series of called bases by position, named by the sample
+    """
+
+    bcftoolscmd = tools.get_cmd('bcftools')
+    cmd = '{bc} mpileup -f {r} -R {p} -a AD,DP --min-MQ 60 --max-depth 500 -O u {b} '\
+          '| {bc} call --ploidy 1 -m -O z --threads {t} -o {o}'\
+          .format(bc=bcftoolscmd, r=ref, p=panel_file, b=bam_file, o=outfile, t=threads)
+    print (cmd)
+    subprocess.check_output(cmd, shell=True)
+    return read_panel_calls(outfile, min_depth)
+
+def read_panel_calls(vcf_file, min_depth=4):
+    """Called bases of a single sample vcf, sites below min_depth are N"""
+
+    v = tools.read_vcf_arrays(vcf_file, fields=['GT','DP'])
+    gtb = tools.get_genotype_bases(v['REF'], v['ALT'], v['GT'])[:,0]
+    dp = pd.to_numeric(pd.Series(v['DP'][:,0]), errors='coerce').fillna(0).values
+    gtb[(dp < min_depth) | pd.isnull(gtb)] = 'N'
+    s = pd.Series(gtb, index=v['POS'].astype(np.int64), name=v['samples'][0])
+    #indels at panel sites can add a second record
+    s = s[~s.index.duplicated()]
+    s.index.name = 'pos'
+    return s
+
+def type_calls(calls, compiled=None, index=None, k=3, snptable=None):
+    """
+    Type one isolate from its panel calls.
+    Args:
+        calls: series of bases by position
+        compiled: compiled clade snps, see snp_typing.compile_clade_snps
+        snptable: clade snps table if not compiled, default is the M.bovis table
+        index: nearest.NearestIndex of stored isolates or its file name
+        k: number of nearest isolates to report
+    Returns:
+        series of typing results
+    """
+
+    from . import snp_typing
+    X = pd.DataFrame([calls.values], index=[calls.name], columns=calls.index)
+    res = snp_typing.type_samples(X, snptable, compiled=compiled).iloc[0]
+    res['sites'] = len(calls)
+    res['called'] = int((calls != 'N').sum())
+    if index is not None:
+        from . import nearest
+        if not isinstance(index, nearest.NearestIndex):
+            index = nearest.NearestIndex.load(index)
+        n = index.knn(calls, k=k)
+        n = n[n.name != str(calls.name)]
+        res['nearest'] = ','.join(n.name)
+        res['distance'] = ','.join(n.distance.astype(str))
+    return res
+
+def run_panel(bam_files, ref, outdir, snptable=None, core=None, index=None,
+              min_depth=4, threads=1):
+    """
+    Genotype and type bam files at the panel sites.
+    Args:
+        bam_files: list of aligned bam or cram files, one per sample
+        ref: reference fasta used for the alignments
+        outdir: folder for the panel, calls and panel_types.csv
+        snptable: clade snps table
+        core: snp matrix whose sites are added to the panel
+        index: nearest isolate index file
+    Returns:
+        dataframe of typing results
+    """
+
+    from . import snp_typing
+    os.makedirs(outdir, exist_ok=True)
+    chrom = tools.get_chrom(ref)
+    panel_file = os.path.join(outdir, 'panel.tsv')
+    panel = make_panel(chrom, snptable, core, panel_file)
+    print ('%s sites in panel' %len(panel))
+    if snptable is None:
+        snptable = snp_typing.clade_snps
+    compiled = snp_typing.compile_clade_snps(snptable)
+    if index is not None:
+        from . import nearest
+        index = nearest.NearestIndex.load(index)
+    res = []
+    for bam_file in bam_files:
+        st = time.time()
+        name = os.path.splitext(os.path.basename(bam_file))[0]
+        out = os.path.join(outdir, name+'.panel.vcf.gz')
+        calls = genotype_bam(bam_file, ref, panel_file, out, min_depth, threads)
+        calls.name = name
+        r = type_calls(calls, compiled, index)
+        r['time'] = round(time.time()-st, 1)
+        res.append(r)
+        print (r.to_string())
+        print ()
+    res = pd.DataFrame(res)
+    res.index.name = 'sample'
+    res.to_csv(os.path.join(outdir, 'panel_types.csv'))
+    return res
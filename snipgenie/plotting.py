@@ -74,23 +74,29 @@ def get_fasta_sequence(filename, start, end, key=0):
     seq = refseq[chrom][start:end].seq
     return seq
 
-def get_chrom(bam_file):
-    """Get first sequence name in a bam file"""
+def open_alignment(bam_file, ref=None):
+    """Open a bam or cram file with pysam, cram files need the reference"""
 
     import pysam
-    samfile = pysam.AlignmentFile(bam_file, "r")
+    if ref != None:
+        return pysam.AlignmentFile(bam_file, "r", reference_filename=ref)
+    return pysam.AlignmentFile(bam_file, "r")
+
+def get_chrom(bam_file, ref=None):
+    """Get first sequence name in a bam or cram file"""
+
+    samfile = open_alignment(bam_file, ref)
     iter=samfile.fetch(start=0,end=10)
     for read in iter:
         if read.reference_name:
             return read.reference_name
 
-def get_coverage(bam_file, chr, start, end):
-    """Get coverage from bam file at specified region"""
+def get_coverage(bam_file, chr, start, end, ref=None):
+    """Get coverage from bam or cram file at specified region"""
 
-    import pysam
     if bam_file is None or not os.path.exists(bam_file):
         return
-    samfile = pysam.AlignmentFile(bam_file, "r")
+    samfile = open_alignment(bam_file, ref)
     vals = [(pileupcolumn.pos, pileupcolumn.n) for pileupcolumn in samfile.pileup(chr, start, end)]
     df = pd.DataFrame(vals,columns=['pos','coverage'])
     df = df[(df.pos>=start) & (df.pos<=end)]
@@ -101,17 +107,16 @@ def get_coverage(bam_file, chr, start, end):
         df = df.append(new).reset_index(drop=True)
     return df
 
-def get_bam_aln(bam_file, chr, start, end, group=False):
-    """Get all aligned reads from a sorted bam file for within the given coords"""
+def get_bam_aln(bam_file, chr, start, end, group=False, ref=None):
+    """Get all aligned reads from a sorted bam or cram file for within the given coords"""
 
-    import pysam
     if not os.path.exists(bam_file):
         return
     if chr is None:
         return
     if start<1:
         start=0
-    samfile = pysam.AlignmentFile(bam_file, "r")
+    samfile = open_alignment(bam_file, ref)
     iter = samfile.fetch(chr, start, end)
     d=[]
     for read in iter:
@@ -154,10 +159,11 @@ def plot_coverage(df, plot_width=800, plot_height=60, xaxis=True, ax=None):
     return
 
 def plot_bam_alignment(bam_file, chr, xstart, xend, ystart=0, yend=100,
-                        rect_height=.6, fill_color='gray', ax=None):
+                        rect_height=.6, fill_color='gray', ax=None, ref=None):
     """bam alignments plotter.
     Args:
-        bam_file: name of a sorted bam file
+        bam_file: name of a sorted bam or cram file
+        ref: reference fasta, needed for cram files
         start: start of range to show
         end: end of range
     """
@@ -166,7 +172,7 @@ def plot_bam_alignment(bam_file, chr, xstart, xend, ystart=0, yend=100,
     #cover the visible range from start-end
     o = (xend-xstart)/2
     #get reads in range into a dataframe
-    df = get_bam_aln(bam_file, chr, xstart-o, xend+o)
+    df = get_bam_aln(bam_file, chr, xstart-o, xend+o, ref=ref)
     #print (df[:4])
     df['x'] = df.start+df.length/2
     df['y'] = df.y*(h+1)
@@ -193,9 +199,16 @@ def plot_bam_alignment(bam_file, chr, xstart, xend, ystart=0, yend=100,
     return
 
 def plot_features(rec, ax, rows=3, xstart=0, xend=30000):
+    """Plot features in a region.
+    Args:
+        rec: a SeqRecord or features dataframe, e.g. from annotation.load_genbank
+    """
 
     h=1
-    df = tools.records_to_dataframe([rec])
+    if isinstance(rec, pd.DataFrame):
+        df = rec.astype({'id':object,'feat_type':object})
+    else:
+        df = tools.records_to_dataframe([rec])
     df = df[(df.feat_type!='region') & (df['feat_type']!='source')]
     df = df[(df.start>xstart) & (df.end<xend)]
     df['length'] = df.end-df.start
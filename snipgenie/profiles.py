@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+    Compact binary encoding of sample snp profiles.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,struct,hashlib
+import numpy as np
+import pandas as pd
+
+#magic, version, flags, site set id, number of calls, number of missing sites
+header = struct.Struct('<2sBBQII')
+magic = b'SP'
+version = 1
+#positions are stored as indexes into the site set
+SITE_INDEX = 1
+bases = np.array(['A','C','G','T','N'], dtype=object)
+
+def site_set_id(positions):
+    """Identifier of a set of positions, the first 8 bytes of the md5 of the
+    sorted positions"""
+
+    p = np.unique(np.asarray(positions, dtype=np.int64)).astype('<i8')
+    return struct.unpack('<Q', hashlib.md5(p.tobytes()).digest()[:8])[0]
+
+def varint_encode(values):
+    """
+    Encode unsigned integers as LEB128 varints.
+    Returns:
+        byte array and the number of bytes used by each value
+    """
+
+    v = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(v), dtype=np.int64)
+    for k in range(1,10):
+        lengths += v >= np.uint64(1) << np.uint64(7*k)
+    vi = np.repeat(np.arange(len(v)), lengths)
+    start = np.cumsum(lengths)-lengths
+    k = np.arange(len(vi))-start[vi]
+    out = ((v[vi] >> (7*k).astype(np.uint64)) & np.uint64(127)).astype(np.uint8)
+    out[k < lengths[vi]-1] |= 128
+    return out, lengths
+
+def varint_decode(data):
+    """Decode a byte array of LEB128 varints into an array of integers"""
+
+    b = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else data
+    if len(b) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 128)
+    vi = np.zeros(len(b), dtype=np.int64)
+    vi[ends[:-1]+1] = 1
+    vi = np.cumsum(vi)
+    start = np.concatenate([[0], ends[:-1]+1])
+    k = np.arange(len(b))-start[vi]
+    parts = (b & 127).astype(np.int64) << (7*k)
+    return np.add.reduceat(parts, start)
+
+def _segment_cumsum(values, counts):
+    """Cumulative sums restarting at each segment"""
+
+    c = np.cumsum(values)
+    starts = np.cumsum(counts)-counts
+    c0 = np.concatenate([[0], c])
+    return c - np.repeat(c0[starts], counts)
+
+def _segment_diff(values, counts):
+    """Differences within each segment, the first value of a segment is kept"""
+
+    d = np.diff(values, prepend=0)
+    starts = np.cumsum(counts)-counts
+    starts = starts[np.asarray(counts) > 0]
+    d[starts] = values[starts]
+    return d
+
+def encode_profiles(nucmat, ref=None, sites=None):
+    """
+    Encode snp profiles in a compact binary form. Each profile is a header
+    followed by the varint delta encoded sorted positions of the called sites
+    and then of the missing sites, then the called alleles packed 4 per byte.
+    Encoding is done for all samples at once.
+    Args:
+        nucmat: snp matrix in either orientation, see snp_typing.sample_matrix
+        ref: series of reference alleles by position, only differing alleles
+        are stored if given, the ref column of the matrix is used otherwise
+        sites: site set the positions belong to, positions are then stored as
+        indexes into this set and its id written in the header
+    Returns:
+        series of bytes indexed by sample
+    """
+
+    from . import snp_typing
+    names, positions, codes, r = snp_typing.allele_matrix(nucmat)
+    if ref is None:
+        ref = r
+    keep = np.ones(codes.shape, dtype=bool)
+    if ref is not None:
+        ref = pd.Series(ref)
+        ref.index = ref.index.astype(np.int64)
+        r = snp_typing.encode_alleles(ref.reindex(positions).values)
+        keep = codes != r
+    flags = 0
+    sid = 0
+    order = np.argsort(positions, kind='stable')
+    p = positions[order]
+    if sites is not None:
+        sites = np.unique(np.asarray(sites, dtype=np.int64))
+        idx = np.searchsorted(sites, p)
+        if (idx >= len(sites)).any() or (sites[np.minimum(idx,len(sites)-1)] != p).any():
+            raise ValueError('positions not in the site set')
+        p = idx
+        flags = SITE_INDEX
+        sid = site_set_id(sites)
+    codes = codes[:, order]
+    keep = keep[:, order]
+    called = keep & (codes < 4)
+    missing = keep & (codes == 4)
+    n = len(names)
+    ncalled = called.sum(1)
+    nmissing = missing.sum(1)
+    #positions of each sample, called then missing, as one stream
+    rows_c, cols_c = np.nonzero(called)
+    rows_m, cols_m = np.nonzero(missing)
+    seg = np.concatenate([rows_c*2, rows_m*2+1])
+    cols = np.concatenate([cols_c, cols_m])
+    o = np.argsort(seg, kind='stable')
+    counts = np.bincount(seg, minlength=2*n)
+    pos = p[cols[o]]
+    deltas = _segment_diff(pos, counts)
+    vbytes, lengths = varint_encode(deltas)
+    seglen = np.bincount(seg[o], weights=lengths, minlength=2*n).astype(np.int64)
+    seglen = seglen.reshape(n,2).sum(1)
+    vsplit = np.split(vbytes, np.cumsum(seglen)[:-1])
+    #alleles 2 bits each, padded to whole bytes per sample
+    a = codes[rows_c, cols_c]
+    pad = (-ncalled) % 4
+    slot = np.arange(len(a)) - np.repeat(np.cumsum(ncalled)-ncalled, ncalled)
+    offset = np.repeat(np.cumsum(ncalled+pad)-(ncalled+pad), ncalled)
+    packed = np.zeros((ncalled+pad).sum(), dtype=np.uint8)
+    packed[offset+slot] = a
+    packed = packed.reshape(-1,4)
+    packed = packed[:,0] | packed[:,1]<<2 | packed[:,2]<<4 | packed[:,3]<<6
+    asplit = np.split(packed, np.cumsum((ncalled+pad)//4)[:-1])
+    res = []
+    for i in range(n):
+        h = header.pack(magic, version, flags, sid, int(ncalled[i]), int(nmissing[i]))
+        res.append(h + vsplit[i].tobytes() + asplit[i].tobytes())
+    return pd.Series(res, index=names, dtype=object)
+
+def decode_profiles(blobs, sites=None):
+    """
+    Decode profiles made with encode_profiles, all at once.
+    Args:
+        blobs: list or series of bytes
+        sites: the site set used when encoding, if any
+    Returns:
+        dataframe of samples by positions with A, C, G, T or N for missing
+        sites, sites not stored in a profile are empty
+    """
+
+    if isinstance(blobs, pd.Series):
+        names = blobs.index
+    else:
+        names = None
+    blobs = list(blobs)
+    n = len(blobs)
+    if sites is not None:
+        sites = np.unique(np.asarray(sites, dtype=np.int64))
+        sid = site_set_id(sites)
+    hs = [header.unpack_from(b) for b in blobs]
+    for h in hs:
+        if h[0] != magic or h[1] > version:
+            raise ValueError('not an encoded snp profile')
+        if h[2] & SITE_INDEX:
+            if sites is None:
+                raise ValueError('profile needs its site set to be decoded')
+            if h[3] != sid:
+                raise ValueError('profile was encoded with a different site set')
+    ncalled = np.array([h[4] for h in hs], dtype=np.int64)
+    nmissing = np.array([h[5] for h in hs], dtype=np.int64)
+    nalleles = (ncalled+3)//4
+    data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    starts = np.cumsum([0]+[len(b) for b in blobs])[:-1]
+    body = np.ones(len(data), dtype=bool)
+    for s,na,b in zip(starts, nalleles, blobs):
+        body[s:s+header.size] = False
+        body[s+len(b)-na:s+len(b)] = False
+    values = varint_decode(data[body])
+    counts = np.stack([ncalled, nmissing], 1).ravel()
+    pos = _segment_cumsum(values, counts)
+    seg = np.repeat(np.arange(2*n), counts)
+    isna = seg % 2 == 1
+    rows = seg//2
+    #unpack alleles
+    amask = np.zeros(len(data), dtype=bool)
+    for s,na,b in zip(starts, nalleles, blobs):
+        amask[s+len(b)-na:s+len(b)] = True
+    packed = data[amask]
+    a = np.stack([packed & 3, packed>>2 & 3, packed>>4 & 3, packed>>6 & 3], 1).ravel()
+    slot = np.arange(ncalled.sum()) - np.repeat(np.cumsum(ncalled)-ncalled, ncalled)
+    a = a[np.repeat(np.cumsum(4*nalleles)-4*nalleles, ncalled)+slot]
+    alleles = np.full(len(pos), 4, dtype=np.uint8)
+    alleles[~isna] = a
+    if sites is not None:
+        pos = np.where(np.repeat(np.array([h[2] & SITE_INDEX for h in hs]), ncalled+nmissing) > 0,
+                       sites[np.minimum(pos, len(sites)-1)], pos)
+    upos, pi = np.unique(pos, return_inverse=True)
+    M = np.full((n, len(upos)), None, dtype=object)
+    M[rows, pi] = bases[alleles]
+    df = pd.DataFrame(M, index=names, columns=upos, dtype=object)
+    df.columns.name = 'pos'
+    return df
+
+def encode_profile(snps, ref=None, sites=None):
+    """Encode a single profile given as a series of alleles by position"""
+
+    s = pd.Series(snps)
+    return encode_profiles(pd.DataFrame([s.values], columns=s.index.astype(np.int64)),
+                           ref, sites).iloc[0]
+
+def decode_profile(blob, sites=None):
+    """Decode a single profile to a series of alleles by position"""
+
+    return decode_profiles([blob], sites).iloc[0].dropna()
+
+def to_text(blob, sites=None):
+    """Text form of an encoded profile as written by snp_typing.encode_snps"""
+
+    from . import snp_typing
+    return snp_typing.encode_snps(decode_profile(blob, sites))
@@ -54,11 +54,12 @@ def create_rd_index(names=None):
     SeqIO.write(seqs, 'RD.fa', 'fasta')
     aligners.build_bwa_index('RD.fa')
 
-def find_regions(df, path, threads=4, callback=None):
+def find_regions(df, path, threads=4, callback=None, cram=False):
     """Align reads to regions of difference and get coverage stats.
     Args:
         df: a samples dataframe from snpgenie
         path: folder with raw reads
+        cram: store the alignments as cram files
     Returns:
         dataframe of rd results
     """
@@ -73,7 +74,10 @@ def find_regions(df, path, threads=4, callback=None):
         os.makedirs(path, exist_ok=True)
     #iterate over samples by grouping so we can get pairs if present
     for i,g in df.groupby('sample'):
-        out = os.path.join(path,i+'.bam')
+        if cram == True:
+            out = os.path.join(path,i+'.cram')
+        else:
+            out = os.path.join(path,i+'.bam')
         print (i)
         if len(g) > 1:
             f1 = g.iloc[0].filename; f2 = g.iloc[1].filename
@@ -87,7 +91,7 @@ def find_regions(df, path, threads=4, callback=None):
         #print (rg)
         avdepth = int(tmp)*2/len(rg[k])
         #print (avdepth)
-        cmd = 'samtools coverage --min-BQ 0 %s' %out
+        cmd = 'samtools coverage --min-BQ 0 --reference %s %s' %(ref,out)
         tmp = subprocess.check_output(cmd,shell=True)
         s = pd.read_csv(StringIO(tmp.decode()),sep='\t')
         s['name'] = i
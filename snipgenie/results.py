@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+    Storage of workflow result tables in binary formats.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,time,json
+import numpy as np
+import pandas as pd
+from . import tools
+
+manifest_name = 'manifest.json'
+
+#how the text outputs are read, used when no binary copy exists
+text_options = {'core.txt': {'sep':' ', 'index_col':0},
+                'snpdist.csv': {'index_col':0},
+                'csq.matrix': {'index_col':[0,1,2,3]},
+                'csq_indels.matrix': {'index_col':[0,1,2,3]},
+                'samples.csv': {},
+                'summary.csv': {}}
+
+def has_parquet():
+    """Check if a parquet engine is installed"""
+
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        return False
+
+def binary_name(filename, matrix=False):
+    """Name of the binary copy of a text output"""
+
+    stem = os.path.splitext(filename)[0]
+    if matrix == True:
+        return stem+'.npz'
+    return stem+'.parquet'
+
+def read_manifest(path):
+    """Read the manifest of outputs in a results folder"""
+
+    mfile = os.path.join(path, manifest_name)
+    if not os.path.exists(mfile):
+        return {}
+    return json.load(open(mfile))
+
+def update_manifest(path, name, entry):
+    """Add an entry to the manifest"""
+
+    m = read_manifest(path)
+    m[name] = entry
+    mfile = os.path.join(path, manifest_name)
+    tmp = mfile+'.tmp'
+    json.dump(m, open(tmp,'w'), indent=2)
+    os.replace(tmp, mfile)
+    return
+
+def save_matrix(df, filename):
+    """Save a numeric matrix with its row and column labels as a compressed npz"""
+
+    np.savez_compressed(filename, values=df.values,
+                        index=np.array([str(i) for i in df.index], dtype=str),
+                        columns=np.array([str(i) for i in df.columns], dtype=str))
+    return
+
+def load_matrix(filename):
+    """Load a matrix saved with save_matrix"""
+
+    with np.load(filename, allow_pickle=False) as f:
+        return pd.DataFrame(f['values'], index=f['index'], columns=f['columns'])
+
+def save_table(df, filename, text=True, index=True, matrix=False, **kwargs):
+    """
+    Save a results table in a binary format with an optional text copy. Tables
+    are written as parquet, or as text only if pyarrow is not installed.
+    Numeric matrices such as snp distances and sparse matrices are saved as
+    compressed npz arrays.
+    Args:
+        df: dataframe or tools.SparseMatrix
+        filename: name of the text output, e.g. outdir/core.txt
+        text: also write the text file
+        index: whether the index is part of the table
+        matrix: save as a numeric matrix
+        kwargs: passed to to_csv for the text file
+    Returns:
+        the binary file name or None
+    """
+
+    path = os.path.dirname(filename)
+    name = os.path.basename(filename)
+    sparse = isinstance(df, tools.SparseMatrix)
+    if matrix == True or sparse == True:
+        fmt = 'npz'
+    elif has_parquet():
+        fmt = 'parquet'
+    else:
+        fmt = 'text'
+    #text is written first so the binary file is newer
+    if sparse == True and text == True:
+        df.to_csv(filename)
+    elif text == True or fmt == 'text':
+        df.to_csv(filename, index=index, **kwargs)
+    elif os.path.exists(filename):
+        #remove any out of date text file
+        os.remove(filename)
+    binfile = None
+    if fmt == 'npz':
+        binfile = binary_name(filename, True)
+        if sparse == True:
+            df.save_npz(binfile)
+        else:
+            save_matrix(df, binfile)
+    elif fmt == 'parquet':
+        binfile = binary_name(filename)
+        x = df.copy()
+        x.columns = x.columns.astype(str)
+        x.to_parquet(binfile, index=index)
+    entry = {'format': fmt, 'shape': [int(i) for i in df.shape], 'created': time.time()}
+    if sparse == True:
+        entry['sparse'] = True
+    if binfile != None:
+        entry['file'] = os.path.basename(binfile)
+    if os.path.exists(filename):
+        entry['text'] = name
+    update_manifest(path, os.path.splitext(name)[0], entry)
+    return binfile
+
+def load_table(filename, sparse=False, **kwargs):
+    """
+    Load a results table using the binary copy if there is one that is
+    up to date, otherwise the text file.
+    Args:
+        filename: name of the text output, e.g. outdir/snpdist.csv
+        sparse: return sparse matrices as a tools.SparseMatrix, otherwise
+        they are converted to a dataframe
+        kwargs: read_csv options for the text file, default options are used
+        for the standard outputs
+    Returns:
+        dataframe
+    """
+
+    for binfile in [binary_name(filename, True), binary_name(filename)]:
+        if not os.path.exists(binfile):
+            continue
+        if os.path.exists(filename) and os.path.getmtime(filename) > os.path.getmtime(binfile):
+            #text file was changed after
+            break
+        if binfile.endswith('.npz'):
+            with np.load(binfile) as f:
+                is_sparse = 'indptr' in f.files
+            if is_sparse == False:
+                return load_matrix(binfile)
+            m = tools.SparseMatrix.load_npz(binfile)
+            if sparse == True:
+                return m
+            return m.to_dense()
+        if has_parquet():
+            return pd.read_parquet(binfile, memory_map=True)
+    if len(kwargs) == 0:
+        kwargs = text_options.get(os.path.basename(filename), {})
+    return pd.read_csv(filename, **kwargs)
@@ -18,19 +18,14 @@
     Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """
 
-import sys,os,subprocess,glob,shutil,re,random,time
+import sys,os,io,subprocess,glob,shutil,re,random,time
 import numpy as np
 import pandas as pd
-import pylab as plt
-import scipy.cluster.hierarchy as shc
-from sklearn.preprocessing import normalize
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio import SeqIO,AlignIO
 from Bio import Phylo
-import seaborn as sns
-import toytree
-from snipgenie import app, trees, tools
+from snipgenie import trees, tools
 
 home = os.path.expanduser("~")
 config_path = os.path.join(home,'.config','snipgenie')
@@ -64,6 +59,7 @@ def snps_to_fasta(snpmat, outfile):
 def tree_from_snps(snpmat):
     """Make tree from snp matrix"""
 
+    import toytree
     snps_to_fasta(snpmat, 'snps.fa')
     treefile = trees.run_fasttree('snps.fa')
     tre = toytree.tree(treefile)
@@ -78,8 +74,16 @@ def make_ref_snps(nucmat, clusts):
     X=nucmat.T.merge(clusts,left_index=True,right_on='SequenceName').set_index(['ClusterNumber']).T
     return X
 
-def get_clade_snps(refmat):
-    """Get unique clade SNPs from a SNP matrix
+def get_clade_snps(refmat, tolerance=0, chunksize=2000):
+    """Get unique clade SNPs from a SNP matrix. Finds for every clade at
+       once the positions where the clade has an allele that is not found
+       outside the clade.
+       Args:
+           refmat: snp matrix of positions by samples with the clade of each
+           sample as the column labels, see make_ref_snps
+           tolerance: number of isolates inside and outside the clade that
+           may disagree
+           chunksize: positions processed at once
        returns: a dataframe with unique positions/allele for each clade
        with this format
               clade      pos allele
@@ -89,28 +93,27 @@ def get_clade_snps(refmat):
            2  1124266      G
     """
 
-    res=[]
-    clusters = refmat.columns.unique()
-    for c in clusters:
-        for pos,r in list(refmat.iterrows())[:700]:
-            #print (pos)
-            a = r[c]
-            b = r[~r.index.isin([c])]
-            #print (len(r),len(a),len(b))
-            f1 = a.value_counts()
-            f2 = b.value_counts()
-            alt1 = f1.index[0]
-            if len(f1)>1:
-                continue
-            alt2 = f2.index[0]
-            if alt1 in f2:
-                continue
-            #print (f1,alt2)
-            #print (f1,f2)
-            res.append((c,pos,alt1))
-
-    res = pd.DataFrame(res,columns=['clade','pos','allele'])
-    print (res)
+    clades, cidx = np.unique(refmat.columns.values, return_inverse=True)
+    #one hot matrix of samples by clade
+    onehot = np.zeros((len(cidx), len(clades)), dtype=np.float32)
+    onehot[np.arange(len(cidx)), cidx] = 1
+    res = []
+    for i in range(0, len(refmat), chunksize):
+        codes = encode_alleles(refmat.iloc[i:i+chunksize].values)
+        #allele counts by position, clade and allele
+        counts = np.stack([(codes == a).astype(np.float32) @ onehot for a in range(4)], axis=2)
+        total = counts.sum(1)
+        called = counts.sum(2)
+        #test every allele present in the clade, with a tolerance the most
+        #common one is not always the one missing outside the clade
+        outside = total[:,None,:] - counts
+        ok = (counts > 0) & (called[:,:,None]-counts <= tolerance) & (outside <= tolerance)
+        p, k, a = np.nonzero(ok)
+        res.append(pd.DataFrame({'clade': clades[k], 'pos': refmat.index.values[i+p],
+                                 'allele': np.array(list('ACGT'))[a]}))
+    if len(res) == 0:
+        return pd.DataFrame(columns=['clade','pos','allele'])
+    res = pd.concat(res).sort_values(['clade','pos','allele']).reset_index(drop=True)
     return res
 
 def lookup_sample(snptable, snps):
@@ -121,37 +124,172 @@ def lookup_sample(snptable, snps):
         in the snp matrix produced from snipgenie
     """
 
-    found=[]
-    for i,r in snptable.iterrows():
-        if not r.pos in snps.index:
-            continue
-        if snps[r.pos] == r.allele:
-            #print (r.pos,r.allele,r.clade)
-            found.append(r.clade)
+    x = snptable[snptable.pos.isin(snps.index)]
+    found = x[snps[x.pos].values == x.allele.values].clade
     if len(found) == 0:
         return
     return set(found)
 
-def type_samples(nucmat):
+#allele codes used for typing, anything else is treated as missing
+allele_codes = np.full(256, 4, dtype=np.uint8)
+for i,b in enumerate('ACGT'):
+    allele_codes[ord(b)] = i
+    allele_codes[ord(b.lower())] = i
+
+def encode_alleles(values):
+    """Array of allele strings to codes A=0, C=1, G=2, T=3, 4 for missing"""
+
+    #only the first character is kept so None and nan become N and n,
+    #empty strings give code point zero
+    x = np.asarray(values, dtype=object).astype('U1')
+    c = np.minimum(x.view(np.uint32), 255).reshape(x.shape)
+    return allele_codes[c]
+
+def compile_clade_snps(snptable=None):
+    """
+    Compile a clade snp table into index arrays so samples can be typed in
+    one pass. Only needs to be done once per table.
+    Args:
+        snptable: dataframe with clade, pos and allele columns, default is
+        the M.bovis table
+    Returns:
+        dict of arrays
+    """
+
+    if snptable is None:
+        snptable = clade_snps
+    snptable = snptable[['clade','pos','allele']].dropna()
+    positions, pos_idx = np.unique(snptable.pos.astype(np.int64).values, return_inverse=True)
+    clades, clade_idx = np.unique(snptable.clade.values, return_inverse=True)
+    alleles = encode_alleles(snptable.allele.values)
+    #one hot matrix of snps by clade for counting
+    onehot = np.zeros((len(snptable), len(clades)), dtype=np.float32)
+    onehot[np.arange(len(snptable)), clade_idx] = 1
+    return {'positions': positions, 'pos_idx': pos_idx, 'alleles': alleles,
+            'clades': clades, 'clade_idx': clade_idx, 'onehot': onehot,
+            'sizes': onehot.sum(0).astype(int)}
+
+def positions_as_rows(df):
+    """Check if a snp matrix has positions as rows, as in core.txt"""
+
+    def numeric(x):
+        return pd.to_numeric(pd.Index(x).astype(str), errors='coerce').notna().all()
+
+    return df.index.name == 'pos' or (numeric(df.index) and not numeric(df.columns))
+
+def sample_matrix(nucmat):
+    """
+    Get a snp matrix as samples by positions. Accepts the core.txt format
+    with positions as rows and a ref column, or samples as rows.
+    """
+
+    df = nucmat
+    if 'pos' in df.columns:
+        df = df.set_index('pos')
+    if positions_as_rows(df):
+        df = df.T
+    df = df.drop(index=['ref'], errors='ignore')
+    df.columns = df.columns.astype(np.int64)
+    return df
+
+def allele_matrix(nucmat):
+    """
+    Allele codes of a snp matrix in either orientation as samples by
+    positions, without transposing the dataframe which is slow for large
+    string matrices.
+    Returns:
+        sample names, positions, array of allele codes and the ref column
+        or None
     """
-    Type multiple samples.
+
+    df = nucmat
+    if 'pos' in df.columns:
+        df = df.set_index('pos')
+    ref = None
+    if positions_as_rows(df):
+        if 'ref' in df.columns:
+            ref = df['ref']
+            df = df.drop(columns=['ref'])
+        codes = encode_alleles(df.values).T
+        names, positions = df.columns, df.index
+    else:
+        if 'ref' in df.index:
+            ref = df.loc['ref']
+            df = df.drop(index=['ref'])
+        codes = encode_alleles(df.values)
+        names, positions = df.index, df.columns
+    return names, np.asarray(positions, dtype=np.int64), codes, ref
+
+def clade_counts(nucmat, compiled=None):
+    """
+    Count matching and mismatching clade snps for every sample and clade.
+    Args:
+        nucmat: snp matrix, see sample_matrix
+        compiled: output of compile_clade_snps
+    Returns:
+        matches and mismatches dataframes of samples by clades
+    """
+
+    if compiled == None:
+        compiled = compile_clade_snps()
+    X = sample_matrix(nucmat)
+    #columns of the matrix for each clade position, missing if not present
+    cols = X.columns.get_indexer(compiled['positions'])
+    codes = np.full((len(X), len(cols)), 4, dtype=np.uint8)
+    codes[:, cols>=0] = encode_alleles(X.values[:, cols[cols>=0]])
+    calls = codes[:, compiled['pos_idx']]
+    match = (calls == compiled['alleles']).astype(np.float32)
+    called = (calls < 4).astype(np.float32)
+    m = match @ compiled['onehot']
+    mm = called @ compiled['onehot'] - m
+    clades = compiled['clades']
+    matches = pd.DataFrame(m.astype(int), index=X.index, columns=clades)
+    mismatches = pd.DataFrame(mm.astype(int), index=X.index, columns=clades)
+    return matches, mismatches
+
+def type_samples(nucmat, snptable=None, compiled=None):
+    """
+    Type multiple samples against the clade snps in one pass.
     Args:
         nucmat: a dataframe with the following format-
         pos       687  937  1303 ..
         sample1    C    A    G
         sample2    C    A    G
         ...
+        the core.txt format with positions as rows can also be used
+        snptable: clade snp table, default is the M.bovis table
+        compiled: snp table from compile_clade_snps, saves compiling it again
     Returns:
-        types for each sample
+        dataframe with the clade with most matching snps for each sample,
+        its match and mismatch counts and number of clade snps. Samples
+        with no matches have no clade.
     """
-    snptable = clade_snps
-    for name,r in nucmat.iterrows():
-        #print (r)
-        cl = lookup_sample(snptable, r)
-        print (name,cl)
+
+    if compiled == None:
+        compiled = compile_clade_snps(snptable)
+    matches, mismatches = clade_counts(nucmat, compiled)
+    m = matches.values
+    #best clade by fraction of its snps matched
+    frac = m / np.maximum(compiled['sizes'], 1)
+    best = np.argmax(frac, axis=1)
+    i = np.arange(len(m))
+    found = m[i, best] > 0
+    res = pd.DataFrame(index=matches.index)
+    res.index.name = 'sample'
+    res['clade'] = pd.Series(compiled['clades'][best], index=res.index, dtype=object).where(found)
+    res['matches'] = np.where(found, m[i, best], 0)
+    res['mismatches'] = np.where(found, mismatches.values[i, best], 0)
+    res['clade_snps'] = np.where(found, compiled['sizes'][best], 0)
+    #all clades with any matching snps
+    found = np.full(len(m), '', dtype=object)
+    for j,c in enumerate(compiled['clades']):
+        found = np.where(m[:,j] > 0, found+','+str(c), found)
+    res['found'] = pd.Series(found, index=res.index).str.lstrip(',')
+    return res
 
 def encode_snps(x):
-    """encode snps as string for storage"""
+    """encode snps as string for export, see profiles.encode_profiles for
+    the binary form used for storage"""
 
     s=[]
     for i in zip(x.index.astype(str),x.values):
@@ -173,6 +311,25 @@ def decode_snps(s):
     x.index.name='pos'
     return x
 
+def read_snp_matrix(filename):
+    """Read a snp matrix from a core.txt file or a multi sample vcf, returns
+    samples by positions. The reference alleles are kept as a 'ref' row,
+    from the ref column of core.txt or the REF field of the vcf."""
+
+    if re.search(r'\.(vcf|bcf)(\.gz)?$', filename):
+        v = tools.read_vcf_arrays(filename, fields=['GT'])
+        gtb = tools.get_genotype_bases(v['REF'], v['ALT'], v['GT'])
+        return pd.DataFrame(np.vstack([v['REF'][None,:], gtb.T]),
+                            index=['ref']+list(v['samples']), columns=v['POS'])
+    from . import results
+    df = results.load_table(filename, sep=' ', index_col=0)
+    if 'pos' in df.columns:
+        df = df.set_index('pos')
+    if positions_as_rows(df):
+        df = df.T
+    df.columns = df.columns.astype(np.int64)
+    return df
+
 def main():
     "Run the application"
 
@@ -180,8 +337,62 @@ def main():
     from argparse import ArgumentParser
     parser = ArgumentParser(description='snipgenie typing tool.')
     parser.add_argument("-i", "--input", action='append', dest="input", default=[],
-                        help="input ", metavar="FILE")
-
+                        help="snp matrix (core.txt) or multi sample vcf, can be repeated", metavar="FILE")
+    parser.add_argument("-c", "--clades", dest="clades", default=None,
+                        help="clade snps table with clade, pos and allele columns, "
+                        "default is the M.bovis table", metavar="FILE")
+    parser.add_argument("-o", "--outfile", dest="outfile", default='snp_types.csv',
+                        help="output csv file", metavar="FILE")
+    parser.add_argument("-d", "--details", dest="details", action="store_true", default=False,
+                        help="also write match and mismatch counts for every clade")
+    parser.add_argument("-n", "--nearest", dest="nearest", default=None,
+                        help="nearest isolate index, add the closest stored isolate "
+                        "to the output", metavar="FILE")
+    parser.add_argument("-b", "--build-index", dest="build_index", default=None,
+                        help="save a nearest isolate index of the input samples", metavar="FILE")
+    args = vars(parser.parse_args())
+    if len(args['input']) == 0:
+        print ('No input files provided. Use -h for help.')
+        return
+    st = time.time()
+    if args['clades'] != None:
+        snptable = pd.read_csv(args['clades'])
+    else:
+        snptable = clade_snps
+    compiled = compile_clade_snps(snptable)
+    from . import nearest
+    index = None
+    if args['nearest'] != None:
+        index = nearest.NearestIndex.load(args['nearest'])
+    res = []
+    for f in args['input']:
+        X = read_snp_matrix(f)
+        print ('typing %s samples from %s' %(len(X)-('ref' in X.index), f))
+        t = type_samples(X, compiled=compiled)
+        if index != None:
+            n = nearest.nearest_isolates(X, index)
+            t = t.join(n[~n.index.duplicated()])
+        res.append(t)
+        if args['build_index'] != None:
+            if len(res) == 1:
+                B = nearest.NearestIndex.from_matrix(X)
+            else:
+                B.add(X)
+        if args['details'] == True:
+            m, mm = clade_counts(X, compiled)
+            x = pd.concat({'matches': m.stack(), 'mismatches': mm.stack()}, axis=1)
+            x.index.names = ['sample','clade']
+            name = os.path.splitext(args['outfile'])[0]+'_counts.csv'
+            x[x.matches+x.mismatches > 0].to_csv(name, mode='a' if len(res) > 1 else 'w',
+                                                header=len(res) == 1)
+    res = pd.concat(res)
+    res.to_csv(args['outfile'])
+    print (res.clade.value_counts().to_string())
+    if args['build_index'] != None:
+        B.save(args['build_index'])
+        print ('saved index of %s isolates to %s' %(len(B), args['build_index']))
+    print ('typed %s samples in %s seconds' %(len(res), round(time.time()-st,1)))
+    return
 
 if __name__ == '__main__':
     main()
@@ -20,7 +20,7 @@
 """
 
 import sys, os, tempfile
-from . import app, tools, aligners, trees
+from . import app, tools, aligners, trees, cache, results, annotation, triage
 import unittest
 tempdir = tempfile.gettempdir()
 module_path = os.path.dirname(os.path.abspath(__file__))
@@ -44,6 +44,473 @@ class snpgenieTests(unittest.TestCase):
             W.run()
         return
 
+    def test_trim_reads(self):
+        """Built in trimming test"""
+
+        import gzip
+        infile = os.path.join(tempdir, 'trim_test.fastq.gz')
+        outfile = os.path.join(tempdir, 'trim_test_out.fastq.gz')
+        with gzip.open(infile, 'wt') as f:
+            f.write('@r1\nACGTACGT\n+\nIIIII###\n@r2\nACGT\n+\n####\n')
+        stats = tools.trim_reads_default(infile, outfile, right_quality=30, threads=1)
+        self.assertEqual(stats['reads'], 2)
+        self.assertEqual(stats['trimmed_bases'], 7)
+        lines = gzip.open(outfile, 'rt').read().split('\n')
+        self.assertEqual(lines[1], 'ACGTA')
+        self.assertEqual(lines[5], '')
+        #second file has more reads after a full batch of the first
+        import io
+        file1 = os.path.join(tempdir, 'trim_test_1.fastq')
+        file2 = os.path.join(tempdir, 'trim_test_2.fastq')
+        open(file1,'w').write('@r\nACGT\n+\nIIII\n'*2)
+        open(file2,'w').write('@r\nACGT\n+\nIIII\n'*3)
+        with self.assertRaises(ValueError):
+            tools.trim_reads_interleaved(file1, file2, io.BytesIO(), threads=1, batch_size=2)
+        return
+
+    def test_vcf_to_dataframe(self):
+        """Vcf reader test"""
+
+        vcffile = os.path.join(tempdir, 'vcf_test.vcf')
+        with open(vcffile, 'w') as f:
+            f.write('##fileformat=VCFv4.2\n')
+            f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n')
+            f.write('chr\t10\t.\tA\tG\t50\t.\t.\tGT:DP:AD\t1:12:0,12\t.:.:.\n')
+            f.write('chr\t30\t.\tCAT\tC\t20\t.\t.\tGT:PL:DP:AD\t0:0,9:8:8,0\t1:0,9:9:1,8\n')
+        df = tools.vcf_to_dataframe(vcffile)
+        self.assertEqual(len(df), 3)
+        self.assertEqual(list(df.mut), ['10A>G','32CAT','32CAT>C'])
+        self.assertEqual(list(df.DP), [12,8,9])
+        self.assertEqual(df.AD.iloc[2], [1,8])
+        self.assertEqual(list(df.sub_type), ['ts','del','del'])
+        m = tools.get_snp_matrix(df)
+        self.assertEqual(m.shape, (3,2))
+        self.assertEqual(m.column('s2').tolist(), ['32CAT>C'])
+        self.assertEqual(m.to_dense().loc['10A>G','s1'], 1)
+        df = tools.vcf_to_dataframe(vcffile, region='chr:20-40', samples=['s2'])
+        self.assertEqual(list(df.ALT), ['C'])
+        return
+
+    def test_vcfquery(self):
+        """Indexed vcf query test"""
+
+        import pysam
+        from . import vcfquery
+        vcffile = os.path.join(tempdir, 'vcfquery_test.vcf')
+        header = ['##fileformat=VCFv4.2', '##contig=<ID=chr1>', '##contig=<ID=chr2>',
+                  '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+                  '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2']
+        #enough records for several bgzf blocks
+        records = []
+        for chrom in ['chr1','chr2']:
+            for i in range(1, 6001):
+                records.append((chrom, i*7, '%s\t%s\t.\tA\tG\t50\t.\t.\tGT:DP\t%s:%s\t0:%s'
+                                %(chrom, i*7, i%2, i%50, i%40)))
+        open(vcffile,'w').write('\n'.join(header+[r[2] for r in records])+'\n')
+        for csi in [False, True]:
+            out = pysam.tabix_index(vcffile, preset='vcf', csi=csi, force=True, keep_original=True)
+            Q = vcfquery.GenotypeQuery(out)
+            self.assertEqual(Q.samples, ['s1','s2'])
+            #first record of the second bgzf block
+            prev = None
+            for line,v in Q.reader.lines(0):
+                if line.startswith('#'):
+                    continue
+                if prev != None and v >> 16 != prev >> 16:
+                    break
+                prev = v
+            p = int(line.split('\t')[1])
+            for chrom,start,end in [('chr1',p-100,p+100), ('chr2',1,500), ('chr2',41000,42100)]:
+                g = Q.genotypes('%s:%s-%s' %(chrom,start,end))
+                expected = [r[1] for r in records if r[0] == chrom and start <= r[1] <= end]
+                self.assertEqual(list(g.index), expected)
+            positions = [7, p-7, p, 41993, 41994]
+            d = Q.depths('chr1', positions=positions)
+            self.assertEqual(list(d.index), [7, p-7, p, 41993])
+            self.assertEqual(d.s1.tolist(), [1, (p//7-1)%50, (p//7)%50, 49])
+        return
+
+    def test_results_tables(self):
+        """Binary result tables test"""
+
+        import pandas as pd
+        path = os.path.join(tempdir, 'snpgenie_results')
+        os.makedirs(path, exist_ok=True)
+        dist = pd.DataFrame([[0,3],[3,0]], index=['s1','s2'], columns=['s1','s2'])
+        filename = os.path.join(path, 'snpdist.csv')
+        results.save_table(dist, filename, text=False, matrix=True)
+        self.assertFalse(os.path.exists(filename))
+        x = results.load_table(filename)
+        self.assertEqual(x.loc['s2','s1'], 3)
+        self.assertIn('snpdist', results.read_manifest(path))
+        return
+
+    def test_annotation(self):
+        """Native consequence calling test"""
+
+        from Bio import SeqIO
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from Bio.SeqFeature import SeqFeature, FeatureLocation
+        gbfile = os.path.join(tempdir, 'csq_test.gb')
+        #ATG AAA TGG TAA on + strand and its reverse complement on - strand
+        seq = 'CC'+'ATGAAATGGTAA'+'CC'+'TTACCATTTCAT'+'CC'
+        rec = SeqRecord(Seq(seq), id='chr', annotations={'molecule_type':'DNA'})
+        rec.features = [SeqFeature(FeatureLocation(2,14,strand=1), type='CDS',
+                                   qualifiers={'locus_tag':['g1'],'gene':['abc']}),
+                        SeqFeature(FeatureLocation(16,28,strand=-1), type='CDS',
+                                   qualifiers={'locus_tag':['g2']})]
+        SeqIO.write(rec, gbfile, 'genbank')
+        A = annotation.load_genbank(gbfile, path=os.path.join(tempdir, 'snpgenie_annot'))
+        self.assertEqual(list(A.overlaps(10,20).locus_tag), ['g1','g2'])
+        self.assertEqual(A.sequence(1, protein=True), 'MKW*')
+        C = annotation.CodonIndex(gbfile)
+        df = C.annotate('chr', [6,11,11,4,1,28,22], ['A','G','G','T','C','T','A'],
+                        ['G','A','C','A','A','C','AT'])
+        self.assertEqual(list(df.site), [0,1,2,3,5,6])
+        self.assertEqual(list(df.snp_type), ['missense','stop_gained','missense',
+                                             'start_lost','missense','frameshift'])
+        self.assertEqual(list(df.aa), ['2K>2E','3W>3*','3W>3C','1M>1K','1M>1V','3W'])
+        self.assertEqual(list(df.gene), ['abc','abc','abc','abc','g2','g2'])
+        self.assertEqual(df.nuc.iloc[0], '6A>G')
+        vcffile = os.path.join(tempdir, 'csq_test.vcf')
+        with open(vcffile, 'w') as f:
+            f.write('##fileformat=VCFv4.2\n')
+            f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n')
+            f.write('chr\t11\t.\tG\tA,C\t50\t.\t.\tGT\t1\t2\n')
+        csqout = os.path.join(tempdir, 'csq_test.tsv')
+        csq = annotation.csq_from_vcf(vcffile, C, csqout)
+        self.assertEqual(list(csq['sample']), ['s1','s2'])
+        self.assertEqual(list(csq.aa), ['3W>3*','3W>3C'])
+        #written in the bcftools csq field order
+        line = open(csqout).readline().rstrip().split('\t')
+        self.assertEqual(line[-1], 'stop_gained|abc|g1|protein_coding|+|3W>3*|11G>A')
+        x = app.read_csq_file(csqout)
+        self.assertEqual(list(x.strand), ['+','+'])
+        self.assertEqual(list(x.aa), list(csq.aa))
+        return
+
+    def test_triage(self):
+        """Split k-mer triage test"""
+
+        import random
+        import numpy as np
+        from Bio.Seq import Seq
+        random.seed(1)
+        seq = ''.join(random.choice('ACGT') for i in range(2000))
+        rc = str(Seq(seq).reverse_complement())
+        a = triage.split_kmers(seq.encode())
+        self.assertEqual(len(a), 2000-30)
+        self.assertTrue(np.array_equal(np.sort(a), np.sort(triage.split_kmers(rc.encode()))))
+        #two snps more than a k-mer apart
+        mut = seq[:500]+('A' if seq[500]!='A' else 'C')+seq[501:1500]+('A' if seq[1500]!='A' else 'C')+seq[1501:]
+        profiles = {}
+        for name,s in [('s1',seq),('s2',mut),('s3',rc)]:
+            fasta = os.path.join(tempdir, 'triage_%s.fa' %name)
+            open(fasta,'w').write('>%s\n%s\n' %(name,s))
+            profiles[name] = os.path.join(tempdir, 'triage_%s.npy' %name)
+            triage.build_profile([fasta], profiles[name], min_count=1)
+        dist = triage.snp_distances(triage.variable_sites(profiles))
+        self.assertEqual(dist.loc['s1','s2'], 2)
+        self.assertEqual(dist.loc['s1','s3'], 0)
+        near = triage.nearest(dist, known=['s1'])
+        self.assertEqual(list(near.nearest), ['s1','s1'])
+        empty = np.array([], dtype=np.uint64)
+        self.assertEqual(len(triage.filter_counts(empty, np.array([], dtype=np.int64))), 0)
+        return
+
+    def test_snp_typing(self):
+        """SNP typing test"""
+
+        import pandas as pd
+        from . import snp_typing
+        snptable = pd.DataFrame({'clade':[1,1,2,2], 'pos':[10,20,30,40],
+                                 'allele':['A','C','G','T']})
+        nucmat = pd.DataFrame({'pos':[10,20,30,40], 'ref':['G','G','A','A'],
+                               's1':['A','C','A','A'], 's2':['A','G','G','T'],
+                               's3':['G','G','A','A']})
+        res = snp_typing.type_samples(nucmat, snptable)
+        self.assertEqual(list(res.clade.fillna(0)), [1,2,0])
+        self.assertEqual(list(res.matches), [2,2,0])
+        self.assertEqual(list(res.mismatches), [0,0,0])
+        self.assertEqual(list(res.found), ['1','1,2',''])
+        m, mm = snp_typing.clade_counts(nucmat, snp_typing.compile_clade_snps(snptable))
+        self.assertEqual(mm.loc['s2',1], 1)
+        #clade snps with one discordant isolate allowed
+        refmat = pd.DataFrame([['A','A','G','G'],['A','C','G','G'],['T','T','T','G']],
+                              index=[5,6,7], columns=[1,1,2,2])
+        x = snp_typing.get_clade_snps(refmat)
+        self.assertEqual(list(x.pos), [5,5,6])
+        x = snp_typing.get_clade_snps(refmat, tolerance=1)
+        self.assertEqual(list(zip(x.clade,x.pos,x.allele)),
+                         [(1,5,'A'),(1,6,'A'),(1,6,'C'),(1,7,'T'),(2,5,'G'),(2,6,'G'),(2,7,'G')])
+        #the minority allele of a clade can still be unique to it
+        refmat = pd.DataFrame([['A','G','A','A']], index=[5], columns=[2,2,1,1])
+        x = snp_typing.get_clade_snps(refmat, tolerance=1)
+        self.assertIn((2,5,'G'), list(zip(x.clade,x.pos,x.allele)))
+        return
+
+    def test_nearest(self):
+        """Nearest isolate index test"""
+
+        import pandas as pd
+        from . import nearest
+        nucmat = pd.DataFrame({'pos':[10,20,30,40], 'ref':['G','G','A','A'],
+                               's1':['A','C','A','A'], 's2':['A','G','G','T'],
+                               's3':['G','G','A','A']})
+        N = nearest.NearestIndex.from_matrix(nucmat, npivots=2)
+        q = pd.Series(['A','C','A','T'], index=[10,20,30,40])
+        r = N.knn(q, k=2)
+        self.assertEqual(list(r.name), ['s1','s2'])
+        self.assertEqual(list(r.distance), [1,2])
+        self.assertEqual(list(N.within('10A;20C;50T', 1).name), ['s1'])
+        filename = os.path.join(tempdir, 'nearest.npz')
+        N.save(filename)
+        N = nearest.NearestIndex.load(filename)
+        N.add(pd.DataFrame([['A','C','A','T']], index=['s4'], columns=[10,20,30,40]))
+        self.assertEqual(list(N.knn(q, k=1).name), ['s4'])
+        #new positions need the reference alleles
+        self.assertRaises(ValueError, N.add, pd.DataFrame([['A','C']], index=['s5'], columns=[10,50]))
+        #the ref column is kept when reading a core.txt file
+        from . import snp_typing
+        corefile = os.path.join(tempdir, 'nearest_core.txt')
+        nucmat.set_index('pos').to_csv(corefile, sep=' ')
+        X = snp_typing.read_snp_matrix(corefile)
+        self.assertEqual(list(X.loc['ref']), ['G','G','A','A'])
+        N = nearest.NearestIndex.from_matrix(X, npivots=2)
+        self.assertEqual(list(N.knn(q, k=2).distance), [1,2])
+        return
+
+    def test_profiles(self):
+        """SNP profile encoding test"""
+
+        import pandas as pd
+        from . import profiles
+        X = pd.DataFrame([['A','C',None,'T'],['G','N','T','T'],['G','G','G','T']],
+                         index=['s1','s2','s3'], columns=[100,20,30000,5])
+        ref = pd.Series(['G','G','G','T'], index=[100,20,30000,5])
+        b = profiles.encode_profiles(X, ref=ref)
+        D = profiles.decode_profiles(b)
+        self.assertEqual(list(D.columns), [20,100,30000])
+        self.assertEqual(list(D.loc['s1']), ['C','A','N'])
+        self.assertEqual(list(D.loc['s2'].fillna('')), ['N','','T'])
+        self.assertEqual(D.loc['s3'].isnull().sum(), 3)
+        sites = [5,20,100,30000,40000]
+        b = profiles.encode_profiles(X, ref=ref, sites=sites)
+        self.assertTrue(profiles.decode_profiles(b, sites).equals(D))
+        self.assertRaises(ValueError, profiles.decode_profiles, b)
+        self.assertEqual(profiles.to_text(b['s1'], sites), '20C;100A;30000N')
+        return
+
+    def test_database(self):
+        """Isolate database test"""
+
+        import pandas as pd
+        from . import database
+        path = os.path.join(tempdir, 'db_results')
+        os.makedirs(path, exist_ok=True)
+        core = pd.DataFrame({'ref':['G','G','A'], 's1':['A','G','A'], 's2':['G','T','A']},
+                            index=pd.Index([10,20,30], name='pos'))
+        core.to_csv(os.path.join(path, 'core.txt'), sep=' ')
+        samples = pd.DataFrame({'sample':['s1','s1','s2'], 'filename':['a','b','c'],
+                                'mean_depth':[30,30,45]})
+        samples.to_csv(os.path.join(path, 'samples.csv'), index=False)
+        pd.DataFrame({'clade':[5,None]}, index=pd.Index(['s1','s2'], name='sample')).to_csv(
+                            os.path.join(path, 'snp_types.csv'))
+        filename = os.path.join(tempdir, 'isolates.sqlite')
+        if os.path.exists(filename):
+            os.remove(filename)
+        D = database.Database(filename)
+        run_id = D.ingest_results(path)
+        self.assertEqual(list(D.isolates(clade=5).name), ['s1'])
+        self.assertEqual(list(D.isolates().run_id), [run_id, run_id])
+        self.assertEqual(D.metadata(['mean_depth']).loc['s2','mean_depth'], '45')
+        X = D.get_profiles()
+        self.assertEqual(list(X.loc['s2']), ['G','T','A'])
+        #adding again updates the isolates
+        run_id = D.ingest_results(path)
+        self.assertEqual(len(D.isolates()), 2)
+        self.assertEqual(list(D.isolates().run_id), [run_id, run_id])
+        #metadata without a run keeps the run of the isolate
+        D.add_metadata(pd.DataFrame({'site':['x']}, index=['s1']))
+        self.assertEqual(D.isolates().set_index('name').loc['s1','run_id'], run_id)
+        D.close()
+        return
+
+    def test_clustering(self):
+        """SNP address clustering test"""
+
+        import pandas as pd
+        from . import clustering, snp_typing
+        X = pd.DataFrame([list('AAAAAA'),list('AAAAAC'),list('CCCAAA'),list('CAAAAA')],
+                         index=['s1','s2','s3','s4'], columns=[1,2,3,4,5,6])
+        X.loc['ref'] = list('AAAAAA')
+        C = clustering.SNPClusters.from_matrix(X.loc[['s1','s3','ref']], thresholds=[0,1,2])
+        self.assertEqual(list(C.table().address), ['1.1.1','2.2.2'])
+        #s4 links s1 and s3 at 2 snps so their clusters are merged
+        new = C.add(X.loc[['s2','s4','ref']])
+        self.assertEqual(list(new.address), ['1.1.3','1.1.4'])
+        self.assertEqual(C.table().loc['s3','address'], '1.2.2')
+        self.assertEqual(list(C.merges.iloc[0]), [2,2,1,2])
+        filename = os.path.join(tempdir, 'clusters.npz')
+        C.save(filename)
+        C = clustering.SNPClusters.load(filename)
+        self.assertEqual(list(C.table().t2), [1,1,1,1])
+        self.assertEqual(len(C.add(X.loc[['s1','ref']])), 0)
+        self.assertRaises(ValueError, C.add, X.loc[['s1']])
+        #batches read from core.txt files keep their reference alleles
+        batches = []
+        for i,s in enumerate([['s3'],['s1','s2','s4']]):
+            batches.append(os.path.join(tempdir, 'cluster_core%s.txt' %i))
+            X.loc[['ref']+s].T.to_csv(batches[-1], sep=' ', index_label='pos')
+        C = clustering.SNPClusters([0,1,2])
+        for f in batches:
+            C.add(snp_typing.read_snp_matrix(f))
+        self.assertEqual(list(C.table().address), ['1.1.1','1.2.2','1.2.3','1.2.4'])
+        return
+
+    def test_panel(self):
+        """Panel genotyping test"""
+
+        import pandas as pd
+        from . import panel, nearest
+        snptable = pd.DataFrame({'clade':[1,1,2], 'pos':[10,20,30], 'allele':['A','C','G']})
+        core = pd.DataFrame({'ref':['G','G'], 's1':['A','G'], 's2':['G','T']},
+                            index=pd.Index([20,40], name='pos'))
+        p = panel.make_panel('chr', snptable, core)
+        self.assertEqual(list(p.pos), [10,20,30,40])
+        vcf = os.path.join(tempdir, 'panel.vcf')
+        lines = ['##fileformat=VCFv4.2',
+                 '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tx.bam',
+                 'chr\t10\t.\tG\tA\t50\t.\t.\tGT:DP\t1:20',
+                 'chr\t20\t.\tG\t.\t50\t.\t.\tGT:DP\t0:15',
+                 'chr\t30\t.\tA\tG\t50\t.\t.\tGT:DP\t1:2',
+                 'chr\t40\t.\tG\tT\t50\t.\t.\tGT:DP\t1:30']
+        open(vcf,'w').write('\n'.join(lines)+'\n')
+        calls = panel.read_panel_calls(vcf)
+        self.assertEqual(list(calls), ['A','G','N','T'])
+        index = nearest.NearestIndex.from_matrix(core)
+        r = panel.type_calls(calls, index=index, snptable=snptable)
+        self.assertEqual(r.matches, 1)
+        self.assertEqual(r.nearest.split(',')[0], 's2')
+        return
+
+    def test_placement(self):
+        """Tree placement test"""
+
+        import pandas as pd
+        import shutil
+        from Bio import Phylo
+        from . import trees
+        core = pd.DataFrame({'ref':['A','A','A','A'], 's1':['C','C','A','A'],
+                             's2':['C','C','G','A'], 's3':['A','A','A','T'],
+                             's4':['A','A','A','A']}, index=pd.Index([1,2,3,4], name='pos'))
+        treefile = os.path.join(tempdir, 'place.newick')
+        open(treefile,'w').write('((s1:1,s2:1):2,(s3:1,s4:1):1);')
+        new = pd.DataFrame({'ref':['A','A','A'], 's5':['C','C','G']}, index=pd.Index([1,2,3], name='pos'))
+        tree, res, rebuild = trees.place_samples(treefile, core, new)
+        self.assertEqual(res.cost[0], 0)
+        self.assertEqual(res.edge[0], 's2')
+        self.assertEqual(len(tree.get_terminals()), 5)
+        self.assertFalse(rebuild)
+        tree, res, rebuild = trees.place_samples(treefile, core, new, max_new=0.1)
+        self.assertTrue(rebuild)
+        #placed samples are kept with the tree for a second update
+        outdir = os.path.join(tempdir, 'place_update')
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        out = trees.update_tree(treefile, core, new, outdir, max_new=1)
+        new2 = pd.DataFrame({'ref':['A','A','A','A'], 's6':['C','C','G','T']},
+                            index=pd.Index([1,2,3,4], name='pos'))
+        out = trees.update_tree(out, core, new2, outdir, max_new=1)
+        tree = Phylo.read(out, 'newick')
+        self.assertEqual(len(tree.get_terminals()), 6)
+        stored = pd.read_csv(out+'.core.txt', sep=' ', index_col=0)
+        self.assertEqual(list(stored.columns), ['ref','s1','s2','s3','s4','s5','s6'])
+        self.assertEqual(list(stored.s5), ['C','C','G','A'])
+        self.assertEqual(list(pd.read_csv(out+'.placements.csv')['sample']), ['s5','s6'])
+        return
+
+    def test_nj_tree(self):
+        """Neighbour joining tree test"""
+
+        from Bio import Phylo
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        seqs = {'s1':'AAAAAA', 's2':'AAAAAC', 's3':'CCAAAA', 's4':'CCGAAA', 's5':'AAAAAN'}
+        aln = MultipleSeqAlignment([SeqRecord(Seq(seqs[i]), id=i) for i in seqs])
+        dist = tools.snp_dist_matrix(aln)
+        self.assertEqual(dist.loc['s1','s4'], 3)
+        self.assertEqual(dist.loc['s2','s5'], 1)
+        dist = dist.drop(index='s5', columns='s5')
+        for method in ['nj','bionj']:
+            outfile = os.path.join(tempdir, 'nj.newick')
+            trees.nj_tree(dist, outfile, method=method)
+            t = Phylo.read(outfile, 'newick')
+            self.assertEqual(len(t.get_terminals()), 4)
+            #distances are additive so the tree fits them exactly
+            self.assertAlmostEqual(t.distance('s1','s4'), 3)
+            self.assertAlmostEqual(t.distance('s3','s4'), 1)
+        return
+
+    def test_bootstrap(self):
+        """Bootstrap tree test"""
+
+        import shutil
+        from Bio import Phylo, SeqIO
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        path = os.path.join(tempdir, 'snpgenie_bootstrap')
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        seqs = {'s1':'AAAAAAAA', 's2':'AAAAAAAC', 's3':'CCCCAAAA', 's4':'CCCCAAAG', 's5':'CCCCGAAA'}
+        infile = os.path.join(path, 'core.fa')
+        SeqIO.write([SeqRecord(Seq(seqs[i]), id=i) for i in seqs], infile, 'fasta')
+        outfile = trees.bootstrap_tree(infile, path, 'nj', bootstraps=10, threads=1, seed=1)
+        t = Phylo.read(outfile, 'newick')
+        conf = [c.confidence for c in t.find_clades(terminal=False) if c.confidence != None]
+        self.assertIn(100, conf)
+        #removed replicates are remade the same way
+        os.remove(os.path.join(path, 'bootstrap', 'rep_3.newick'))
+        trees.bootstrap_tree(infile, path, 'nj', bootstraps=10, threads=1)
+        t = Phylo.read(outfile, 'newick')
+        self.assertEqual(conf, [c.confidence for c in t.find_clades(terminal=False)
+                                if c.confidence != None])
+        #replicates of a changed alignment are not reused
+        del seqs['s5']
+        SeqIO.write([SeqRecord(Seq(seqs[i]), id=i) for i in seqs], infile, 'fasta')
+        trees.bootstrap_tree(infile, path, 'nj', bootstraps=10, threads=1)
+        t = Phylo.read(outfile, 'newick')
+        self.assertEqual(sorted(c.name for c in t.get_terminals()), ['s1','s2','s3','s4'])
+        return
+
+    def test_alignment_cache(self):
+        """Alignment cache test"""
+
+        import shutil
+        path = os.path.join(tempdir, 'snpgenie_cache')
+        shutil.rmtree(path, ignore_errors=True)
+        C = cache.AlignmentCache(path, max_size=15)
+        fq = os.path.join(tempdir, 'cache_test.fastq')
+        ref = os.path.join(tempdir, 'cache_test.fa')
+        open(fq,'w').write('@r1\nACGT\n+\nIIII\n')
+        open(ref,'w').write('>chr\nACGTACGT\n')
+        key = C.key([fq,None], ref, 'bwa', trim=False)
+        self.assertNotEqual(key, C.key([fq,None], ref, 'bwa', trim=True))
+        bam = os.path.join(tempdir, 'cache_test.bam')
+        open(bam,'w').write('x'*10)
+        C.put(key, bam)
+        out = os.path.join(tempdir, 'cache_test_out.bam')
+        self.assertTrue(C.get(key, out))
+        self.assertEqual(open(out).read(), 'x'*10)
+        #least recently used entry is evicted
+        key2 = C.key([fq,None], ref, 'bowtie')
+        C.put(key2, bam)
+        self.assertFalse(C.get(key, out))
+        self.assertEqual(len(C.entries()), 1)
+        return
 
 if __name__ == '__main__':
     unittest.main()
@@ -132,22 +132,46 @@ def diffseqs(seq1,seq2):
             c+=1
     return c
 
-def snp_dist_matrix(aln):
+def alignment_array(aln):
+    """Names and a uint8 array of the characters of an alignment"""
+
+    names = [s.id for s in aln]
+    A = np.array([np.frombuffer(str(s.seq).upper().encode(), dtype=np.uint8) for s in aln])
+    return names, A
+
+def snp_dist_array(A, weights=None, block=2000):
+    """
+    Pairwise differences between the rows of a character array. Matching
+    characters are counted with matrix products of one-hot encodings, in
+    blocks of sites.
+    Args:
+        A: uint8 array of sequences by sites, see alignment_array
+        weights: optional count of each site, e.g. for bootstrap replicates
+    Returns:
+        int64 array
+    """
+
+    n, m = A.shape
+    same = np.zeros((n,n), dtype=np.float64)
+    for i in range(0, m, block):
+        X = A[:,i:i+block]
+        for c in np.unique(X):
+            h = (X == c).astype(np.float32)
+            if weights is not None:
+                same += (h*np.asarray(weights[i:i+block], dtype=np.float32)) @ h.T
+            else:
+                same += h @ h.T
+    total = m if weights is None else np.sum(weights)
+    return np.round(total - same).astype(np.int64)
+
+def snp_dist_matrix(aln, block=2000):
     """Get pairwise snps distances from biopython
        Multiple Sequence Alignment object.
        returns: pandas dataframe
     """
 
-    names=[s.id for s in aln]
-    m = []
-    for i in aln:
-        x=[]
-        for j in aln:
-            d = diffseqs(i,j)
-            x.append(d)
-        #print (x)
-        m.append(x)
-    m = pd.DataFrame(m,index=names,columns=names)
+    names, A = alignment_array(aln)
+    m = pd.DataFrame(snp_dist_array(A, block=block), index=names, columns=names)
     return m
 
 def get_fasta_length(filename):
@@ -415,12 +439,16 @@ def records_to_dataframe(records, cds=False, nucl_seq=False):
                'in the translation qualifier of each protein feature.' )
     return pd.concat(res)
 
-def genbank_to_dataframe(infile, cds=False):
+def genbank_to_dataframe(infile, cds=False, nucl_seq=True):
     """Get genome records from a genbank file into a dataframe
-      returns a dataframe with a row for each cds/entry"""
-
-    recs = list(SeqIO.parse(infile,'genbank'))
-    df = records_to_dataframe(recs, cds, nucl_seq=True)
+      returns a dataframe with a row for each cds/entry. The file is only
+      parsed once, see annotation.load_genbank"""
+
+    from . import annotation
+    A = annotation.load_genbank(infile)
+    df = A.to_dataframe(nucl_seq)
+    if cds == True:
+        df = df[df.feat_type=='CDS']
     return df
 
 def gff_to_records(gff_file):
@@ -469,32 +497,309 @@ def features_summary(df):
 
     return s
 
-def trim_reads_default(filename,  outfile, right_quality=35):
-    """Trim adapters - built in method"""
+class GzipWriter(object):
+    """
+    Buffered gzip writer that compresses blocks in a thread pool.
+    Each block is written as a separate gzip member, which standard
+    tools such as zcat, bwa and cutadapt read as one stream.
+    """
+    def __init__(self, filename, threads=4, level=4, blocksize=4*1024**2):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        self.handle = open(filename, 'wb')
+        self.level = level
+        self.blocksize = blocksize
+        self.threads = max(int(threads),1)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+        return
 
-    #trimmed = []
-    fastq_parser = SeqIO.parse(gzopen(filename, "rt"), "fastq")
-    c=0
-    out = gzopen(outfile, "wt")
-    for record in fastq_parser:
-        score = record.letter_annotations["phred_quality"]
-        for i in range(len(score)-1,0,-1):
-            if score[i] >= right_quality:
-                break
-        #trimmed.append(record[:i])
+    def __enter__(self):
+        return self
 
-        SeqIO.write(record[:i],out,'fastq')
-    return
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            self._submit()
+        return
+
+    def _submit(self):
+        import gzip
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.pending.append(self.pool.submit(gzip.compress, data, self.level))
+        #keep a bounded number of blocks in memory, written in order
+        while len(self.pending) > self.threads*2:
+            self.handle.write(self.pending.popleft().result())
+        return
+
+    def close(self):
+        if self.handle is None:
+            return
+        if self.size > 0:
+            self._submit()
+        while len(self.pending) > 0:
+            self.handle.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.handle.close()
+        self.handle = None
+        return
+
+def open_fastq(filename):
+    """Open a plain or gzipped fastq file for reading raw lines"""
+
+    import io
+    if os.path.splitext(filename)[1] == '.gz':
+        return io.BufferedReader(gzopen(filename, 'rb'), buffer_size=1024**2)
+    return open(filename, 'rb', buffering=1024**2)
+
+def trim_batch(lines, quality=20, join=True):
+    """
+    Right trim a batch of raw fastq lines on base quality. Each read is cut
+    after the last base with phred score >= quality.
+    Args:
+        lines: list of fastq lines as bytes, 4 per read
+        quality: phred quality threshold
+        join: return the reads joined as one bytes object, otherwise a list
+        with one item per read
+    Returns:
+        trimmed reads, number of reads, input bases, output bases
+    """
+
+    quals = lines[3::4]
+    n = len(quals)
+    if n == 0:
+        return b'', 0, 0, 0
+    #newlines are kept so that every read has a non-empty segment
+    lengths = np.fromiter(map(len, quals), dtype=np.int64, count=n)
+    offsets = np.zeros(n, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    buf = np.frombuffer(b''.join(quals), dtype=np.uint8)
+    #newline is below the phred offset so never passes
+    idx = np.where(buf >= quality+33, np.arange(len(buf)), -1)
+    last = np.maximum.reduceat(idx, offsets)
+    keep = np.where(last >= offsets, last-offsets+1, 0)
+    bases = int(lengths.sum()) - n
+    if join == False:
+        out = [b''.join((h, s[:k], b'\n+\n', q[:k], b'\n'))
+                for h,s,q,k in zip(lines[0::4], lines[1::4], quals, keep.tolist())]
+        return out, n, bases, int(keep.sum())
+    out = []
+    for h,s,q,k in zip(lines[0::4], lines[1::4], quals, keep.tolist()):
+        out.extend((h, s[:k], b'\n+\n', q[:k], b'\n'))
+    return b''.join(out), n, bases, int(keep.sum())
+
+def trim_pair_batch(lines1, lines2, quality=20):
+    """Trim a batch of paired reads and interleave the mates.
+    If lines2 is None the single end reads are returned as is."""
+
+    if lines2 is None:
+        return trim_batch(lines1, quality)
+    r1,n1,b1,k1 = trim_batch(lines1, quality, join=False)
+    r2,n2,b2,k2 = trim_batch(lines2, quality, join=False)
+    if n1 != n2:
+        raise ValueError('paired files have different numbers of reads')
+    data = b''.join([r for pair in zip(r1,r2) for r in pair])
+    return data, n1+n2, b1+b2, k1+k2
+
+def ordered_map(func, iterable, pool=None, queue=8):
+    """
+    Apply func to each item of iterable in a process pool, yielding results in
+    input order. Unlike Pool.imap only queue items are held in memory at once.
+    """
+
+    from collections import deque
+    if pool == None:
+        for args in iterable:
+            yield func(*args)
+        return
+    pending = deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= queue:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def trim_reads_default(filename, outfile, right_quality=35, threads=4, batch_size=50000):
+    """
+    Trim reads on quality - built in method. Works on batches of raw fastq
+    lines which are trimmed in worker processes and written through a
+    threaded gzip compressor.
+    Args:
+        filename: input fastq(.gz) file
+        outfile: gzipped output file
+        right_quality: phred quality threshold for right trimming
+        threads: worker processes used for trimming and compression
+        batch_size: reads per batch
+    Returns:
+        dict with trimming stats
+    """
+
+    threads = int(threads)
+    right_quality = int(right_quality)
+    stats = {'reads':0, 'bases':0, 'trimmed_bases':0}
+    handle = open_fastq(filename)
+    batches = ((b, right_quality) for b in batch_iterator(iter(handle), batch_size*4))
+    pool = None
+    if threads > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(threads)
+    results = ordered_map(trim_batch, batches, pool, queue=threads*2)
+    with GzipWriter(outfile, threads=threads) as out:
+        for data,n,b,k in results:
+            out.write(data)
+            stats['reads'] += n
+            stats['bases'] += b
+            stats['trimmed_bases'] += b-k
+    if pool != None:
+        pool.close()
+        pool.join()
+    handle.close()
+    return stats
+
+def paired_batches(b1, b2, quality):
+    """Pairs of batches from two fastq files for trim_pair_batch, raises an
+    error if one file runs out before the other"""
+
+    from itertools import zip_longest
+    for x,y in zip_longest(b1, b2):
+        if x is None or y is None:
+            raise ValueError('paired files have different numbers of reads')
+        yield x, y, quality
+
+def trim_reads_interleaved(file1, file2, out, quality=20, threads=4, batch_size=50000):
+    """
+    Trim paired files with the built in method and write them as one
+    interleaved uncompressed fastq stream, e.g. to the stdin of an aligner.
+    Args:
+        file1, file2: fastq files, file2 can be None for single end reads
+        out: open binary file handle
+        quality: phred quality threshold for right trimming
+        threads: worker processes used for trimming
+    Returns:
+        dict with trimming stats
+    """
+
+    threads = int(threads)
+    quality = int(quality)
+    stats = {'reads':0, 'bases':0, 'trimmed_bases':0}
+    h1 = open_fastq(file1)
+    b1 = batch_iterator(iter(h1), batch_size*4)
+    if file2 != None:
+        h2 = open_fastq(file2)
+        b2 = batch_iterator(iter(h2), batch_size*4)
+        batches = paired_batches(b1, b2, quality)
+    else:
+        h2 = None
+        batches = ((x, None, quality) for x in b1)
+    pool = None
+    if threads > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(threads)
+    try:
+        for data,n,b,k in ordered_map(trim_pair_batch, batches, pool, queue=threads*2):
+            out.write(data)
+            stats['reads'] += n
+            stats['bases'] += b
+            stats['trimmed_bases'] += b-k
+    finally:
+        if pool != None:
+            pool.terminate()
+        h1.close()
+        if h2 != None:
+            h2.close()
+    return stats
+
+def downsample_reads(file1, file2, out1, out2, ref_length, depth=60, seed=None,
+                     threads=4, batch_size=50000):
+    """
+    Downsample reads to a target depth by reservoir sampling read pairs in
+    one streaming pass. The depth is estimated as number of reads x mean read
+    length / reference length. Sampled reads are held in memory so this scales
+    with the target depth, not the input size.
+    Args:
+        file1, file2: fastq files, file2 can be None for single end reads
+        out1, out2: gzipped output files, only written if reads are removed
+        ref_length: length of reference genome
+        depth: target depth
+        seed: random seed
+    Returns:
+        dict with estimated input depth, fraction of reads kept and number of
+        reads per file
+    """
+
+    rng = np.random.default_rng(seed)
+    h1 = open_fastq(file1)
+    b1 = batch_iterator(iter(h1), batch_size*4)
+    if file2 != None:
+        h2 = open_fastq(file2)
+        batches = zip(b1, batch_iterator(iter(h2), batch_size*4))
+    else:
+        h2 = None
+        batches = ((x, None) for x in b1)
+    k = None
+    n = 0
+    bases = 0
+    reservoir = []
+    for x,y in batches:
+        b = len(x)//4
+        blen = sum(map(len, x[1::4])) - b
+        if y != None:
+            blen += sum(map(len, y[1::4])) - b
+        bases += blen
+        if k == None:
+            #reservoir size from mean read length of first batch
+            k = max(int(depth*ref_length/(blen/b)), 1)
+        def record(i):
+            r = (b''.join(x[i*4:i*4+4]),)
+            if y != None:
+                r += (b''.join(y[i*4:i*4+4]),)
+            return r
+        #fill reservoir
+        i = 0
+        while len(reservoir) < k and i < b:
+            reservoir.append(record(i))
+            i += 1
+        #replace items with decreasing probability
+        if i < b:
+            idx = np.arange(n+i, n+b)
+            j = (rng.random(len(idx))*(idx+1)).astype(np.int64)
+            for h in np.nonzero(j < k)[0]:
+                reservoir[j[h]] = record(i+h)
+        n += b
+    h1.close()
+    if h2 != None:
+        h2.close()
+    est = round(bases/ref_length, 2)
+    if n <= k:
+        return {'depth':est, 'fraction':1.0, 'reads':n}
+    outs = [GzipWriter(out1, threads=threads)]
+    if file2 != None:
+        outs.append(GzipWriter(out2, threads=threads))
+    for r in reservoir:
+        for o,rec in zip(outs, r):
+            o.write(rec)
+    for o in outs:
+        o.close()
+    return {'depth':est, 'fraction':round(k/n,4), 'reads':n}
 
 def trim_reads(filename, outfile, adapter=None, quality=20,
                 method='cutadapt', threads=4):
-    """Trim adapters using cutadapt"""
+    """Trim adapters using cutadapt or quality trim with the built in method"""
 
     #if adapter is not None and not type(adapter) is str:
     #    print ('not valid adapter')
     #    return
     if method == 'default':
-        trim_reads_default(filename,  outfile, right_quality=quality)
+        trim_reads_default(filename, outfile, right_quality=quality, threads=threads)
     elif method == 'cutadapt':
         if adapter != None:
             cmd = 'cutadapt -O 5 -q {q} -a {a} -j {t} {i} -o {o}'.format(a=adapter,i=filename,o=outfile,t=threads,q=quality)
@@ -504,58 +809,442 @@ def trim_reads(filename, outfile, adapter=None, quality=20,
         result = subprocess.check_output(cmd, shell=True, executable='/bin/bash')
     return
 
-def vcf_to_dataframe(vcf_file):
+def parse_region(region):
+    """Split a region string chrom:start-end into parts, start and end may be omitted"""
+
+    if region == None:
+        return None, None, None
+    if ':' not in region:
+        return region, None, None
+    chrom, r = region.rsplit(':',1)
+    r = r.replace(',','').split('-')
+    start = int(r[0])
+    end = int(r[1]) if len(r)>1 and r[1] != '' else None
+    return chrom, start, end
+
+def read_vcf_header(file):
+    """Read the header lines of an open vcf file, leaving the file at the
+    first record. Returns the column names."""
+
+    for line in file:
+        if line.startswith('#CHROM'):
+            return line[1:].rstrip('\n').split('\t')
+    return []
+
+def _split_format(values, keys, fields, nalleles):
+    """Split sample FORMAT strings sharing the same keys into arrays for each
+    required field. Number=R fields are returned as (n, nalleles) arrays and
+    other fields apart from GT are assumed numeric. The strings are joined and
+    split with the C csv parser which is much faster than splitting each one."""
+
+    from io import StringIO
+    import csv
+    def parse(x, sep, ncols, **kwargs):
+        return pd.read_csv(StringIO('\n'.join(x)), sep=sep, header=None, names=range(ncols),
+                           na_values=['.',''], keep_default_na=False,
+                           quoting=csv.QUOTE_NONE, skip_blank_lines=False, **kwargs)
+    use = [keys.index(f) for f in fields if f in keys]
+    dtypes = {}
+    for i in use:
+        if keys[i] in ['GT','AD','ADF','ADR']:
+            dtypes[i] = object
+        else:
+            dtypes[i] = float
+    parts = parse(values, ':', len(keys), usecols=use, dtype=dtypes)
+    res = {}
+    for f in fields:
+        if f not in keys:
+            res[f] = None
+            continue
+        col = parts[keys.index(f)]
+        if f == 'GT':
+            res[f] = col.fillna('.').to_numpy(dtype=object)
+        elif f in ['AD','ADF','ADR']:
+            x = parse(col.fillna('.').to_numpy(dtype=object), ',', nalleles, dtype=float)
+            res[f] = x.fillna(-1).values.astype(np.int32)
+        else:
+            res[f] = col.values
+    return res
+
+def read_vcf_arrays(vcf_file, fields=['GT','DP','AD','ADF','ADR'], region=None,
+                    samples=None, chunksize=50000):
+    """
+    Read a multi sample vcf into numpy arrays without building per record
+    objects. The file is read in chunks and FORMAT fields are found by name.
+    Args:
+        vcf_file: vcf or bgzipped vcf file
+        fields: FORMAT fields to read
+        region: only sites in this region, e.g. chrom or chrom:start-end
+        samples: only read these samples
+        chunksize: number of records read at a time
+    Returns:
+        dict with site arrays CHROM, POS, REF, ALT, QUAL, the list of samples
+        and an (n_sites, n_samples) array for each field. GT is kept as strings,
+        Number=R fields such as AD are (n_sites, n_samples, n_alleles) arrays
+        padded with -1.
+    """
+
+    if os.path.splitext(vcf_file)[1] == '.gz':
+        file = gzopen(vcf_file, 'rt')
+    else:
+        file = open(vcf_file)
+    cols = read_vcf_header(file)
+    allsamples = cols[9:]
+    if samples == None:
+        samples = allsamples
+    else:
+        samples = [s for s in allsamples if s in samples]
+    usecols = ['CHROM','POS','REF','ALT','QUAL'] + (['FORMAT'] + samples if len(samples)>0 else [])
+    chrom, start, end = parse_region(region)
+    reader = pd.read_csv(file, sep='\t', header=None, names=cols, usecols=usecols,
+                         dtype=str, na_filter=False, chunksize=chunksize)
+    parts = []
+    for chunk in reader:
+        if chrom != None:
+            pos = chunk.POS.values.astype(np.int64)
+            keep = (chunk.CHROM.values == chrom)
+            if start != None:
+                keep &= (pos >= start)
+            if end != None:
+                keep &= (pos <= end)
+            chunk = chunk[keep]
+        if len(chunk) == 0:
+            continue
+        parts.append(vcf_chunk_arrays(chunk, samples, fields))
+    file.close()
+    return concat_vcf_arrays(parts, samples, fields)
+
+def vcf_chunk_arrays(chunk, samples, fields):
+    """
+    Convert a block of vcf records to arrays, see read_vcf_arrays.
+    Args:
+        chunk: dataframe of vcf lines read as strings with the header column names
+        samples: samples to use
+        fields: FORMAT fields to read
+    """
+
+    res = {'samples': samples}
+    res['CHROM'] = chunk.CHROM.to_numpy(dtype=object)
+    res['POS'] = chunk.POS.values.astype(np.int64)
+    res['REF'] = chunk.REF.to_numpy(dtype=object)
+    res['ALT'] = chunk.ALT.to_numpy(dtype=object)
+    res['QUAL'] = pd.to_numeric(chunk.QUAL, errors='coerce').values
+    n = len(chunk)
+    ns = len(samples)
+    nalleles = chunk.ALT.str.count(',').values + 2
+    amax = nalleles.max() if n>0 else 2
+    for f in fields:
+        if f == 'GT':
+            res[f] = np.full((n,ns), '.', dtype=object)
+        elif f in ['AD','ADF','ADR']:
+            res[f] = np.full((n,ns,amax), -1, dtype=np.int32)
+        else:
+            res[f] = np.full((n,ns), np.nan)
+    if ns == 0 or n == 0:
+        return res
+    #split all samples at once for each distinct FORMAT string
+    values = chunk[samples].to_numpy(dtype=object)
+    for fmt, idx in chunk.groupby('FORMAT', sort=False).indices.items():
+        x = _split_format(values[idx].ravel(), fmt.split(':'), fields, amax)
+        for f in fields:
+            if x[f] is None:
+                continue
+            if f in ['AD','ADF','ADR']:
+                res[f][idx] = x[f].reshape(len(idx),ns,amax)
+            else:
+                res[f][idx] = x[f].reshape(len(idx),ns)
+    return res
+
+def concat_vcf_arrays(parts, samples, fields):
+    """Join the outputs of vcf_chunk_arrays"""
+
+    sitecols = ['CHROM','POS','REF','ALT','QUAL']
+    res = {}
+    for c in sitecols:
+        if len(parts) > 0:
+            res[c] = np.concatenate([p[c] for p in parts])
+        else:
+            res[c] = np.array([], dtype=np.int64 if c=='POS' else object)
+    res['samples'] = samples
+    for f in fields:
+        if len(parts) == 0:
+            res[f] = np.empty((0,len(samples)))
+        elif f in ['AD','ADF','ADR']:
+            #pad chunks to the same number of alleles
+            amax = max(p[f].shape[2] for p in parts)
+            res[f] = np.concatenate([np.pad(p[f], ((0,0),(0,0),(0,amax-p[f].shape[2])),
+                                    constant_values=-1) for p in parts])
+        else:
+            res[f] = np.concatenate([p[f] for p in parts])
+    return res
+
+def get_variant_types(ref, alt):
+    """
+    Variant type and sub type for each site, e.g. snp/ts or indel/del.
+    Args:
+        ref, alt: arrays of REF and ALT strings
+    Returns:
+        arrays of types and sub types
+    """
+
+    def vtype(r, a):
+        alts = a.split(',')
+        if a == '.':
+            return 'indel','del'
+        if len(r) == 1 and all(x in ['A','C','G','T','N','*'] for x in alts):
+            if len(alts) > 1:
+                return 'snp','unknown'
+            if (r+a) in ['AG','GA','CT','TC']:
+                return 'snp','ts'
+            return 'snp','tv'
+        if any(x.startswith('<') or '[' in x or ']' in x for x in alts):
+            return 'unknown','unknown'
+        if len(r) > 1 or any(len(x) != len(r) for x in alts):
+            if len(alts) > 1:
+                return 'indel','unknown'
+            if len(r) > len(a):
+                return 'indel','del'
+            return 'indel','ins'
+        return 'unknown','unknown'
+
+    #only classify each distinct REF/ALT pair once
+    key = pd.Series(ref, dtype=object) + '\t' + pd.Series(alt, dtype=object)
+    codes, uniq = pd.factorize(key)
+    types = np.array([vtype(*u.split('\t')) for u in uniq], dtype=object).reshape(-1,2)
+    return types[codes,0], types[codes,1]
+
+def get_genotype_bases(ref, alt, gt):
+    """
+    Convert GT strings to the called bases.
+    Args:
+        ref, alt: arrays of REF and ALT strings for each site
+        gt: (n_sites, n_samples) array of GT strings
+    Returns:
+        array of the same shape as gt with None for no call
+    """
+
+    nsites = len(ref)
+    alts = pd.Series(alt, dtype=object).str.split(',')
+    nalleles = (alts.str.len()+1).values
+    #table of alleles for each site
+    alleles = np.full((nsites, nalleles.max() if nsites>0 else 1), None, dtype=object)
+    alleles[:,0] = ref
+    for k in np.unique(nalleles):
+        m = nalleles == k
+        alleles[m,1:k] = np.array(alts[m].tolist(), dtype=object).reshape(-1,k-1)
+    #haploid calls are looked up directly
+    gtb = np.full(gt.shape, None, dtype=object)
+    num = pd.to_numeric(pd.Series(gt.ravel()), errors='coerce').values.reshape(gt.shape)
+    i,j = np.where(~np.isnan(num))
+    gtb[i,j] = alleles[i, num[i,j].astype(int)]
+    #anything else e.g. diploid calls
+    for i,j in zip(*np.where(np.isnan(num) & (gt != '.'))):
+        g = re.split(r'([/|])', gt[i,j])
+        if '.' in g:
+            continue
+        gtb[i,j] = ''.join(alleles[i,int(x)] if x not in '/|' else x for x in g)
+    return gtb
+
+def vcf_to_dataframe(vcf_file, region=None, samples=None, parquet=False):
     """
     Convert a multi sample vcf to dataframe. Records each samples FORMAT fields.
+    Samples with no call at a site are omitted.
     Args:
         vcf_file: input multi sample vcf
+        region: only include sites in this region, chrom:start-end
+        samples: only include these samples
+        parquet: save the result as a parquet file next to the vcf and re-load it
+        while it is newer than the vcf, requires pyarrow
     Returns: pandas DataFrame
     """
 
-    import vcf
-    ext = os.path.splitext(vcf_file)[1]
-    if ext == '.gz':
-        file = gzopen(vcf_file, "rt")
-    else:
-        file = open(vcf_file)
-    vcf_reader = vcf.Reader(file,'r')
-    res=[]
+    pqfile = vcf_file+'.parquet'
+    if parquet == True and region == None and samples == None:
+        if os.path.exists(pqfile) and os.path.getmtime(pqfile) >= os.path.getmtime(vcf_file):
+            return pd.read_parquet(pqfile)
+    v = read_vcf_arrays(vcf_file, fields=['GT','DP','AD','ADF','ADR'],
+                        region=region, samples=samples)
     cols = ['sample','REF','ALT','mut','DP','ADF','ADR','AD','chrom','var_type',
             'sub_type','start','end','QUAL']
-    i=0
-    for rec in vcf_reader:
-        #if i>50:
-        #    break
-        x = [rec.CHROM, rec.var_type, rec.var_subtype, rec.start, rec.end, rec.QUAL]
-        for sample in rec.samples:
-            if sample.gt_bases == None:
-                mut=''
-                row = [sample.sample, rec.REF, sample.gt_bases, mut, 0,0,0,0]
-            elif rec.REF != sample.gt_bases:
-                mut = str(rec.end)+rec.REF+'>'+sample.gt_bases
-                cdata = sample.data
-                row = [sample.sample, rec.REF, sample.gt_bases, mut, cdata[2], cdata[4] ,cdata[5], cdata[6]] + x
-            else:
-                mut = str(rec.end)+rec.REF
-                #inf = sample.site.INFO
-                cdata = sample.data
-                row = [sample.sample, rec.REF, sample.gt_bases, mut, cdata[2], cdata[4] ,cdata[5], cdata[6]] + x
-
-            res.append(row)
-    res = pd.DataFrame(res,columns=cols)
-    res = res[~res.start.isnull()]
-    #res['start'] = res.start.astype(int)
-    #res['end'] = res.end.astype(int)
+    ns = len(v['samples'])
+    nsites = len(v['POS'])
+    if nsites == 0 or ns == 0:
+        return pd.DataFrame(columns=cols)
+    ref = v['REF']
+    alts = pd.Series(v['ALT']).str.split(',')
+    nalleles = (alts.str.len()+1).values
+    var_type, sub_type = get_variant_types(ref, v['ALT'])
+    start = v['POS']-1
+    end = start + pd.Series(ref).str.len().values
+
+    gtb = get_genotype_bases(ref, v['ALT'], v['GT'])
+
+    #long form with one row per site and sample
+    site = np.repeat(np.arange(nsites), ns)
+    gtb = gtb.ravel()
+    keep = np.array([x is not None for x in gtb], dtype=bool)
+    site = site[keep]
+    gtb = gtb[keep]
+    res = pd.DataFrame({'sample': np.tile(np.array(v['samples'], dtype=object), nsites)[keep],
+                        'REF': ref[site], 'ALT': gtb})
+    mut = pd.Series(end[site].astype(str), dtype=object) + ref[site]
+    diff = ref[site] != gtb
+    mut[diff] = mut[diff] + '>' + gtb[diff]
+    res['mut'] = mut.values
+    res['DP'] = np.nan_to_num(v['DP'].ravel()[keep]).astype(int)
+    for f in ['ADF','ADR','AD']:
+        a = v[f].reshape(nsites*ns,-1)[keep]
+        na = nalleles[site]
+        lists = np.empty(len(a), dtype=object)
+        for k in np.unique(na):
+            m = na == k
+            lists[m] = pd.Series(a[m,:k].tolist(), dtype=object).values
+        res[f] = lists
+    res['chrom'] = v['CHROM'][site]
+    res['var_type'] = var_type[site]
+    res['sub_type'] = sub_type[site]
+    res['start'] = start[site]
+    res['end'] = end[site]
+    res['QUAL'] = v['QUAL'][site]
+    if parquet == True and region == None and samples == None:
+        try:
+            res.to_parquet(pqfile)
+        except ImportError:
+            print ('pyarrow is needed to save parquet files')
     return res
 
+class SparseMatrix(object):
+    """
+    Sparse presence/absence matrix with row and column labels, used for
+    mutation by sample matrices which are mostly zeros.
+    Args:
+        data: scipy sparse matrix
+        index: row labels, a pandas Index or MultiIndex
+        columns: column labels
+    """
+    def __init__(self, data, index, columns):
+        from scipy import sparse
+        self.data = sparse.csr_matrix(data, dtype=bool)
+        if not isinstance(index, pd.Index):
+            index = pd.Index(index)
+        if not isinstance(columns, pd.Index):
+            columns = pd.Index(columns)
+        self.index = index
+        self.columns = columns
+        return
+
+    @classmethod
+    def from_pairs(cls, rows, cols):
+        """
+        Make the matrix from pairs of row and column labels that are present.
+        Args:
+            rows: row labels, a dataframe gives a MultiIndex
+            cols: column labels
+        """
+
+        from scipy import sparse
+        if isinstance(rows, pd.DataFrame):
+            ridx = pd.MultiIndex.from_frame(rows)
+        else:
+            ridx = pd.Index(rows)
+        rcodes, index = pd.factorize(ridx, sort=True)
+        if isinstance(ridx, pd.MultiIndex):
+            index = pd.MultiIndex.from_tuples(index, names=ridx.names)
+        else:
+            index = pd.Index(index, name=ridx.name)
+        cidx = pd.Index(cols)
+        ccodes, columns = pd.factorize(cidx, sort=True)
+        columns = pd.Index(columns, name=cidx.name)
+        data = sparse.coo_matrix((np.ones(len(rcodes), dtype=bool), (rcodes, ccodes)),
+                                 shape=(len(index), len(columns)))
+        return cls(data, index, columns)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __repr__(self):
+        return 'SparseMatrix %s rows x %s columns, %s values' %(self.shape[0],
+                    self.shape[1],self.data.nnz)
+
+    def to_dense(self):
+        """Dense dataframe of 0/1 values, only for small matrices"""
+
+        return pd.DataFrame(self.data.toarray().astype(int), index=self.index,
+                            columns=self.columns)
+
+    def row(self, label):
+        """Columns present for a row label"""
+
+        i = self.index.get_loc(label)
+        return list(self.columns[self.data[i].indices])
+
+    def column(self, label):
+        """Row labels present for a column"""
+
+        j = self.columns.get_loc(label)
+        return self.index[self.data[:,j].nonzero()[0]]
+
+    def sum(self, axis=0):
+        """Counts over rows (axis=0) or columns (axis=1)"""
+
+        s = np.asarray(self.data.sum(axis)).ravel()
+        if axis == 0:
+            return pd.Series(s, index=self.columns)
+        return pd.Series(s, index=self.index)
+
+    def to_csv(self, filename, chunksize=5000):
+        """Write as a text table without densifying the whole matrix"""
+
+        with open(filename, 'w') as f:
+            for i in range(0, max(len(self),1), chunksize):
+                block = self.data[i:i+chunksize].toarray().astype(int)
+                x = pd.DataFrame(block, index=self.index[i:i+chunksize], columns=self.columns)
+                x.to_csv(f, header=(i==0))
+        return
+
+    def save_npz(self, filename):
+        """Save in compressed numpy format with the labels"""
+
+        arrays = {'indptr': self.data.indptr, 'indices': self.data.indices,
+                  'shape': np.array(self.shape), 'columns': np.array(list(self.columns), dtype=str),
+                  'index_names': np.array([str(n) for n in self.index.names], dtype=str)}
+        for i in range(self.index.nlevels):
+            level = self.index.get_level_values(i)
+            if level.dtype.kind in 'iuf':
+                arrays['index_%s' %i] = level.values
+            else:
+                arrays['index_%s' %i] = np.array([str(x) for x in level], dtype=str)
+        np.savez_compressed(filename, **arrays)
+        return
+
+    @classmethod
+    def load_npz(cls, filename):
+        """Load a matrix saved with save_npz"""
+
+        from scipy import sparse
+        with np.load(filename, allow_pickle=False) as f:
+            shape = tuple(f['shape'])
+            data = sparse.csr_matrix((np.ones(len(f['indices']), dtype=bool), f['indices'],
+                                      f['indptr']), shape=shape)
+            names = list(f['index_names'])
+            levels = [f['index_%s' %i] for i in range(len(names))]
+            columns = f['columns']
+        if len(levels) == 1:
+            index = pd.Index(levels[0], name=names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(levels, names=names)
+        return cls(data, index, columns)
+
 def get_snp_matrix(df):
-    """SNP matrix from multi sample vcf dataframe"""
+    """SNP presence/absence matrix from multi sample vcf dataframe.
+    Returns: a SparseMatrix of mutations by samples"""
 
     df = df.drop_duplicates(['mut','sample'])
-    x = df.set_index(['mut','sample'])['start'].unstack('sample')
-    x[x.notna()] = 1
-    x = x.fillna(0)
-    return x
+    return SparseMatrix.from_pairs(df['mut'], df['sample'])
 
 def plot_fastq_qualities(filename, ax=None, limit=10000):
     """Plot fastq qualities"""
@@ -735,6 +1424,67 @@ def samtools_flagstat(filename):
         d[c] = v
     return d
 
+def get_bam_length(bam_file):
+    """Get total length of reference sequences from a bam header"""
+
+    samtoolscmd = get_cmd('samtools')
+    cmd = '{s} view -H {b}'.format(s=samtoolscmd,b=bam_file)
+    tmp = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+    return sum([int(i[3:]) for i in re.findall(r'LN:\d+', tmp)])
+
+def samtools_stats(bam_file, ref_length=None, threads=1, overwrite=False, ref=None,
+                   total=None, filtered=False):
+    """
+    Get mapping counts, mean depth, breadth of coverage and insert size from
+    a bam file in a single pass with samtools stats. The raw output is saved
+    next to the bam and re-used while it is newer than the bam file.
+    Args:
+        bam_file: sorted bam file
+        ref_length: length of the reference, read from the bam header if not given
+        ref: reference fasta, needed for cram files
+        total: number of input reads, e.g. from trimming, used for the
+        percentage mapped instead of the reads in the bam
+        filtered: unmapped reads were removed from the bam, perc_mapped is
+        left empty unless total is given
+    Returns:
+        dict of stats
+    """
+
+    samtoolscmd = get_cmd('samtools')
+    statsfile = bam_file+'.stats'
+    if overwrite == True or not os.path.exists(statsfile) or \
+        os.path.getmtime(statsfile) < os.path.getmtime(bam_file):
+        cmd = '{s} stats -@ {t} -c 1,10000,1 {r} {b} > {o}'.format(s=samtoolscmd,t=threads,
+                    b=bam_file,o=statsfile,r=reference_option(ref))
+        subprocess.check_output(cmd, shell=True)
+    sn = {}
+    cov = []
+    for line in open(statsfile):
+        if line.startswith('SN\t'):
+            x = line.split('\t')
+            sn[x[1].rstrip(':')] = float(x[2])
+        elif line.startswith('COV\t'):
+            x = line.split('\t')
+            cov.append((int(x[2]), int(x[3])))
+    if ref_length == None:
+        ref_length = get_bam_length(bam_file)
+    cov = np.array(cov, dtype=np.int64).reshape(-1,2)
+    d = {}
+    d['total'] = int(sn['raw total sequences']) if total == None else int(total)
+    d['mapped'] = int(sn['reads mapped'])
+    if filtered == True and total == None:
+        d['perc_mapped'] = None
+    else:
+        d['perc_mapped'] = round(d['mapped']/d['total']*100,2) if d['total']>0 else 0
+    d['properly_paired'] = int(sn['reads properly paired'])
+    d['duplicates'] = int(sn['reads duplicated'])
+    d['mean_depth'] = round(float((cov[:,0]*cov[:,1]).sum()/ref_length),2)
+    d['breadth_1x'] = round(float(cov[cov[:,0]>=1,1].sum()/ref_length*100),2)
+    d['breadth_10x'] = round(float(cov[cov[:,0]>=10,1].sum()/ref_length*100),2)
+    d['insert_size'] = sn['insert size average']
+    d['insert_size_sd'] = sn['insert size standard deviation']
+    return d
+
 def samtools_tview(bam_file, chrom, pos, width=200, ref='', display='T'):
     """View bam alignment with samtools"""
 
@@ -746,23 +1496,31 @@ def samtools_tview(bam_file, chrom, pos, width=200, ref='', display='T'):
     tmp = subprocess.check_output(cmd, shell=True, universal_newlines=True)
     return tmp
 
-def samtools_depth(bam_file, chrom=None, start=None, end=None):
-    """Get depth from bam file"""
+def reference_option(ref=None):
+    """samtools reference option for reading cram files"""
+
+    if ref == None:
+        return ''
+    return '--reference {r}'.format(r=ref)
+
+def samtools_depth(bam_file, chrom=None, start=None, end=None, ref=None):
+    """Get depth from bam or cram file"""
 
     samtoolscmd = get_cmd('samtools')
+    r = reference_option(ref)
     if chrom != None and start != None:
-        cmd = '{sc} depth -r {c}:{s}-{e} {b}'.format(b=bam_file,c=chrom,s=start,e=end,sc=samtoolscmd)
+        cmd = '{sc} depth {r} -r {c}:{s}-{e} {b}'.format(b=bam_file,c=chrom,s=start,e=end,sc=samtoolscmd,r=r)
     else:
-        cmd = '{sc} depth {b}'.format(b=bam_file,sc=samtoolscmd)
+        cmd = '{sc} depth {r} {b}'.format(b=bam_file,sc=samtoolscmd,r=r)
     tmp=subprocess.check_output(cmd, shell=True, universal_newlines=True)
     from io import StringIO
     c = pd.read_csv(StringIO(tmp),sep='\t',names=['chr','pos','depth'])
     return c
 
-def get_mean_depth(bam_file, chrom=None, start=None, end=None, how='mean'):
-    """Get mean depth from bam file"""
+def get_mean_depth(bam_file, chrom=None, start=None, end=None, how='mean', ref=None):
+    """Get mean depth from bam or cram file"""
 
-    c = samtools_depth(bam_file, chrom, start, end)
+    c = samtools_depth(bam_file, chrom, start, end, ref=ref)
     if how == 'mean':
         return c.depth.mean().round(2)
     else:
@@ -787,7 +1545,6 @@ def gff_bcftools_format(in_file, out_file):
     """
 
     from BCBio import GFF
-    in_handle = open(in_file)
     out_handle = open(out_file, "w")
     from Bio.SeqFeature import SeqFeature
     from Bio.SeqFeature import FeatureLocation
@@ -833,7 +1590,8 @@ def gff_bcftools_format(in_file, out_file):
             new.features.append(feat)
         #write the new features to a GFF
         GFF.write([new], out_handle)
-        return
+    out_handle.close()
+    return
 
 def get_spoligotype(filename, reads_limit=500000, threshold=2):
     """Get mtb spoligotype from WGS reads"""
@@ -18,7 +18,7 @@
     Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """
 
-import sys,os,subprocess,glob,shutil,re,random
+import sys,os,subprocess,glob,shutil,re,random,time
 import platform
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
@@ -120,8 +120,8 @@ def run_RAXML(infile, name='variants', threads=8, bootstraps=100, outpath='.'):
         os.makedirs(outpath, exist_ok=True)
 
     model = 'GTRCAT'
-    s1 = random.randint(0,1e8)
-    s2 = random.randint(0,1e8)
+    s1 = random.randint(0,10**8)
+    s2 = random.randint(0,10**8)
 
     files = glob.glob(os.path.join(outpath,'RAxML_*'))
     for f in files:
@@ -149,6 +149,286 @@ def convert_branch_lengths(treefile, outfile, snps):
     Phylo.write(tree, outfile, "newick")
     return
 
+def _min_q(D, r, k, buf, block=256):
+    """Position of the smallest neighbour joining criterion
+    Q = (k-2)D_ij - r_i - r_j over the first k rows. Only the upper triangle
+    is scanned, in blocks of rows, using the minimum of each row."""
+
+    best = (np.inf, 0, 0)
+    lower = np.tril(np.ones((block, block), dtype=bool), -1)
+    for s in range(0, k-1, block):
+        e = min(k-1, s+block)
+        q = buf[:e-s, :k-s-1]
+        np.multiply(D[s:e, s+1:k], k-2, out=q)
+        q -= r[s+1:k]
+        #entries on or below the diagonal
+        w = e-s
+        q[:, :w][lower[:w, :w]] = np.inf
+        j = q.argmin(1)
+        v = q[np.arange(e-s), j] - r[s:e]
+        i = v.argmin()
+        if v[i] < best[0]:
+            best = (v[i], s+i, s+1+j[i])
+    return best[1], best[2]
+
+def _branch(name, length):
+    return '%s:%s' %(name, round(max(length, 0), 5))
+
+def nj_tree(dist, outfile=None, method='nj'):
+    """
+    Build a neighbour joining tree from a distance matrix such as the one
+    from tools.snp_dist_matrix, so branch lengths are in snps. The matrix is
+    kept compacted to the active nodes so memory is O(n^2) and each join
+    is a vectorised scan of the remaining rows.
+    Args:
+        dist: square dataframe of distances or the name of a saved matrix,
+        e.g. snpdist.csv
+        outfile: write the newick tree here
+        method: 'nj' or 'bionj', BIONJ weights each join by the variance
+        of the distances and is more accurate when rates vary
+    Returns:
+        newick string of the unrooted tree
+    """
+
+    if isinstance(dist, str):
+        from . import results
+        dist = results.load_table(dist)
+    if method not in ['nj','bionj']:
+        raise ValueError('unknown method %s' %method)
+    names = [str(i) for i in dist.index]
+    n = len(names)
+    D = np.array(dist.values, dtype=np.float64)
+    V = D.copy() if method == 'bionj' else None
+    nodes = list(names)
+    r = D.sum(1)
+    buf = np.empty((min(n, 256), n))
+    k = n
+    while k > 2:
+        i, j = _min_q(D, r, k, buf)
+        if i > j:
+            i, j = j, i
+        dij = D[i,j]
+        li = dij/2 + (r[i]-r[j])/(2*(k-2))
+        lj = dij - li
+        di = D[i,:k].copy()
+        dj = D[j,:k].copy()
+        if method == 'bionj' and V[i,j] > 0:
+            lam = 0.5 + (V[j,:k].sum() - V[i,:k].sum())/(2*(k-2)*V[i,j])
+            lam = min(max(lam, 0), 1)
+        else:
+            lam = 0.5
+        du = lam*(di - li) + (1-lam)*(dj - lj)
+        du[i] = 0
+        #the new node takes row i and the last row is moved into row j
+        r[:k] += du - di - dj
+        D[i,:k] = du
+        D[:k,i] = du
+        r[i] = du.sum() - du[j]
+        if method == 'bionj':
+            vu = lam*V[i,:k] + (1-lam)*V[j,:k] - lam*(1-lam)*V[i,j]
+            vu[i] = 0
+            V[i,:k] = vu
+            V[:k,i] = vu
+        nodes[i] = '(%s,%s)' %(_branch(nodes[i], li), _branch(nodes[j], lj))
+        last = k-1
+        if j != last:
+            D[j,:k] = D[last,:k]
+            D[:k,j] = D[:k,last]
+            D[j,j] = 0
+            r[j] = r[last]
+            if method == 'bionj':
+                V[j,:k] = V[last,:k]
+                V[:k,j] = V[:k,last]
+                V[j,j] = 0
+            nodes[j] = nodes[last]
+        k -= 1
+    if n == 1:
+        tree = '(%s);' %nodes[0]
+    else:
+        tree = '(%s,%s);' %(_branch(nodes[0], D[0,1]/2), _branch(nodes[1], D[0,1]/2))
+    if outfile != None:
+        with open(outfile, 'w') as f:
+            f.write(tree+'\n')
+    return tree
+
+_alignment = None
+
+def _init_bootstrap(infile):
+    """Load the alignment once in each worker process"""
+
+    global _alignment
+    _alignment = tools.alignment_array(AlignIO.read(infile, 'fasta'))
+    return
+
+def _replicate_tree(job):
+    """Build one tree from a resampled alignment and write it to outfile.
+    The tree is written under a temporary name first so an interrupted
+    replicate is not taken as done."""
+
+    i, seed, method, outfile, resample = job
+    names, A = _alignment
+    m = A.shape[1]
+    weights = None
+    if resample == True:
+        rng = np.random.default_rng([seed, i])
+        weights = np.bincount(rng.integers(0, m, m), minlength=m)
+    tmp = outfile+'.tmp'
+    if method in ['nj','bionj']:
+        d = tools.snp_dist_array(A, weights)
+        nj_tree(pd.DataFrame(d, index=names, columns=names), tmp, method=method)
+    else:
+        path = os.path.dirname(outfile)
+        cols = np.repeat(np.arange(m), weights) if weights is not None else np.arange(m)
+        fasta = os.path.join(path, 'rep_%s.fa' %i)
+        recs = [SeqRecord(Seq(A[j,cols].tobytes().decode()), id=n) for j,n in enumerate(names)]
+        SeqIO.write(recs, fasta, 'fasta')
+        if method == 'raxml':
+            name = 'rep_%s' %i
+            for f in glob.glob(os.path.join(path, 'RAxML_*.'+name)):
+                os.remove(f)
+            cmd = 'raxmlHPC -m GTRCAT -V -p {s} -n {n} -w {w} -s {i}'\
+                    .format(s=seed+i, n=name, w=os.path.abspath(path), i=fasta)
+            subprocess.check_output(cmd, shell=True)
+            shutil.move(os.path.join(path, 'RAxML_bestTree.'+name), tmp)
+            for f in glob.glob(os.path.join(path, 'RAxML_*.'+name)):
+                os.remove(f)
+        elif method == 'fasttree':
+            fc = tools.get_cmd('fasttree')
+            subprocess.check_output('{fc} -nt -nosupport {i} > {o}'.format(fc=fc,i=fasta,o=tmp), shell=True)
+        os.remove(fasta)
+    os.replace(tmp, outfile)
+    return outfile
+
+def tree_splits(tree, tips):
+    """Bipartitions of a tree as integer bitmasks of the tips, each split is
+    given as the side without the first tip so rooting does not matter"""
+
+    full = (1 << len(tips)) - 1
+    masks = {}
+    splits = {}
+    for c in tree.find_clades(order='postorder'):
+        if c.is_terminal():
+            masks[id(c)] = 1 << tips[c.name]
+            continue
+        x = 0
+        for ch in c.clades:
+            x |= masks[id(ch)]
+        masks[id(c)] = x
+        s = full ^ x if x & 1 else x
+        #ignore splits of single tips
+        if 1 < bin(s).count('1') < len(tips)-1:
+            splits[id(c)] = s
+    return splits
+
+def add_support(tree, replicates):
+    """
+    Set the confidence of each internal clade to the percentage of replicate
+    trees with the same bipartition.
+    Args:
+        tree: Bio.Phylo tree
+        replicates: list of replicate tree files or trees with the same tips
+    Returns:
+        the tree
+    """
+
+    names = sorted(c.name for c in tree.get_terminals())
+    tips = {n:i for i,n in enumerate(names)}
+    counts = {}
+    for r in replicates:
+        if isinstance(r, str):
+            r = Phylo.read(r, 'newick')
+        for s in set(tree_splits(r, tips).values()):
+            counts[s] = counts.get(s, 0) + 1
+    n = len(replicates)
+    if n == 0:
+        return tree
+    splits = tree_splits(tree, tips)
+    for c in tree.find_clades(terminal=False):
+        if id(c) in splits:
+            c.confidence = round(100*counts.get(splits[id(c)], 0)/n)
+    return tree
+
+def bootstrap_tree(infile, outpath, method='nj', bootstraps=100, threads=4,
+                   treefile=None, seed=None):
+    """
+    Build a tree with bootstrap support. Replicate alignments are made by
+    resampling sites and a tree is inferred from each across a process pool.
+    Each replicate tree is saved as it finishes, so a run that is
+    interrupted continues from the completed replicates when run again.
+    Args:
+        infile: core snp alignment, e.g. core.fa
+        outpath: output folder, replicates are kept in outpath/bootstrap
+        method: 'nj', 'bionj', 'raxml' or 'fasttree', the last two need the
+        external programs and are run single threaded per replicate
+        bootstraps: number of replicates
+        threads: number of processes
+        treefile: best tree to map the support onto, otherwise it is built
+        from the full alignment with the same method
+        seed: random seed, stored with the replicates for resuming. The
+        replicates are removed if the alignment or method has changed
+    Returns:
+        name of the tree file with support values, tree.newick
+    """
+
+    import json
+    path = os.path.join(outpath, 'bootstrap')
+    os.makedirs(path, exist_ok=True)
+    paramsfile = os.path.join(path, 'params.json')
+    from .cache import md5sum
+    aln = AlignIO.read(infile, 'fasta')
+    current = {'method': method, 'md5': md5sum(infile), 'samples': [s.id for s in aln],
+               'sites': aln.get_alignment_length()}
+    params = None
+    if os.path.exists(paramsfile):
+        params = json.load(open(paramsfile))
+        if any(params.get(k) != current[k] for k in current):
+            #replicates of another alignment or method can't be reused
+            print ('alignment or method changed, removing old replicates in %s' %path)
+            for f in glob.glob(os.path.join(path, 'rep_*'))+glob.glob(os.path.join(path, 'best.newick*')):
+                os.remove(f)
+            params = None
+        else:
+            seed = params['seed']
+    if params == None:
+        if seed == None:
+            seed = random.randint(0, 10**8)
+        params = dict(current, seed=seed, infile=os.path.abspath(infile))
+        json.dump(params, open(paramsfile,'w'))
+    jobs = []
+    best = os.path.join(path, 'best.newick')
+    if treefile == None and not os.path.exists(best):
+        jobs.append((-1, seed, method, best, False))
+    repfiles = [os.path.join(path, 'rep_%s.newick' %i) for i in range(bootstraps)]
+    for i,f in enumerate(repfiles):
+        if not os.path.exists(f):
+            jobs.append((i, seed, method, f, True))
+    print ('%s of %s replicates done' %(bootstraps-len([j for j in jobs if j[0]>=0]), bootstraps))
+    threads = max(1, min(int(threads), len(jobs)))
+    st = time.time()
+    if threads > 1:
+        import multiprocessing as mp
+        with mp.Pool(threads, _init_bootstrap, (infile,)) as pool:
+            for f in pool.imap_unordered(_replicate_tree, jobs):
+                print (os.path.basename(f), round(time.time()-st,1))
+    elif len(jobs) > 0:
+        _init_bootstrap(infile)
+        for f in map(_replicate_tree, jobs):
+            print (os.path.basename(f), round(time.time()-st,1))
+    scale = 1
+    if treefile == None:
+        treefile = best
+        if method in ['raxml','fasttree']:
+            #branch lengths in snps
+            scale = current['sites']
+    tree = Phylo.read(treefile, 'newick')
+    add_support(tree, repfiles)
+    for c in tree.find_clades():
+        if c.branch_length:
+            c.branch_length *= scale
+    outfile = os.path.join(outpath, 'tree.newick')
+    Phylo.write(tree, outfile, 'newick')
+    return outfile
+
 def biopython_draw_tree(filename):
 
     from Bio import Phylo
@@ -195,3 +475,279 @@ def remove_nodes(tree, names):
     for n in names:
         node = tree.search_nodes(name=n)[0]
         node.delete()
+
+#fitch state sets, A C G T as bits, anything else is all states
+state_masks = np.array([1,2,4,8,15], dtype=np.uint8)
+
+def fitch_states(X):
+    """State set bit masks of a samples by positions allele array"""
+
+    from . import snp_typing
+    return state_masks[snp_typing.encode_alleles(X)]
+
+def fitch_combine(sets, cost=False):
+    """Fitch set of several state sets, the states found in the most sets.
+    Optionally also returns the number of changes at each site."""
+
+    if len(sets) == 2:
+        a, b = sets
+        inter = a & b
+        res = np.where(inter != 0, inter, a | b)
+        if cost == True:
+            return res, (inter == 0).astype(np.int64)
+        return res
+    counts = np.stack([sum(((s >> b) & 1).astype(np.int64) for s in sets) for b in range(4)])
+    top = counts.max(0)
+    res = np.zeros(len(sets[0]), dtype=np.uint8)
+    for b in range(4):
+        res |= ((counts[b] == top) << b).astype(np.uint8)
+    if cost == True:
+        return res, len(sets) - top
+    return res
+
+class ParsimonyTree(object):
+    """
+    Fitch parsimony state sets on a tree for placing new samples. Down pass
+    sets hold the states of the subtree below each node and up pass sets the
+    states of the rest of the tree, so the cost of attaching a sample to any
+    edge is found for all edges at once.
+    Args:
+        tree: Bio.Phylo tree with tip names matching the alignment
+        states: dataframe of state masks, samples by sites, see fitch_states
+    """
+    def __init__(self, tree, states):
+        self.tree = tree
+        self.states = states
+        self.update()
+        return
+
+    def update(self):
+        """Recompute the state sets after the tree is changed"""
+
+        tree = self.tree
+        self.nodes = list(tree.find_clades(order='postorder'))
+        self.idx = {id(c): i for i,c in enumerate(self.nodes)}
+        self.parent = {}
+        for c in self.nodes:
+            for ch in c.clades:
+                self.parent[id(ch)] = c
+        n = len(self.nodes)
+        m = self.states.shape[1]
+        D = np.zeros((n, m), dtype=np.uint8)
+        self.score = 0
+        for i,c in enumerate(self.nodes):
+            if c.is_terminal():
+                D[i] = self.states.loc[c.name].values
+            else:
+                sets = [D[self.idx[id(ch)]] for ch in c.clades]
+                if len(sets) == 1:
+                    D[i] = sets[0]
+                    continue
+                D[i], changes = fitch_combine(sets, cost=True)
+                self.score += int(changes.sum())
+        U = np.full((n, m), 15, dtype=np.uint8)
+        for c in reversed(self.nodes):
+            p = self.parent.get(id(c))
+            if p == None:
+                continue
+            sets = [D[self.idx[id(s)]] for s in p.clades if s is not c]
+            if id(p) in self.parent:
+                sets.append(U[self.idx[id(p)]])
+            U[self.idx[id(c)]] = fitch_combine(sets) if len(sets) > 1 else sets[0]
+        self.D = D
+        self.U = U
+        return
+
+    def placement_costs(self, q):
+        """Added parsimony cost of attaching a sample with state sets q to
+        the edge above each node"""
+
+        E = fitch_combine([self.D, self.U])
+        return ((E & q) == 0).sum(1)
+
+    def place(self, name, q):
+        """
+        Attach a sample to the edge with the lowest added cost, ties are
+        broken by the distance to the subtree below the edge.
+        Returns:
+            dict with the cost, number of equally good edges and the node
+            below the new branch
+        """
+
+        cost = self.placement_costs(q)
+        root = self.idx[id(self.tree.root)]
+        cost[root] = cost.max()+1
+        best = cost.min()
+        ties = np.flatnonzero(cost == best)
+        below = ((self.D[ties] & q) == 0).sum(1)
+        i = ties[np.argmin(below)]
+        v = self.nodes[i]
+        p = self.parent[id(v)]
+        E = fitch_combine([self.D[i], self.U[i]])
+        #split the edge in proportion to the changes on each side
+        cv = int(((self.D[i] & E) == 0).sum())
+        cu = int(((self.U[i] & E) == 0).sum())
+        L = v.branch_length or 0
+        lv = L*cv/(cv+cu) if cv+cu > 0 else L/2
+        from Bio.Phylo.Newick import Clade
+        leaf = Clade(branch_length=int(best), name=name)
+        w = Clade(branch_length=L-lv, clades=[v, leaf])
+        v.branch_length = lv
+        p.clades[p.clades.index(v)] = w
+        return {'sample': name, 'cost': int(best), 'ties': len(ties), 'edge': v.name}
+
+def alignment_states(core, new=None):
+    """
+    State masks of the core alignment and new samples at the same sites.
+    Args:
+        core: core snp matrix with a ref column or its file name
+        new: snp matrix of new samples or a series of calls for one sample,
+        sites missing from it are taken to be the reference allele
+    Returns:
+        dataframe of state masks of samples by positions
+    """
+
+    from . import snp_typing, results
+    if isinstance(core, str):
+        core = results.load_table(core)
+    names, positions, codes, ref = snp_typing.allele_matrix(core)
+    names = list(names.astype(str))
+    if new is not None:
+        if isinstance(new, pd.Series):
+            new = pd.DataFrame([new.values], index=[new.name], columns=new.index)
+        elif isinstance(new, str):
+            new = snp_typing.read_snp_matrix(new)
+        nnames, npos, ncodes, nref = snp_typing.allele_matrix(new)
+        keep = ~pd.Index(nnames.astype(str)).isin(names)
+        if ref is not None:
+            rc = snp_typing.encode_alleles(ref.values)
+        else:
+            rc = np.full(len(positions), 4, dtype=np.uint8)
+        Q = np.tile(rc, (keep.sum(), 1))
+        idx = pd.Index(npos).get_indexer(positions)
+        Q[:, idx >= 0] = ncodes[keep][:, idx[idx >= 0]]
+        codes = np.concatenate([codes, Q])
+        names += list(nnames[keep].astype(str))
+    return pd.DataFrame(state_masks[codes], index=names, columns=positions)
+
+def state_bases(states):
+    """Allele letters of a dataframe of state masks, N for missing"""
+
+    bases = np.array(list('ACGTN'))
+    return bases[np.searchsorted(state_masks, states.values)]
+
+def tree_core(treefile, core):
+    """
+    Core snp matrix of all the samples in a tree. Trees written by
+    place_samples and update_tree have a copy of the core table with the
+    placed samples added next to them, which is used in place of the
+    given core so later updates include them.
+    """
+
+    stored = treefile+'.core.txt'
+    if os.path.exists(stored):
+        return pd.read_csv(stored, sep=' ', index_col=0)
+    return core
+
+def save_tree_core(states, core, treefile):
+    """Save the states of all samples in a tree next to it as a core.txt
+    table with the ref column of the core"""
+
+    from . import snp_typing
+    names, positions, codes, ref = snp_typing.allele_matrix(core)
+    X = pd.DataFrame(state_bases(states).T, index=states.columns, columns=states.index)
+    if ref is not None:
+        X.insert(0, 'ref', np.asarray(ref)[pd.Index(positions).get_indexer(X.index)])
+    X.index.name = 'pos'
+    X.to_csv(treefile+'.core.txt', sep=' ')
+    return
+
+def place_samples(treefile, core, new, outfile=None, max_new=0.2, max_ties=20):
+    """
+    Place new samples onto an existing tree by parsimony using the sites of
+    its core alignment, without rebuilding the tree. Branch lengths are in
+    snps as in tree.newick.
+    Args:
+        treefile: newick tree made from the core alignment, e.g. tree.newick
+        core: core snp matrix (core.txt) of the samples in the tree, the
+        copy saved with trees from earlier updates is used if present
+        new: snp matrix of the new samples, a vcf or core.txt file, or a
+        series of calls for one sample, see alignment_states
+        outfile: write the updated tree here
+        max_new: fraction of placed samples in the tree above which a rebuild
+        is advised
+        max_ties: number of equally good edges above which a placement is
+        considered ambiguous
+    Returns:
+        updated tree, table of placements and whether the tree should be
+        rebuilt
+    """
+
+    from . import results
+    tree = Phylo.read(treefile, 'newick')
+    core = tree_core(treefile, core)
+    if isinstance(core, str):
+        core = results.load_table(core)
+    states = alignment_states(core, new)
+    tips = set(c.name for c in tree.get_terminals())
+    new = [n for n in states.index if n not in tips]
+    #placements from earlier updates are kept with the tree
+    logfile = treefile+'.placements.csv'
+    prev = pd.read_csv(logfile) if os.path.exists(logfile) else pd.DataFrame()
+    P = ParsimonyTree(tree, states)
+    res = []
+    for name in new:
+        r = P.place(name, states.loc[name].values)
+        res.append(r)
+        P.update()
+    res = pd.concat([prev, pd.DataFrame(res)], ignore_index=True)
+    ntips = len(tree.get_terminals())
+    rebuild = bool(len(res) > max_new*ntips or (res.ties > max_ties).any())
+    if outfile != None:
+        Phylo.write(tree, outfile, 'newick')
+        res.to_csv(outfile+'.placements.csv', index=False)
+        save_tree_core(states, core, outfile)
+    return tree, res, rebuild
+
+def update_tree(treefile, core, new, outdir, rebuild=False, threads=4, **kwargs):
+    """
+    Add new samples to a tree by placement, or rebuild it from the combined
+    alignment if asked or when the placements are of poor quality.
+    Args:
+        treefile: existing tree
+        core: core snp matrix of the tree samples
+        new: snp matrix of the new samples, see place_samples
+        outdir: folder for the new tree
+        rebuild: always rebuild the tree
+        kwargs: passed to place_samples
+    Returns:
+        name of the new tree file
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+    outfile = os.path.join(outdir, 'tree.newick')
+    if rebuild == False:
+        tree, res, rebuild = place_samples(treefile, core, new, outfile, **kwargs)
+        print ('placed %s samples, parsimony cost %s' %(len(res), res.cost.sum()))
+        if rebuild == False:
+            return outfile
+        print ('placement quality is low, rebuilding tree')
+    #samples placed by earlier updates are kept in the rebuilt tree
+    core = tree_core(treefile, core)
+    if isinstance(core, str):
+        from . import results
+        core = results.load_table(core)
+    states = alignment_states(core, new)
+    seqs = state_bases(states)
+    outfasta = os.path.join(outdir, 'core.fa')
+    recs = [SeqRecord(Seq(''.join(c)), id=n) for n,c in zip(states.index, seqs)]
+    SeqIO.write(recs, outfasta, 'fasta')
+    t = run_RAXML(outfasta, threads=threads, outpath=outdir)
+    if t == None:
+        return
+    convert_branch_lengths(t, outfile, states.shape[1])
+    save_tree_core(states, core, outfile)
+    placed = outfile+'.placements.csv'
+    if os.path.exists(placed):
+        os.remove(placed)
+    return outfile
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+    Alignment free triage of samples using split k-mers.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,glob,time
+import numpy as np
+import pandas as pd
+from . import tools
+
+#split k-mers are two flanks of this length either side of a middle base
+flank = 15
+#base codes, anything else is 4 and breaks the k-mers
+code_table = np.full(256, 4, dtype=np.uint8)
+for i,b in enumerate(b'ACGT'):
+    code_table[b] = i
+    code_table[b+32] = i
+
+def kmer_codes(codes, k=flank):
+    """
+    2-bit codes of every k-mer in a sequence of base codes and of their
+    reverse complements, for k up to 16. Built by doubling so it takes
+    log(k) passes over the sequence.
+    """
+
+    n = len(codes)-k+1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    fwd = {1: (codes & 3).astype(np.uint32)}
+    rc = {1: np.uint32(3)-fwd[1]}
+    size = 1
+    while size*2 <= k:
+        f, r = fwd[size], rc[size]
+        m = len(f)-size
+        sh = np.uint32(2*size)
+        fwd[size*2] = (f[:m] << sh) | f[size:size+m]
+        rc[size*2] = (r[size:size+m] << sh) | r[:m]
+        size *= 2
+    #join the power of two parts making up k
+    f = np.zeros(n, dtype=np.uint32)
+    r = np.zeros(n, dtype=np.uint32)
+    pos = 0
+    while size > 0:
+        if pos+size <= k:
+            sh = np.uint32(2*size)
+            f = (f << sh) | fwd[size][pos:pos+n]
+            r = r | (rc[size][pos:pos+n] << np.uint32(2*pos))
+            pos += size
+        size //= 2
+    return f, r
+
+def split_kmers(seq, k=flank):
+    """
+    Canonical split k-mers of a sequence. Each is packed into one integer
+    as the two flanks (4k bits) followed by the middle base (2 bits), so
+    sorting groups the same flanks together.
+    Args:
+        seq: bytes, reads can be joined with newlines as separators
+    Returns:
+        array of uint64 codes
+    """
+
+    codes = code_table[np.frombuffer(seq, dtype=np.uint8)]
+    size = 2*k+1
+    n = len(codes)-size+1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    #windows containing an N or a separator are dropped
+    bad = np.zeros(len(codes)+1, dtype=np.int64)
+    bad[1:] = np.cumsum(codes == 4)
+    valid = bad[size:] - bad[:n] == 0
+    fwd, rc = kmer_codes(codes, k)
+    fwd = fwd.astype(np.uint64)
+    rc = rc.astype(np.uint64)
+    shift = np.uint64(2*k)
+    key = (fwd[:n] << shift) | fwd[k+1:k+1+n]
+    rkey = (rc[k+1:k+1+n] << shift) | rc[:n]
+    mid = (codes[k:k+n] & 3).astype(np.uint64)
+    rev = rkey < key
+    key = np.where(rev, rkey, key)
+    mid = np.where(rev, np.uint64(3)-mid, mid)
+    res = (key << np.uint64(2)) | mid
+    return res[valid]
+
+def count_codes(codes):
+    """Distinct codes and their counts"""
+
+    return np.unique(codes, return_counts=True)
+
+def merge_counts(parts):
+    """Merge a list of (codes, counts) from count_codes"""
+
+    if len(parts) == 1:
+        return parts[0]
+    codes = np.concatenate([p[0] for p in parts])
+    counts = np.concatenate([p[1] for p in parts])
+    u, inv = np.unique(codes, return_inverse=True)
+    return u, np.bincount(inv, weights=counts, minlength=len(u)).astype(np.int64)
+
+def read_sequences(filename, batch_size=20000):
+    """Iterate over batches of sequences in a fastq or fasta file, each
+    batch is the sequences joined by newlines"""
+
+    if os.path.splitext(filename.replace('.gz',''))[1] in ['.fa','.fasta','.fna']:
+        from Bio import SeqIO
+        handle = tools.gzopen(filename,'rt') if filename.endswith('.gz') else open(filename)
+        for rec in SeqIO.parse(handle, 'fasta'):
+            yield str(rec.seq).encode()
+        handle.close()
+        return
+    handle = tools.open_fastq(filename)
+    for lines in tools.batch_iterator(iter(handle), batch_size*4):
+        yield b''.join(lines[1::4])
+    handle.close()
+
+def filter_counts(codes, counts, min_count=3, min_freq=0.8):
+    """
+    Keep split k-mers seen at least min_count times whose middle base has
+    at least min_freq of the reads, which removes most sequencing errors
+    and mixed sites.
+    """
+
+    if len(codes) == 0:
+        return codes[:0]
+    key = codes >> np.uint64(2)
+    start = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    total = np.add.reduceat(counts, start)
+    top = np.maximum.reduceat(counts, start)
+    #position of the most common middle for each key
+    n = np.diff(np.r_[start, len(codes)])
+    first = np.repeat(start, n)
+    best = counts == np.repeat(top, n)
+    idx = np.flatnonzero(best)
+    #ties keep the first and are then failed by the frequency test
+    idx = idx[np.r_[True, first[idx][1:] != first[idx][:-1]]]
+    ok = (top >= min_count) & (top >= min_freq*total)
+    return codes[idx[ok]]
+
+def build_profile(filenames, outfile=None, min_count=3, max_reads=None, batch_size=20000,
+                  merge_size=50000000):
+    """
+    Split k-mer profile of a sample, built from its reads in batches so the
+    reads are never all in memory.
+    Args:
+        filenames: fastq files for the sample, or a fasta assembly where
+        min_count should be 1
+        outfile: save the profile as a .npy file
+        min_count: minimum times a split k-mer is seen
+        max_reads: only use this many reads from each file
+    Returns:
+        sorted array of split k-mer codes
+    """
+
+    parts = []
+    size = 0
+    for f in filenames:
+        if f == None:
+            continue
+        reads = 0
+        for seq in read_sequences(f, batch_size):
+            parts.append(count_codes(split_kmers(seq)))
+            size += len(parts[-1][0])
+            if size > merge_size:
+                parts = [merge_counts(parts)]
+                size = len(parts[0][0])
+            reads += batch_size
+            if max_reads != None and reads >= max_reads:
+                break
+    if len(parts) == 0:
+        profile = np.zeros(0, dtype=np.uint64)
+    else:
+        codes, counts = merge_counts(parts)
+        profile = filter_counts(codes, counts, min_count)
+    if outfile != None:
+        np.save(outfile, profile)
+    return profile
+
+def _build(args):
+    name, files, outfile, min_count, max_reads = args
+    st = time.time()
+    p = build_profile(files, outfile, min_count, max_reads)
+    print ('%s: %s split k-mers, %s seconds' %(name, len(p), round(time.time()-st,1)))
+    return outfile
+
+def profile_samples(samples, outdir, threads=4, min_count=3, max_reads=None,
+                    overwrite=False):
+    """
+    Build split k-mer profiles for samples in parallel, one process per sample.
+    Args:
+        samples: dataframe of files from app.get_samples
+        outdir: folder for the profiles
+    Returns:
+        dict of sample name to profile file
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+    jobs = []
+    profiles = {}
+    for name,df in samples.groupby('sample', sort=False):
+        outfile = os.path.join(outdir, '%s.npy' %name)
+        profiles[name] = outfile
+        if os.path.exists(outfile) and overwrite == False:
+            continue
+        jobs.append((name, list(df.filename), outfile, min_count, max_reads))
+    threads = max(1, min(int(threads), len(jobs)))
+    if threads > 1:
+        import multiprocessing as mp
+        with mp.Pool(threads) as pool:
+            list(pool.imap_unordered(_build, jobs))
+    else:
+        list(map(_build, jobs))
+    return profiles
+
+def load_profiles(path):
+    """Get dict of sample name to profile file for the profiles in a folder"""
+
+    files = sorted(glob.glob(os.path.join(path, '*.npy')))
+    return {os.path.basename(f)[:-4]: f for f in files}
+
+def variable_sites(profiles, partitions=16):
+    """
+    Find split k-mers whose middle base differs between samples. The k-mer
+    space is processed in partitions so only a slice of each profile is
+    loaded at once.
+    Args:
+        profiles: dict of sample name to profile file
+    Returns:
+        matrix of middle base codes, sites by samples, 4 where missing
+    """
+
+    names = list(profiles.keys())
+    arrays = [np.load(profiles[n], mmap_mode='r') for n in names]
+    step = 2**(4*flank+2)//partitions
+    bounds = [np.uint64(i*step) for i in range(partitions)]
+    res = []
+    for i in range(partitions):
+        lo = bounds[i]
+        parts = []
+        samples = []
+        for j,a in enumerate(arrays):
+            s = np.searchsorted(a, lo)
+            e = len(a) if i == partitions-1 else np.searchsorted(a, bounds[i+1])
+            parts.append(np.asarray(a[s:e]))
+            samples.append(np.full(e-s, j, dtype=np.int32))
+        codes = np.concatenate(parts)
+        samples = np.concatenate(samples)
+        if len(codes) == 0:
+            continue
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        samples = samples[order]
+        key = codes >> np.uint64(2)
+        #keys with more than one middle base
+        newcode = np.r_[True, codes[1:] != codes[:-1]]
+        newkey = np.r_[True, key[1:] != key[:-1]]
+        kid = np.cumsum(newkey)-1
+        nmid = np.bincount(kid, weights=newcode)
+        var = nmid[kid] > 1
+        if var.sum() == 0:
+            continue
+        site = np.unique(kid[var], return_inverse=True)[1]
+        m = np.full((site.max()+1, len(names)), 4, dtype=np.uint8)
+        m[site, samples[var]] = (codes[var] & np.uint64(3)).astype(np.uint8)
+        res.append(m)
+    if len(res) == 0:
+        return pd.DataFrame(np.zeros((0,len(names)), dtype=np.uint8), columns=names)
+    return pd.DataFrame(np.concatenate(res), columns=names)
+
+def snp_distances(sites, chunksize=20000):
+    """
+    Approximate pairwise snp distances, the number of variable split k-mers
+    present in both samples with a different middle base.
+    Args:
+        sites: matrix from variable_sites
+    Returns:
+        distance matrix dataframe
+    """
+
+    m = sites.values
+    n = m.shape[1]
+    both = np.zeros((n,n))
+    same = np.zeros((n,n))
+    for i in range(0, len(m), chunksize):
+        x = m[i:i+chunksize]
+        p = (x < 4).astype(np.float32)
+        both += p.T @ p
+        for b in range(4):
+            y = (x == b).astype(np.float32)
+            same += y.T @ y
+    d = np.rint(both-same).astype(int)
+    return pd.DataFrame(d, index=sites.columns, columns=sites.columns)
+
+def nearest(dist, known=None):
+    """
+    Nearest isolate to each sample.
+    Args:
+        dist: distance matrix
+        known: names of known isolates to search, otherwise all other samples
+    Returns:
+        dataframe with the nearest isolate and distance for each new sample
+    """
+
+    names = list(dist.index)
+    if known == None or len(known) == 0:
+        known = names
+    known = [k for k in known if k in names]
+    query = [n for n in names if n not in known or len(known) == len(names)]
+    d = dist.loc[query, known].values.astype(float)
+    #a sample is not its own nearest isolate
+    for i,q in enumerate(query):
+        if q in known:
+            d[i, known.index(q)] = np.inf
+    res = []
+    for i,q in enumerate(query):
+        if np.isinf(d[i]).all():
+            res.append((q, None, np.nan))
+            continue
+        j = np.argmin(d[i])
+        res.append((q, known[j], d[i,j]))
+    df = pd.DataFrame(res, columns=['sample','nearest','distance'])
+    return df.sort_values('distance').reset_index(drop=True)
+
+def run_triage(samples, outdir, known=None, threshold=None, threads=4, min_count=3,
+               max_reads=None, overwrite=False):
+    """
+    Triage samples before a full workflow run. Builds split k-mer profiles
+    from the reads, approximate snp distances between all samples and
+    the nearest known isolate to each sample.
+    Args:
+        samples: dataframe of files from app.get_samples
+        outdir: results folder
+        known: folder of profiles of known isolates from a previous run
+        threshold: samples within this distance of a known isolate are
+        written to selected.txt
+        threads: processes for building profiles
+    Returns:
+        dataframe of nearest isolates, also saved as nearest.csv
+    """
+
+    st = time.time()
+    os.makedirs(outdir, exist_ok=True)
+    profiles = profile_samples(samples, os.path.join(outdir, 'profiles'), threads,
+                               min_count, max_reads, overwrite)
+    names = None
+    if known != None:
+        k = load_profiles(known)
+        names = list(k.keys())
+        for n in names:
+            if n not in profiles:
+                profiles[n] = k[n]
+    print ('finding variable sites in %s profiles' %len(profiles))
+    sites = variable_sites(profiles)
+    dist = snp_distances(sites)
+    dist.to_csv(os.path.join(outdir, 'snpdist.csv'))
+    near = nearest(dist, names)
+    sizes = {n: len(np.load(f, mmap_mode='r')) for n,f in profiles.items()}
+    near['kmers'] = near['sample'].map(sizes)
+    near.to_csv(os.path.join(outdir, 'nearest.csv'), index=False)
+    #sample list usable as a filter for the workflow
+    if threshold != None:
+        sel = near[near.distance <= float(threshold)]['sample']
+    else:
+        sel = near['sample']
+    sel.to_csv(os.path.join(outdir, 'selected.txt'), index=False, header=False)
+    print ('%s variable sites' %len(sites))
+    print ('took %s seconds' %str(round(time.time()-st,0)))
+    return near
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""
+    Random access queries of bgzipped and indexed vcf files.
+    Created Oct 2026
+    Copyright (C) Damien Farrell
+
+    This program is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 2
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import sys,os,io,struct,zlib,gzip,subprocess
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from . import tools
+
+class BGZFReader(object):
+    """
+    Reads blocks from a bgzf file by virtual offset. Decompressed blocks are
+    kept in an LRU cache so repeated queries of the same region don't touch
+    the file.
+    Args:
+        filename: bgzipped file
+        cache_size: number of decompressed blocks to keep
+    """
+    def __init__(self, filename, cache_size=256):
+        self.filename = filename
+        self.handle = open(filename, 'rb')
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        return
+
+    def block(self, coffset):
+        """Get the decompressed data and compressed size of the block at coffset"""
+
+        if coffset in self.cache:
+            self.cache.move_to_end(coffset)
+            return self.cache[coffset]
+        h = self.handle
+        h.seek(coffset)
+        header = h.read(12)
+        if len(header) < 12:
+            return b'', 0
+        if header[:4] != b'\x1f\x8b\x08\x04':
+            raise ValueError('%s is not bgzf compressed' %self.filename)
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = h.read(xlen)
+        #find the BC subfield with the block size
+        bsize = None
+        i = 0
+        while i < xlen:
+            slen = struct.unpack('<H', extra[i+2:i+4])[0]
+            if extra[i:i+2] == b'BC':
+                bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+            i += 4+slen
+        if bsize == None:
+            raise ValueError('%s is not bgzf compressed' %self.filename)
+        cdata = h.read(bsize-xlen-19)
+        data = zlib.decompress(cdata, -15)
+        value = (data, bsize+1)
+        self.cache[coffset] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def lines(self, voffset, end=None):
+        """Iterate over lines starting at a virtual offset, stopping at the
+        line starting at or after the virtual offset end. Yields the line and
+        its virtual offset."""
+
+        coffset = voffset >> 16
+        uoffset = voffset & 0xffff
+        buf = b''
+        bufstart = voffset
+        while True:
+            data, csize = self.block(coffset)
+            if csize == 0:
+                break
+            data = data[uoffset:]
+            pos = 0
+            while True:
+                if end != None and len(buf) == 0 and (coffset<<16|uoffset+pos) >= end:
+                    return
+                n = data.find(b'\n', pos)
+                if n == -1:
+                    break
+                if len(buf) == 0:
+                    bufstart = coffset<<16|uoffset+pos
+                yield (buf+data[pos:n]).decode(), bufstart
+                buf = b''
+                pos = n+1
+            if pos < len(data):
+                if len(buf) == 0:
+                    bufstart = coffset<<16|uoffset+pos
+                buf += data[pos:]
+            coffset += csize
+            uoffset = 0
+        if len(buf) > 0:
+            yield buf.decode(), bufstart
+        return
+
+    def close(self):
+        self.handle.close()
+
+def reg2bins(beg, end, min_shift=14, depth=5):
+    """
+    Bins that may contain records overlapping the 0-based half open
+    region beg-end, as defined in the CSI specification.
+    """
+
+    bins = []
+    end -= 1
+    s = min_shift + depth*3
+    t = 0
+    for l in range(depth+1):
+        b = t + (beg>>s)
+        e = t + (end>>s)
+        bins.extend(range(b, e+1))
+        t += 1 << l*3
+        s -= 3
+    return bins
+
+def _read_names(data):
+    """sequence names from the tabix style header"""
+
+    return [n.decode() for n in data.split(b'\x00') if n != b'']
+
+def read_index(filename):
+    """
+    Read a tabix (.tbi) or CSI (.csi) index.
+    Returns:
+        dict with min_shift, depth, sequence names and for each sequence a
+        dict of bin: list of (start, end) virtual offset chunks
+    """
+
+    data = gzip.open(filename).read()
+    magic = data[:4]
+    refs = []
+    names = []
+    if magic == b'TBI\x01':
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack('<8i', data[4:36])
+        names = _read_names(data[36:36+l_nm])
+        p = 36+l_nm
+        min_shift, depth = 14, 5
+    elif magic == b'CSI\x01':
+        min_shift, depth, l_aux = struct.unpack('<3i', data[4:16])
+        aux = data[16:16+l_aux]
+        if l_aux >= 28:
+            l_nm = struct.unpack('<i', aux[24:28])[0]
+            names = _read_names(aux[28:28+l_nm])
+        p = 16+l_aux
+        n_ref = struct.unpack('<i', data[p:p+4])[0]
+        p += 4
+    else:
+        raise ValueError('%s is not a tbi or csi index' %filename)
+    for r in range(n_ref):
+        n_bin = struct.unpack('<i', data[p:p+4])[0]
+        p += 4
+        bins = {}
+        for b in range(n_bin):
+            if magic == b'TBI\x01':
+                bin, n_chunk = struct.unpack('<Ii', data[p:p+8])
+                p += 8
+            else:
+                bin, loffset, n_chunk = struct.unpack('<IQi', data[p:p+16])
+                p += 16
+            chunks = np.frombuffer(data, dtype='<u8', count=n_chunk*2, offset=p).reshape(-1,2)
+            p += n_chunk*16
+            bins[bin] = chunks
+        if magic == b'TBI\x01':
+            #skip the linear index
+            n_intv = struct.unpack('<i', data[p:p+4])[0]
+            p += 4+n_intv*8
+        refs.append(bins)
+    return {'min_shift':min_shift, 'depth':depth, 'names':names, 'refs':refs}
+
+class GenotypeQuery(object):
+    """
+    Query genotypes and depths by region, position or sample from a bgzipped
+    and indexed vcf, e.g. the snps.vcf.gz output of a workflow. Only the blocks
+    covering the query are read and decompressed blocks are cached. BCF files
+    are queried through bcftools.
+    Args:
+        vcf_file: bgzipped vcf with a .csi or .tbi index, or an indexed bcf file
+        cache_size: number of decompressed blocks to keep
+    Usage:
+        Q = GenotypeQuery('results/snps.vcf.gz')
+        Q.genotypes('LT708304.1:3100000-3120000', samples=['s1','s2'])
+    """
+    def __init__(self, vcf_file, cache_size=256):
+        self.vcf_file = vcf_file
+        self.bcf = os.path.splitext(vcf_file)[1] == '.bcf'
+        if self.bcf == True:
+            cmd = '{bc} query -l {v}'.format(bc=tools.get_cmd('bcftools'),v=vcf_file)
+            tmp = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+            self.columns = ['CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO','FORMAT']+tmp.split()
+            self.samples = self.columns[9:]
+            #contig names from the header, used when positions are given without a chrom
+            cmd = '{bc} view -h {v}'.format(bc=tools.get_cmd('bcftools'),v=vcf_file)
+            tmp = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+            self.index = {'names': self._contigs(tmp.split('\n'))}
+            return
+        for ext in ['.csi','.tbi']:
+            if os.path.exists(vcf_file+ext):
+                self.index = read_index(vcf_file+ext)
+                break
+        else:
+            raise ValueError('no index found for %s' %vcf_file)
+        self.reader = BGZFReader(vcf_file, cache_size)
+        for line,v in self.reader.lines(0):
+            if line.startswith('#CHROM'):
+                self.columns = line[1:].split('\t')
+                break
+        self.samples = self.columns[9:]
+        if len(self.index['names']) == 0:
+            #bcftools csi index of a vcf without names, use the contig header lines
+            self.index['names'] = self._contigs(line for line,v in self.reader.lines(0))
+        return
+
+    def _contigs(self, lines):
+        names = []
+        for line in lines:
+            if line.startswith('##contig=<ID='):
+                names.append(line[13:].split(',')[0].rstrip('>'))
+            elif not line.startswith('#'):
+                break
+        return names
+
+    def _region_lines(self, chrom, start=None, end=None):
+        """Get vcf lines overlapping a region, start and end are 1-based inclusive"""
+
+        if start == None:
+            start = 1
+        if end == None:
+            end = 2**29
+        if self.bcf == True:
+            cmd = '{bc} view -H -r {c}:{s}-{e} {v}'.format(bc=tools.get_cmd('bcftools'),
+                                c=chrom,s=start,e=end,v=self.vcf_file)
+            tmp = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+            return [l for l in tmp.split('\n') if l != '']
+        idx = self.index
+        if chrom not in idx['names']:
+            return []
+        bins = idx['refs'][idx['names'].index(chrom)]
+        chunks = [bins[b] for b in reg2bins(start-1, end, idx['min_shift'], idx['depth']) if b in bins]
+        if len(chunks) == 0:
+            return []
+        chunks = np.concatenate(chunks)
+        chunks = chunks[np.argsort(chunks[:,0])]
+        #merge overlapping chunks so no line is read twice
+        merged = []
+        for s,e in chunks:
+            if len(merged) > 0 and s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s,e])
+        res = []
+        for s,e in merged:
+            for line,v in self.reader.lines(int(s), int(e)):
+                x = line.split('\t', 2)
+                if x[0] != chrom:
+                    continue
+                pos = int(x[1])
+                if pos > end:
+                    break
+                if pos >= start:
+                    res.append(line)
+        return res
+
+    def _to_arrays(self, lines, samples, fields):
+        if samples == None:
+            samples = self.samples
+        else:
+            samples = [s for s in self.samples if s in samples]
+        usecols = ['CHROM','POS','REF','ALT','QUAL','FORMAT'] + samples
+        if len(lines) == 0:
+            return tools.concat_vcf_arrays([], samples, fields)
+        chunk = pd.read_csv(io.StringIO('\n'.join(lines)), sep='\t', header=None,
+                            names=self.columns, usecols=usecols, dtype=str, na_filter=False)
+        return tools.vcf_chunk_arrays(chunk, samples, fields)
+
+    def query(self, region=None, positions=None, samples=None, fields=['GT','DP','AD']):
+        """
+        Get genotype arrays for a region or list of positions.
+        Args:
+            region: region string chrom:start-end
+            positions: list of positions on the chromosome given in region, or
+            of (chrom, pos) tuples
+            samples: subset of samples
+            fields: FORMAT fields to read
+        Returns:
+            dict of arrays as returned by tools.read_vcf_arrays
+        """
+
+        chrom, start, end = tools.parse_region(region)
+        if positions is None:
+            if chrom == None:
+                raise ValueError('a region or positions are needed')
+            lines = self._region_lines(chrom, start, end)
+            return self._to_arrays(lines, samples, fields)
+        if chrom == None and not all(type(p) is tuple for p in positions):
+            if len(self.index['names']) == 0:
+                raise ValueError('no contigs in header of %s, give a region or (chrom, pos) tuples' %self.vcf_file)
+            chrom = self.index['names'][0]
+        pos = pd.DataFrame([p if type(p) is tuple else (chrom,p) for p in positions],
+                            columns=['chrom','pos'])
+        lines = []
+        for c,g in pos.groupby('chrom', sort=False):
+            p = np.sort(g.pos.unique())
+            #query runs of nearby positions together
+            breaks = np.where(np.diff(p) > 10000)[0]+1
+            for run in np.split(p, breaks):
+                for line in self._region_lines(c, int(run[0]), int(run[-1])):
+                    if int(line.split('\t',2)[1]) in run:
+                        lines.append(line)
+        return self._to_arrays(lines, samples, fields)
+
+    def genotypes(self, region=None, positions=None, samples=None):
+        """Called bases at each site as a dataframe of positions by samples"""
+
+        v = self.query(region, positions, samples, fields=['GT'])
+        gtb = tools.get_genotype_bases(v['REF'], v['ALT'], v['GT'])
+        df = pd.DataFrame(gtb, columns=v['samples'], index=v['POS'])
+        df.index.name = 'pos'
+        return df
+
+    def depths(self, region=None, positions=None, samples=None):
+        """Read depth at each site as a dataframe of positions by samples"""
+
+        v = self.query(region, positions, samples, fields=['DP'])
+        df = pd.DataFrame(v['DP'], columns=v['samples'], index=v['POS'])
+        df.index.name = 'pos'
+        return df
@@ -31,7 +31,7 @@ try:
 except AttributeError:
     def _fromUtf8(s):
         return s
-from . import tools, plotting
+from . import tools, plotting, annotation
 
 module_path = os.path.dirname(os.path.abspath(__file__))
 iconpath = os.path.join(module_path, 'icons')
@@ -808,7 +808,7 @@ class SimpleBamViewer(QDialog):
         chromnames = plotting.get_fasta_names(ref_file)
         length = plotting.get_fasta_length(ref_file)
         if self.gb_file != None:
-            df = tools.genbank_to_dataframe(gb_file)
+            df = annotation.load_genbank(gb_file).to_dataframe()
             df.loc[df["gene"].isnull(),'gene'] = df.locus_tag
             genes = df.gene.unique()
             self.annot = df
@@ -1079,12 +1079,13 @@ class GraphicalBamViewer(QDialog):
             xend = length
 
         #print (start, end)
-        cov = plotting.get_coverage(self.bam_file, self.chrom, xstart, xend)
+        cov = plotting.get_coverage(self.bam_file, self.chrom, xstart, xend, ref=self.ref_file)
         plotting.plot_coverage(cov,ax=self.ax1,xaxis=False)
-        plotting.plot_bam_alignment(self.bam_file, self.chrom, xstart, xend, ax=self.ax2)
+        plotting.plot_bam_alignment(self.bam_file, self.chrom, xstart, xend, ax=self.ax2,
+                                    ref=self.ref_file)
         if self.gb_file != None:
-            recs = tools.gb_to_records(self.gb_file)
-            plotting.plot_features(recs[0], self.ax3, xstart=xstart, xend=xend)
+            feats = annotation.load_genbank(self.gb_file).overlaps(xstart, xend)
+            plotting.plot_features(feats, self.ax3, xstart=xstart, xend=xend)
 
         self.canvas.draw()
         self.view_range = xend-xstart